@@ -0,0 +1,504 @@
+import json
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import os
+import tempfile
+from datetime import datetime
+from threading import Thread
+from time import perf_counter, process_time
+from .utils import AttrDict
+from .encx264_impl import encode, parse_encode_result_line, run_pass
+from .x264_output import X264OutputParser, parse_line, event_types
+from .scheduler import Scheduler, Runner, cpu_count
+from .version import version
+from . import task as task_module
+
+__all__ = ["bench_subcommand"]
+
+def run_encodes(jobs, args, threads=None):
+    """Runs jobs copies of an encode at the same time, returns
+    (wall seconds, total frames, list of return codes)."""
+    frames = [0] * jobs
+    codes = [None] * jobs
+
+    def run(i):
+        def print_hook(*a, **kwargs):
+            if "file" in kwargs:
+                print(*a, **kwargs)
+                return
+
+            event = parse_line(' '.join([str(x) for x in a]))
+            if event.type == event_types.summary:
+                frames[i] += event.frames
+
+        job_args = [args[0], args[1], "bench_{0}.264".format(i)] + args[2:]
+        codes[i] = encode(job_args, print_hook, threads=threads)
+
+    start = datetime.now()
+    threads_list = [Thread(target=run, args=(i,)) for i in range(jobs)]
+    for t in threads_list:
+        t.start()
+
+    for t in threads_list:
+        t.join()
+
+    return (datetime.now() - start).total_seconds(), sum(frames), codes
+
+def bench_threads(args):
+    """threads <jobs> <target> <input> [encode parameters]
+
+    Runs <jobs> concurrent encodes of the same input twice, once with
+    x264's "--threads auto" and once with the per-slot budget the task
+    runner would use, and compares total throughput."""
+    if len(args) < 3:
+        print("Usage: !bench " + bench_threads.__doc__.splitlines()[0])
+        return 1
+
+    jobs = int(args[0])
+    encode_args = args[1:] + ["--1pass-only"]
+    cores = cpu_count()
+    results = []
+    for name, threads in [("auto", None),
+                          ("budget", max(1, cores // jobs))]:
+        print("Running {0} encodes with --threads {1}..."
+              .format(jobs, threads or "auto"))
+        secs, frames, codes = run_encodes(jobs, encode_args, threads)
+        if any(codes):
+            print("Encode failed:", codes)
+            return 1
+
+        results.append((name, threads or "auto", secs, frames / secs))
+
+    print("")
+    print("{0:<8}{1:>8}{2:>12}{3:>14}".format("mode", "threads", "seconds",
+                                            "total fps"))
+    for r in results:
+        print("{0:<8}{1:>8}{2:>12.2f}{3:>14.2f}".format(*r))
+
+    print("speedup: {0:.3f}x".format(results[1][3] / results[0][3]))
+    ret = {"jobs": jobs}
+    for name, threads, secs, fps in results:
+        ret[name + "_threads"] = threads
+        ret[name + "_fps"] = round(fps, 2)
+
+    for i in range(jobs):
+        for f in ["bench_{0}.264", "bench_{0}.264.log",
+                  "bench_{0}.264.bitrate.txt", "bench_{0}.264.x264_stats",
+                  "bench_{0}.264.x264_stats.mbtree"]:
+            if os.path.isfile(f.format(i)):
+                os.remove(f.format(i))
+
+    return ret
+
+def sample_output(lines):
+    """Synthetic x264 output: mostly progress lines, like a real encode."""
+    ret = ["avs [info]: 1920x1080p 1:1 @ 24000/1001 fps (cfr)",
+           "x264 [info]: profile High, level 4.1"]
+    total = lines
+    for i in range(lines):
+        ret.append("[{0:.1f}%] {1}/{2} frames, {3:.2f} fps, {4:.2f} kb/s, "
+                   "eta 0:{5:02d}:{6:02d}".format(
+                       i * 100.0 / total, i, total, 20 + i % 7,
+                       4000 + i % 1000, (total - i) // 60 % 60,
+                       (total - i) % 60))
+        if i % 5000 == 0:
+            ret.append("x264 [info]: frame I:1234  Avg QP:17.12  "
+                       "size:123456")
+
+    ret.append("x264 [info]: SSIM Mean Y:0.9812345 (17.264db)")
+    ret.append("encoded {0} frames, 23.45 fps, 4321.00 kb/s".format(total))
+    return ret
+
+def legacy_parse(lines):
+    """What run_pass and the task runner's print hook used to do with every
+    line, each on its own."""
+    result = None
+    # the title shows the percentage, summed so it is really converted
+    percent_sum = 0.0
+    for l in lines:
+        if l.startswith("["):
+            pass
+        elif not result:
+            result = legacy_result_line(l)
+
+        line = l.strip()
+        if line.startswith("["):
+            percent_sum += float(line[1:line.index('%')])
+
+        legacy_result_line(line)
+
+    return dict(result, percent_sum=percent_sum)
+
+def legacy_result_line(line):
+    m = re.match(r"\s*encoded \d+ frames.*", line)
+    if not m:
+        return None
+
+    fps = re.search(r"([\d\.]+)\s*fps", line).group(1)
+    bitrate = re.search(r"([\d\.]+)\s*kb/s", line).group(1)
+    return {"fps": float(fps), "bitrate": int(float(bitrate))}
+
+def event_parse(lines):
+    """One parse in run_pass, the task runner subscribes to the events."""
+    percent_sum = [0.0]
+    def on_event(event):
+        if event.type == event_types.progress:
+            # what the task runner shows in the title
+            percent_sum[0] += event.percent
+
+    parser = X264OutputParser(on_event)
+    for l in lines:
+        parser.feed(l)
+
+    return dict(parser.result(), percent_sum=percent_sum[0])
+
+def bench_parse(args):
+    """parse [lines]
+
+    Lines per second of x264 output handling, the old string checks versus
+    the event parser."""
+    lines = sample_output(int(args and args[0] or 200000))
+    print("{0:<8}{1:>14}".format("parser", "lines/s"))
+    ret = {"lines": len(lines)}
+    percent_sums = []
+    for name, func in [("legacy", legacy_parse), ("events", event_parse)]:
+        start = datetime.now()
+        result = func(lines)
+        secs = max((datetime.now() - start).total_seconds(), 0.000001)
+        assert result["fps"] == 23.45 and result["bitrate"] == 4321
+        # both did the same work
+        percent_sums.append(result["percent_sum"])
+        assert abs(percent_sums[0] - percent_sums[-1]) < 0.01
+        print("{0:<8}{1:>14.0f}".format(name, len(lines) / secs))
+        ret[name + "_lines_per_sec"] = round(len(lines) / secs)
+
+    return ret
+
+fake_x264 = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "fake_x264.py")
+
+def bench_output(args):
+    """output [frames]
+
+    Spawns the fake x264 (fake_x264.py) as fast as it can go and reads its
+    output through run_pass, the path every encode takes. cpu time is the
+    runner's own, without the fake's."""
+    frames = int(args and args[0] or 100000)
+    os.environ["FAKE_X264_FRAMES"] = str(frames)
+    os.environ["FAKE_X264_FPS"] = "0"
+    cmdline = '"{0}" "{1}" --pass 2 --output "{2}"'.format(
+        sys.executable, fake_x264, os.devnull)
+    pass_args = AttrDict(priority="normal", params={})
+    with open(os.devnull, "w") as log:
+        start = perf_counter()
+        cpu_start = process_time()
+        return_code, result = run_pass(pass_args, cmdline, log,
+                                       lambda *a, **kwargs: None)
+        secs = perf_counter() - start
+        cpu_secs = process_time() - cpu_start
+
+    if return_code or not result or result["frames"] != frames:
+        print("The fake x264 failed:", return_code, result)
+        return 1
+
+    ret = {
+        "frames": frames,
+        "secs": round(secs, 3),
+        "frames_per_sec": round(frames / secs),
+        "runner_cpu_secs": round(cpu_secs, 3),
+        "runner_cpu_us_per_frame": round(cpu_secs * 1000000 / frames, 2),
+    }
+    print_results(ret)
+    return ret
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def bench_scheduler(args):
+    """scheduler [tasks]
+
+    Queues [tasks] (default 10000) 1pass/2pass task pairs that exit as soon
+    as they are launched, and measures the time from a task's exit event
+    to the launch of the next one."""
+    count = int(args and args[0] or 10000)
+    tasks = []
+    for i in range(count):
+        t = task_module.Task(["bench", str(i)], slot=1 + i % 2)
+        if i % 2:
+            t.depends = [tasks[-1].id]
+
+        tasks.append(t)
+
+    exits = []
+    latencies = []
+    def launch(scheduler, runner):
+        now = perf_counter()
+        if exits:
+            latencies.append(now - exits.pop(0))
+
+        exits.append(perf_counter())
+        scheduler.post("exit", runner, 0)
+
+    start = perf_counter()
+    scheduler = Scheduler(tasks, 2, launch, refresh_rate=3600,
+                          critical_path=True)
+    build_secs = perf_counter() - start
+    start = perf_counter()
+    scheduler.run()
+    secs = perf_counter() - start
+    task_module.dirty_tasks.clear()
+
+    ret = {
+        "tasks": count,
+        "build_secs": round(build_secs, 4),
+        "run_secs": round(secs, 3),
+        "tasks_per_sec": round(count / secs),
+        "latency_mean_us": round(sum(latencies) * 1000000 / len(latencies),
+                                 1),
+        "latency_p50_us": round(percentile(latencies, 0.5) * 1000000, 1),
+        "latency_p99_us": round(percentile(latencies, 0.99) * 1000000, 1),
+        "latency_max_us": round(max(latencies) * 1000000, 1),
+    }
+    print_results(ret)
+    return ret
+
+def bench_save(args):
+    """save [tasks] [rounds]
+
+    Cost of task_save() with [tasks] (default 10000) tasks in the database:
+    the first save, saving a single state change, and a compaction."""
+    count = int(args and args[0] or 10000)
+    rounds = int(len(args) > 1 and args[1] or 1000)
+    tmp_dir = tempfile.mkdtemp(prefix="encx264_bench")
+    old_tasks, old_store = task_module.tasks, task_module.task_store
+    try:
+        task_module.task_load(os.path.join(tmp_dir, "tasks"))
+        for i in range(count):
+            task_module.task_add_internal(
+                ["--1pass-only", "mkv_720p", "in{0}.avs".format(i),
+                 "out{0}.mp4".format(i), "20", "--tc", ""],
+                1 + i % 2, target="mkv_720p")
+
+        start = perf_counter()
+        task_module.task_save()
+        first_secs = perf_counter() - start
+
+        start = perf_counter()
+        for i in range(rounds):
+            t = task_module.tasks[i % count]
+            t.set_state(task_module.task_states.running)
+            task_module.task_save()
+
+        change_secs = (perf_counter() - start) / rounds
+
+        start = perf_counter()
+        task_module.task_store.compact(task_module.tasks)
+        compact_secs = perf_counter() - start
+    finally:
+        task_module.tasks, task_module.task_store = old_tasks, old_store
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    ret = {
+        "tasks": count,
+        "first_save_secs": round(first_secs, 4),
+        "change_save_us": round(change_secs * 1000000, 1),
+        "compact_secs": round(compact_secs, 4),
+    }
+    print_results(ret)
+    return ret
+
+class BenchTerminal:
+    """stdout replacement that looks like a terminal and only counts."""
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, s):
+        self.bytes += len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return True
+
+def bench_redraw(args):
+    """redraw [tasks] [running] [rounds]
+
+    Cost of a status redraw of the task runner: the first one, and one
+    where a single running task's progress changed."""
+    count = int(args and args[0] or 200)
+    running = int(len(args) > 1 and args[1] or 4)
+    rounds = int(len(args) > 2 and args[2] or 2000)
+    old_tasks, old_stdout = task_module.tasks, sys.stdout
+    task_module.tasks = [task_module.Task(["bench", str(i)], slot=1)
+                         for i in range(count)]
+    runners = []
+    for i in range(running):
+        task_module.tasks[i].set_state(task_module.task_states.running)
+        runners.append(Runner(task_module.tasks[i], str(i)))
+
+    terminal = BenchTerminal()
+    sys.stdout = terminal
+    try:
+        state = AttrDict()
+        start = perf_counter()
+        task_module.print_status(runners, state)
+        first_secs = perf_counter() - start
+        first_bytes = terminal.bytes
+
+        start = perf_counter()
+        for i in range(rounds):
+            runner = runners[i % running]
+            runner.msg = "[{0}] [{1:.1f}%] {1}/1000 frames".format(
+                runner.tag, i % 1000)
+            task_module.print_status(runners, state)
+
+        secs = (perf_counter() - start) / rounds
+    finally:
+        sys.stdout = old_stdout
+        task_module.tasks = old_tasks
+        task_module.dirty_tasks.clear()
+
+    ret = {
+        "tasks": count,
+        "running": running,
+        "first_redraw_ms": round(first_secs * 1000, 3),
+        "first_redraw_bytes": first_bytes,
+        "redraw_us": round(secs * 1000000, 1),
+        "redraw_bytes": round((terminal.bytes - first_bytes) / rounds),
+    }
+    print_results(ret)
+    return ret
+
+piper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "piper.py")
+
+# a 1080p 8 bit y4m frame, what a frameserver writes and x264 reads at once
+bench_frame_size = 1920 * 1080 * 3 // 2
+
+piper_producer = """
+import sys
+frame = bytes({0})
+out = sys.stdout.buffer
+for i in range({1}):
+    out.write(frame)
+"""
+
+piper_consumer = """
+import sys
+frame = bytearray({0})
+n = 0
+while True:
+    read = sys.stdin.buffer.readinto(frame)
+    if not read:
+        break
+    n += read
+print("bytes", n)
+"""
+
+def bench_piper(args):
+    """piper [megabytes]
+
+    Throughput of piper moving [megabytes] (default 4096) of 1080p frames
+    from a fake frameserver to a fake x264: a plain pipe as before and a
+    plain pipe enlarged to 1MB."""
+    frames = int(args and args[0] or 4096) * 1024 * 1024 // bench_frame_size
+    total = frames * bench_frame_size
+    producer = [sys.executable, "-c",
+                piper_producer.format(bench_frame_size, frames)]
+    consumer = [sys.executable, "-c", piper_consumer.format(bench_frame_size)]
+    modes = [("direct", []),
+             ("direct_1m", ["--pipe-size-kb", "1024"])]
+
+    ret = {"megabytes": total // (1024 * 1024)}
+    print("{0:<12}{1:>10}{2:>12}".format("mode", "seconds", "MB/s"))
+    for name, options in modes:
+        start = perf_counter()
+        p = subprocess.run([sys.executable, piper] + options + producer +
+                           ["----"] + consumer,
+                           stdout=subprocess.PIPE, universal_newlines=True)
+        secs = perf_counter() - start
+        if p.returncode or "bytes {0}".format(total) not in p.stdout:
+            print("piper failed in mode", name)
+            print(p.stdout)
+            return 1
+
+        mb_per_sec = total / (1024 * 1024) / secs
+        print("{0:<12}{1:>10.2f}{2:>12.0f}".format(name, secs, mb_per_sec))
+        ret[name + "_mb_per_sec"] = round(mb_per_sec)
+
+    return ret
+
+def print_results(results):
+    for k, v in sorted(results.items()):
+        print("{0:<28}{1:>14}".format(k, v))
+
+def bench_suite(args):
+    """suite
+
+    Runs parse, output, scheduler, save and redraw with their defaults."""
+    ret = {}
+    for name in ["parse", "output", "scheduler", "save", "redraw"]:
+        print("")
+        print("==", name)
+        result = benchmarks[name]([])
+        if not isinstance(result, dict):
+            return result
+
+        for k, v in result.items():
+            ret[name + "." + k] = v
+
+    return ret
+
+def write_results(name, args, results, json_file):
+    """Appends a record of the run to json_file (JSON lines), so results
+    of different builds can be compared."""
+    record = {
+        "time": datetime.now().isoformat(),
+        "bench": name,
+        "args": args,
+        "version": version,
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    with open(json_file, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+benchmarks = {
+    "threads": bench_threads,
+    "parse": bench_parse,
+    "output": bench_output,
+    "scheduler": bench_scheduler,
+    "save": bench_save,
+    "redraw": bench_redraw,
+    "piper": bench_piper,
+    "suite": bench_suite,
+}
+
+def bench_subcommand():
+    if len(sys.argv) < 3 or sys.argv[2] not in benchmarks:
+        print("Usage:")
+        for f in benchmarks.values():
+            print("!bench " + f.__doc__.splitlines()[0])
+
+        print("")
+        print("--json <file> appends the results to file as JSON lines")
+        return
+
+    args = sys.argv[3:]
+    json_file = None
+    if "--json" in args:
+        i = args.index("--json")
+        json_file = args[i + 1]
+        del args[i:i + 2]
+
+    results = benchmarks[sys.argv[2]](args)
+    if not isinstance(results, dict):
+        sys.exit(results)
+
+    if json_file:
+        write_results(sys.argv[2], args, results, json_file)
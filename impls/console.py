@@ -1,40 +1,20 @@
-from ctypes import windll, Structure, c_short, c_ushort, c_int, byref
+import os
 import sys
+from time import time
 
-SHORT = c_short
-WORD = c_ushort
-INT = c_int
-
-class COORD(Structure):
-    """struct in wincon.h."""
-    _fields_ = [
-      ("X", SHORT),
-      ("Y", SHORT)]
-
-class SMALL_RECT(Structure):
-    """struct in wincon.h."""
-    _fields_ = [
-      ("Left", SHORT),
-      ("Top", SHORT),
-      ("Right", SHORT),
-      ("Bottom", SHORT)]
-
-class CONSOLE_SCREEN_BUFFER_INFO(Structure):
-    """struct in wincon.h."""
-    _fields_ = [
-      ("dwSize", COORD),
-      ("dwCursorPosition", COORD),
-      ("wAttributes", WORD),
-      ("srWindow", SMALL_RECT),
-      ("dwMaximumWindowSize", COORD)]
-
-# winbase.h
-STD_INPUT_HANDLE = -10
-STD_OUTPUT_HANDLE = -11
-STD_ERROR_HANDLE = -12
-
-
-# wincon.h
+if os.name == "nt":
+    from .console_win import clear, set_title, set_cursor_position, \
+                             clear_line_remaining, get_text_color, \
+                             set_text_color
+else:
+    from .console_ansi import clear, set_title, set_cursor_position, \
+                              clear_line_remaining, get_text_color, \
+                              set_text_color
+
+__all__ = ["colors", "clear", "set_title", "get_text_color",
+           "set_text_color", "status_screen"]
+
+# wincon.h, the ANSI backend translates them
 class colors:
     FOREGROUND_BLACK     = 0x0000
     FOREGROUND_BLUE      = 0x0001
@@ -56,61 +36,79 @@ class colors:
     BACKGROUND_GREY      = 0x0070
     BACKGROUND_INTENSITY = 0x0080 # background color is intensified.
 
-stdout_handle = windll.kernel32.GetStdHandle(STD_OUTPUT_HANDLE)
-SetConsoleTextAttribute = windll.kernel32.SetConsoleTextAttribute
-GetConsoleScreenBufferInfo = windll.kernel32.GetConsoleScreenBufferInfo
-FillConsoleOutputCharacter = windll.kernel32.FillConsoleOutputCharacterW
-FillConsoleOutputAttribute = windll.kernel32.FillConsoleOutputAttribute
-SetConsoleCursorPosition = windll.kernel32.SetConsoleCursorPosition
-SetConsoleTitle = windll.kernel32.SetConsoleTitleW
-
-def clear():
-    csbi = CONSOLE_SCREEN_BUFFER_INFO()
-    GetConsoleScreenBufferInfo(stdout_handle, byref(csbi))
-    top_left = COORD(0, 0)
-    written = INT()
-    FillConsoleOutputCharacter(stdout_handle,
-                               0x20,
-                               csbi.dwSize.X * csbi.dwSize.Y,
-                               top_left,
-                               byref(written))
-    FillConsoleOutputAttribute(stdout_handle,
-                                colors.FOREGROUND_GREY,
-                                csbi.dwSize.X * csbi.dwSize.Y,
-                                top_left,
-                                byref(written))
-    SetConsoleCursorPosition(stdout_handle, top_left)
-
-def set_title(title):
-    SetConsoleTitle(title and str(title) or '')
-
-def get_cursor_position():
-    csbi = CONSOLE_SCREEN_BUFFER_INFO()
-    GetConsoleScreenBufferInfo(stdout_handle, byref(csbi))
-    return (csbi.dwCursorPosition.X, csbi.dwCursorPosition.Y)
-    
-def set_cursor_position(x, y):
-    sys.stdout.flush()
-    SetConsoleCursorPosition(stdout_handle, COORD(x, y))
-
-def clear_line_remaining():
-    sys.stdout.flush()
-    csbi = CONSOLE_SCREEN_BUFFER_INFO()
-    GetConsoleScreenBufferInfo(stdout_handle, byref(csbi))
-    print(" " * (csbi.dwSize.X - csbi.dwCursorPosition.X), end='')
-    sys.stdout.flush()
-  
-def get_text_color():
-    """Returns the character attributes (colors) of the console screen
-    buffer."""
-    csbi = CONSOLE_SCREEN_BUFFER_INFO()
-    GetConsoleScreenBufferInfo(stdout_handle, byref(csbi))
-    return csbi.wAttributes & 0xFF
-
-def set_text_color(color):
-    """Sets the character attributes (colors) of the console screen
-    buffer. Color is a combination of foreground and background color,
-    foreground and background intensity."""
-    sys.stdout.flush()
-    SetConsoleTextAttribute(stdout_handle, color)
+def row_text(row):
+    return ''.join([text for _, text in row])
+
+class StatusScreen:
+    """Status display for a console. Rows are lists of (color, text),
+    only the rows that differ from the last drawn ones are rewritten."""
+
+    def __init__(self):
+        self.rows = None
+        self.title = None
+
+    def draw(self, entries, progress, title):
+        """entries are groups of rows (one per task), progress the rows
+        of the running tasks."""
+        rows = [row for entry in entries for row in entry] + progress
+        if self.rows is None:
+            clear()
+            self.rows = []
+
+        old_color = get_text_color()
+        for y, row in enumerate(rows):
+            if y < len(self.rows) and self.rows[y] == row:
+                continue
+
+            set_cursor_position(0, y)
+            for color, text in row:
+                set_text_color(color)
+                print(text, end='')
+
+            clear_line_remaining()
+
+        for y in range(len(rows), len(self.rows)):
+            set_cursor_position(0, y)
+            clear_line_remaining()
+
+        set_text_color(old_color)
+        set_cursor_position(0, len(rows))
+        sys.stdout.flush()
+        self.rows = rows
+
+        if title != self.title:
+            set_title(title)
+            self.title = title
+
+class StatusStream:
+    """Status for a pipe or a file: appends the entries that changed
+    instead of redrawing, and the progress only every interval seconds."""
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.entries = []
+        self.last_progress = 0
+
+    def draw(self, entries, progress, title):
+        texts = ['\n'.join([row_text(row) for row in entry])
+                 for entry in entries]
+        for i, text in enumerate(texts):
+            if i >= len(self.entries) or self.entries[i] != text:
+                print(text)
+
+        self.entries = texts
+
+        if time() - self.last_progress >= self.interval:
+            self.last_progress = time()
+            for row in progress:
+                text = row_text(row)
+                if text.strip():
+                    print(text)
+
+        sys.stdout.flush()
+
+def status_screen():
+    if sys.stdout.isatty():
+        return StatusScreen()
 
+    return StatusStream()
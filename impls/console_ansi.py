@@ -0,0 +1,50 @@
+import sys
+
+# ANSI escape sequences for terminals other than the Windows console.
+# Colors use the Windows attribute bits (see console.colors), translated
+# to SGR codes here.
+
+# Windows bit order is blue, green, red, ANSI's is red, green, blue
+ansi_colors = [0, 4, 2, 6, 1, 5, 3, 7]
+
+current_color = 0x0007
+
+def is_tty():
+    return sys.stdout.isatty()
+
+def write(s):
+    if is_tty():
+        sys.stdout.write(s)
+
+def clear():
+    write("\x1b[2J\x1b[H")
+    sys.stdout.flush()
+
+def set_title(title):
+    write("\x1b]0;{0}\x07".format(title and str(title) or ''))
+    sys.stdout.flush()
+
+def set_cursor_position(x, y):
+    write("\x1b[{0};{1}H".format(y + 1, x + 1))
+
+def clear_line_remaining():
+    write("\x1b[K")
+    sys.stdout.flush()
+
+def get_text_color():
+    return current_color
+
+def set_text_color(color):
+    global current_color
+    current_color = color
+    codes = ["0"]
+    if color & 0x0F != 0x07:
+        # anything but the default grey
+        codes.append(str((color & 0x08 and 90 or 30) +
+                         ansi_colors[color & 0x07]))
+
+    if color & 0xF0:
+        codes.append(str((color & 0x80 and 100 or 40) +
+                         ansi_colors[(color >> 4) & 0x07]))
+
+    write("\x1b[{0}m".format(";".join(codes)))
@@ -0,0 +1,118 @@
+from heapq import heappush, heappop
+
+__all__ = ["task_depends", "find_cycle", "topological_order",
+           "downstream_lengths"]
+
+def task_depends(t):
+    """Ids of the tasks t waits for. Task files written before tasks could
+    have several parents store a single id."""
+    depends = t.get("depends")
+    if not depends:
+        return []
+
+    if isinstance(depends, str):
+        return [depends]
+
+    return list(depends)
+
+def task_children(tasks):
+    children = {}
+    for t in tasks:
+        for id in task_depends(t):
+            children.setdefault(id, []).append(t)
+
+    return children
+
+def find_cycle(tasks):
+    """Ids of a dependency cycle among tasks, in dependency order, or None.
+    Dependencies on tasks that aren't in the list are ignored."""
+    index = dict([(t.id, t) for t in tasks])
+    # 1: on the current path, 2: done
+    marks = {}
+    for root in tasks:
+        if root.id in marks:
+            continue
+
+        path = [root.id]
+        stack = [iter(task_depends(root))]
+        marks[root.id] = 1
+        while stack:
+            id = next(stack[-1], None)
+            if id is None:
+                marks[path.pop()] = 2
+                stack.pop()
+                continue
+
+            if id not in index:
+                continue
+
+            mark = marks.get(id)
+            if mark == 1:
+                cycle = path[path.index(id):]
+                cycle.reverse()
+                return cycle
+
+            if mark is None:
+                marks[id] = 1
+                path.append(id)
+                stack.append(iter(task_depends(index[id])))
+
+    return None
+
+def topological_order(tasks):
+    """tasks with every task after its parents, otherwise in list order.
+    Tasks in a cycle are left out."""
+    index = dict([(t.id, t) for t in tasks])
+    children = task_children(tasks)
+    position = dict([(t.id, i) for i, t in enumerate(tasks)])
+    pending = {}
+    ready = []
+    for t in tasks:
+        pending[t.id] = len([x for x in task_depends(t) if x in index])
+        if not pending[t.id]:
+            heappush(ready, position[t.id])
+
+    order = []
+    while ready:
+        t = tasks[heappop(ready)]
+        order.append(t)
+        for child in children.get(t.id, []):
+            pending[child.id] -= 1
+            if not pending[child.id]:
+                heappush(ready, position[child.id])
+
+    return order
+
+def downstream_lengths(tasks, weight):
+    """{id: (seconds, tasks)} of the longest chain starting at each task
+    and running through its dependents, weight(t) being the seconds of a
+    single task. The chain of a ready task is what's left of the critical
+    path through it. Tasks in a cycle are left out."""
+    # tasks are handled by position, looking up t.id is slow
+    ids = [t.id for t in tasks]
+    position = dict([(id, i) for i, id in enumerate(ids)])
+    parents = [[position[id] for id in task_depends(t) if id in position]
+               for t in tasks]
+    children = [[] for t in tasks]
+    for i, x in enumerate(parents):
+        for parent in x:
+            children[parent].append(i)
+
+    # dependents not measured yet, leaves first
+    pending = [len(x) for x in children]
+    todo = [i for i, x in enumerate(pending) if not x]
+    lengths = [None] * len(tasks)
+    while todo:
+        i = todo.pop()
+        secs, count = 0, 0
+        for child in children[i]:
+            secs = max(secs, lengths[child][0])
+            count = max(count, lengths[child][1])
+
+        lengths[i] = (secs + (weight(tasks[i]) or 0), count + 1)
+        for parent in parents[i]:
+            pending[parent] -= 1
+            if not pending[parent]:
+                todo.append(parent)
+
+    return dict([(ids[i], x) for i, x in enumerate(lengths) if x])
@@ -4,6 +4,112 @@
 x264_path = 'x264.exe'
 
 # possible values: idle, below_normal, normal, above_normal, high
+# targets can override it with "priority"
+# on Linux this sets the nice level and io priority of x264
 default_priority = 'below_normal'
 
+# Linux: run the x264s of every task (or encode) in a cgroup v2 group of
+# their own under this directory, with cpu.weight following the priority.
+# It must be a delegated cgroup the current user can write to. Targets can
+# set "cpu_weight" directly, and cap the cpu time of an encode with
+# "cpu_max": <number of cores>
+cgroup_root = None
+
+# write x264 progress lines to the .log file, at most one every
+# log_progress_interval seconds and/or log_progress_step percent
+# (None means no limit)
 log_progress = False
+log_progress_interval = 30
+log_progress_step = None
+
+# record the progress of every pass as CSV in <output>.progress.csv,
+# sampled the same way as the log
+progress_track = False
+
+# reuse 1st pass results (bitrate, stats and mbtree) of 2pass encodes whose
+# output, input, x264 and 1st pass parameters haven't changed. Scripts are
+# hashed with the files and scripts they name, scripts that read the
+# environment or import python modules are never cached.
+# 0 (the default) disables the cache, e.g. 4096 enables it. None for the
+# cache dir means the temp directory
+pass1_cache_size_mb = 0
+pass1_cache_dir = None
+
+# give every task run by the task runner an explicit --threads budget
+# according to its slot, instead of letting each x264 use the whole machine.
+# Off by default, it rewrites the --threads of the targets
+task_thread_budget = False
+
+# pin each encode run by the task runner to its own set of cpus (Linux):
+#   None: no pinning
+#   "spread": take free cpus from all NUMA nodes
+#   "node": keep the encode on a single NUMA node
+# targets can override it with "cpu_placement", and limit the nodes they
+# may use with "cpu_nodes": [0, 1, ...]
+cpu_placement = None
+
+# serve the task runner's status as JSON over HTTP, "[host:]port".
+# Any host but a loopback one needs task_worker_token, which clients then
+# send as "Authorization: Bearer <token>" (or ?token= for /events). POSTs
+# must be sent as application/json
+task_status_http = None
+
+# shared secret workers must send to "!task serve" (ENCX264_WORKER_TOKEN in
+# the environment overrides it). Required when serve listens on anything
+# but a loopback address, the workers' port can add tasks of its own
+task_worker_token = None
+
+# per pass metrics: wall and cpu time, peak memory, frames, fps, bitrate
+# and output size. Every pass is appended to metrics_jsonl, metrics_prom
+# keeps totals per target and pass in Prometheus text format (point
+# node_exporter's textfile collector at it)
+metrics_jsonl = None
+metrics_prom = None
+
+# throughput of finished passes, used to predict how long queued tasks
+# take. None keeps it in the temp directory, "" disables it
+history_file = None
+
+# order of waiting tasks of the same priority in the task runner:
+#   "fifo": the order they were added in ("queue" works too)
+#   "critical_path": longest chain of dependent tasks first (a 1st pass
+#                    counts with its 2nd pass, encodes with the commands
+#                    waiting for them), measured by predicted time where
+#                    the history knows it, so a long chain isn't left
+#                    running alone at the end
+task_order = "fifo"
+
+# besides the slots, the task runner only starts a task if its estimated
+# memory fits into task_memory_limit_mb, counting the running tasks. The
+# estimate follows the resolution, --ref, --bframes, --rc-lookahead,
+# threads and bit depth, and is corrected by the peak memory of earlier
+# runs of the target. 0 (the default) means no limit, None 80% of the
+# physical memory.
+# task_io_limit_mbps limits the combined read rate (input size over
+# predicted duration) of encodes whose input isn't a script, 0 for none
+task_memory_limit_mb = 0
+task_io_limit_mbps = 0
+
+# decodes an input to y4m on stdout for group tasks ("!task add_group"),
+# which encode several targets from a single run of the filters, and for
+# --frame-cache, e.g.
+#   'vspipe --y4m "{inFile}" -'
+#   'avs2yuv "{inFile}" -o -'
+#   'ffmpeg -loglevel error -i "{inFile}" -f yuv4mpegpipe -'
+frameserver_cmd = None
+# buffer between the frameserver and each x264 of a group
+group_buffer_mb = 64
+# seconds the members of a group that are ready for a pass wait for the
+# others, then the frameserver runs for those that are ready and the rest
+# get a round of their own. None waits forever
+group_join_timeout = 600
+
+# --frame-cache: the 1st pass of a 2pass encode reads the output of
+# frameserver_cmd, which is also written to frame_cache_dir (None for the
+# temp directory), and the 2nd pass reads that file instead of running the
+# filters again. Decoded frames are big (3MB per 1080p frame), a capture
+# is given up once the directory would grow past frame_cache_size_mb.
+# frame_cache_compress: "" (none, for fast disks), "zlib" or "lzma"
+frame_cache_dir = None
+frame_cache_size_mb = 64 * 1024
+frame_cache_compress = ""
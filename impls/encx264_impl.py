@@ -3,8 +3,25 @@ import os
 from datetime import datetime
 import re
 import subprocess
+import tempfile
 import sys
-from .utils import gen_cmd_line, AttrDict
+from threading import Lock
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from .utils import gen_cmd_line, AttrDict, split_cmd_line
+from .priority import priority_levels, process_args, create_cgroup, \
+                      remove_cgroup
+from .segments import segment_ranges, read_keyframes, find_cmdline_arg, \
+                      rewrite_segment_cmdline, join_segments, segment_file, \
+                      sample_ranges
+from .passcache import Pass1Cache
+from .framecache import FrameCache, compressors
+from .progress_log import ProgressSampler, ProgressTrack
+from .metrics import PassUsage, write_metrics
+from .version import version
+from .history import History, x264_build
+from .x264_output import X264OutputParser, parse_line, event_types, \
+                         read_output
 
 
 __all__ = ["encode", "parse_encode_result_line"]
@@ -18,15 +35,10 @@ except ImportError:
     print("Please create one from encx264_targets.py.sample.")
     sys.exit(1)
 
-priority_values = {
-    "idle": 0x40,
-    "below_normal": 0x4000,
-    "normal": 0x20,
-    "above_normal": 0x8000,
-    "high": 0x80,
-}
+def check_return_code(p, usage=None):
+    if usage:
+        usage.wait(p)
 
-def check_return_code(p):
     p.communicate()
     if p.returncode != 0:
         print("x264 exited with return code", p.returncode)
@@ -58,6 +70,18 @@ def parse_args(args=None):
     parser.add_option("--priority")
     parser.add_option("--no-assoc-files", dest="assoc_files", 
                       action="store_false", default=True)
+    parser.add_option("--segments", type="int", default=0)
+    parser.add_option("--segment-workers", type="int", default=0,
+                      dest="segment_workers")
+    parser.add_option("--total-frames", type="int", default=0,
+                      dest="total_frames")
+    parser.add_option("--probe", type="int", default=0)
+    parser.add_option("--probe-frames", type="int", default=300,
+                      dest="probe_frames")
+    parser.add_option("--probe-verify", dest="probe_verify",
+                      action="store_true", default=False)
+    parser.add_option("--frame-cache", dest="frame_cache",
+                      action="store_true", default=False)
 
     args = [x.lower() if x.startswith("-") else x for x in args]
     (opt, extra_args) = parser.parse_args(args)
@@ -90,7 +114,7 @@ def find_assoc_file(
 
     working_dir = working_dir or ""
     if working_dir:
-        working_dir = working_dir.strip('"') + "\\"
+        working_dir = os.path.join(working_dir.strip('"'), "")
 
     for f in formats:
         file_name = f.format(prefix.strip('"'), working_dir=working_dir)
@@ -172,6 +196,11 @@ def get_params(raw_args=None, print=print, working_dir=None):
     if not outFile:
         outFile = os.path.splitext(inFile)[0] + ".mp4"
 
+    if opt.segments > 1 and \
+       os.path.splitext(outFile)[1].lower() not in (".264", ".h264"):
+        print("Segment mode requires a raw .264 output file!")
+        return None
+
     inFile_2pass = opt.inFile_2pass or inFile 
 
     if working_dir:
@@ -230,14 +259,14 @@ def get_params(raw_args=None, print=print, working_dir=None):
 
     statsFile = outFile + ".x264_stats"
 
-    priority = opt.priority or default_priority
+    priority = opt.priority or params.get("priority", default_priority)
     priority = priority.lower()
 
-    if priority not in priority_values:
+    if priority not in priority_levels:
         print("Invalid priority:", priority)
         return None
 
-    priority_value = priority_values[priority]
+    nullDevice = os.devnull
 
     x264_exec = "x264_path" in params and params["x264_path"] or x264_path
 
@@ -284,17 +313,14 @@ def get_params(raw_args=None, print=print, working_dir=None):
     return ret
 
 def parse_encode_result_line(line):
-    pat = r"\s*encoded \d+ frames.*"
-    m = re.match(pat, line)
-    if not m:
+    event = parse_line(line)
+    if event.type != event_types.summary:
         return None
 
-    fps = re.search(r"([\d\.]+)\s*fps", line).group(1)
-    bitrate = re.search(r"([\d\.]+)\s*kb/s", line).group(1)
-
     return {
-        "fps": float(fps),
-        "bitrate": int(float(bitrate)),
+        "fps": event.fps,
+        "bitrate": int(event.kbps),
+        "frames": event.frames,
     }
 
 def extra_args_for_1pass(args):
@@ -305,15 +331,498 @@ def extra_args_for_1pass(args):
 
     return args
 
+def pass1_cmdline(args):
+    # format 2 times to substitute parameters in target
+    return ('{x264_exec} {params[common_pre]} {common_params} {common_params_pass1} ' + \
+            '{params[common]} {params[pass1]} ' + \
+            '{extra_args_1pass} "{inFile}"') \
+           .format(**args).format(**args)
+
+def pass2_cmdline(args):
+    return ('{x264_exec} {params[common_pre]} {common_params} {common_params_pass2} ' + \
+            '{params[common]} {params[pass2]} ' + \
+            '{extra_args} "{inFile_2pass}"') \
+           .format(**args).format(**args)
+
+def spawn_args(args):
+    return process_args(args.priority,
+                        args.get("cgroup"),
+                        args.params.get("cpu_weight"),
+                        args.params.get("cpu_max"))
+
+def run_pass(args,
+             cmdline,
+             log,
+             print=print,
+             working_dir=None,
+             Popen=subprocess.Popen,
+             on_progress=None,
+             procs=None,
+             segment=None):
+    p =  Popen(split_cmd_line(cmdline),
+              stdout = subprocess.PIPE,
+              stderr = subprocess.STDOUT,
+              cwd = working_dir,
+              **spawn_args(args))
+
+    if procs is not None:
+        procs.append(p)
+
+    parser = X264OutputParser()
+    on_event = args.get("on_event")
+    if on_event and on_progress:
+        # segments, the caller reports the combined progress
+        parser.subscribe(lambda event:
+                         event.type == event_types.progress or on_event(event))
+    elif on_event:
+        parser.subscribe(on_event)
+
+    track = args.get("progress_track")
+    log_sampler = ProgressSampler(log_progress_interval, log_progress_step)
+    track_sampler = ProgressSampler(log_progress_interval, log_progress_step)
+    try:
+        for l in read_output(p.stdout):
+            event = parser.feed(l)
+            if event.type == event_types.progress:
+                if log_progress and log_sampler.due(event):
+                    log.write(l + "\n")
+
+                if track and track_sampler.due(event):
+                    track.write(event, segment)
+
+                if on_progress:
+                    on_progress(event)
+                else:
+                    print(event.line.ljust(78),end='\r')
+            else:
+                log.write(l + "\n")
+                print(l)
+    except:
+        p.kill()
+        raise
+
+    return check_return_code(p, args.get("usage")), parser.result()
+
+def probe_total_frames(args, working_dir=None, Popen=subprocess.Popen):
+    """Starts the first pass and kills it as soon as x264 reports the
+    frame count of the input."""
+    probe_args = AttrDict(args)
+    probe_args.outFile = args.outFile + ".probe"
+    probe_args.statsFile = probe_args.outFile + ".x264_stats"
+
+    p = Popen(split_cmd_line(pass1_cmdline(probe_args)),
+              stdout = subprocess.PIPE,
+              stderr = subprocess.STDOUT,
+              cwd = working_dir,
+              **spawn_args(args))
+
+    total = None
+    try:
+        for l in read_output(p.stdout):
+            event = parse_line(l)
+            if event.type == event_types.progress and event.total:
+                total = event.total
+                break
+    finally:
+        if p.poll() is None:
+            p.kill()
+
+        p.communicate()
+        for f in [probe_args.outFile,
+                  probe_args.statsFile,
+                  probe_args.statsFile + ".temp",
+                  probe_args.statsFile + ".mbtree",
+                  probe_args.statsFile + ".mbtree.temp"]:
+            if os.path.isfile(f):
+                os.remove(f)
+
+    return total
+
+def plan_segments(args, print=print, working_dir=None, Popen=subprocess.Popen):
+    total_frames = args.opt.total_frames or \
+                   probe_total_frames(args, working_dir, Popen)
+    if not total_frames:
+        print("Can't detect frame count of the input, " +
+              "please specify it with --total-frames")
+        return None
+
+    cmdline = pass1_cmdline(args)
+    keyframes = None
+    qpfile = find_cmdline_arg(cmdline, "--qpfile")
+    if qpfile:
+        keyframes = read_keyframes(os.path.join(working_dir or "", qpfile))
+
+    keyint = find_cmdline_arg(cmdline, "--keyint")
+    keyint = keyint and keyint.isdigit() and int(keyint) or None
+
+    return segment_ranges(total_frames, args.opt.segments, keyframes, keyint)
+
+class SegmentLog:
+    def __init__(self, log, lock, tag):
+        self.log = log
+        self.lock = lock
+        self.tag = tag
+
+    def write(self, s):
+        with self.lock:
+            self.log.write(self.tag + s)
+
+class SegmentProgress:
+    def __init__(self, segments, print=print, on_event=None):
+        self.print = print
+        self.on_event = on_event
+        self.lock = Lock()
+        self.total = sum([frames for _, frames in segments])
+        self.done = [0] * len(segments)
+        self.fps = [0.0] * len(segments)
+        self.completed = 0
+
+    def update(self, index, event):
+        with self.lock:
+            self.done[index] = event.frames
+            self.fps[index] = event.fps
+            self.print_status()
+
+    def finish(self, index, frames):
+        with self.lock:
+            self.done[index] = frames
+            self.fps[index] = 0.0
+            self.completed += 1
+            self.print_status()
+
+    def print_status(self):
+        done = sum(self.done)
+        line = "[{0:.1f}%] {1}/{2} frames, {3:.2f} fps, {4}/{5} segments" \
+               .format(done * 100.0 / self.total, done, self.total,
+                       sum(self.fps), self.completed, len(self.done))
+        self.print(line.ljust(78), end='\r')
+        if self.on_event:
+            self.on_event(parse_line(line))
+
+def segment_args(args, index, start, frames):
+    seg_args = AttrDict(args)
+    seg_args.outFile = segment_file(args.outFile, index)
+    seg_args.statsFile = seg_args.outFile + ".x264_stats"
+    seek = " --seek {0} --frames {1}".format(start, frames)
+    seg_args.extra_args = args.extra_args + seek
+    seg_args.extra_args_1pass = args.extra_args_1pass + seek
+    return seg_args
+
+def kill_all(procs):
+    for p in list(procs):
+        try:
+            if p.poll() is None:
+                p.kill()
+        except Exception:
+            pass
+
+def run_segments(args,
+                 segments,
+                 make_cmdline,
+                 log,
+                 print=print,
+                 working_dir=None,
+                 Popen=subprocess.Popen,
+                 bitrates=None):
+    log_lock = Lock()
+    progress = SegmentProgress(segments, print, args.get("on_event"))
+    procs = []
+    failed = []
+
+    def run(index):
+        if failed:
+            return 1, None
+
+        start, frames = segments[index]
+        seg_args = segment_args(args, index, start, frames)
+        if bitrates:
+            seg_args.bitrate = bitrates[index]
+
+        cmdline = rewrite_segment_cmdline(make_cmdline(seg_args),
+                                          seg_args.outFile, start, frames,
+                                          working_dir)
+        seg_log = SegmentLog(log, log_lock, "[segment {0}/{1}] "
+                             .format(index + 1, len(segments)))
+        seg_log.write("Command line: " + cmdline + "\n")
+        try:
+            return_code, result = run_pass(
+                seg_args, cmdline, seg_log, print, working_dir, Popen,
+                on_progress=lambda event: progress.update(index, event),
+                procs=procs, segment=index)
+        except:
+            failed.append(index)
+            raise
+
+        if return_code:
+            failed.append(index)
+            kill_all(procs)
+        else:
+            progress.finish(index, frames)
+
+        return return_code, result
+
+    workers = args.opt.segment_workers or len(segments)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(run, i) for i in range(len(segments))]
+    try:
+        for f in futures:
+            f.result()
+    except BaseException:
+        failed.append(None)
+        kill_all(procs)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        if failed:
+            kill_all(procs)
+
+    results = [f.result() for f in futures]
+    for return_code, _ in results:
+        if return_code:
+            return return_code, None
+
+    return 0, [result for _, result in results]
+
+def summarize_segments(segments, results, elapsed):
+    total = sum([frames for _, frames in segments])
+    kbps = sum([(r and r["bitrate"] or 0) * frames
+                for (_, frames), r in zip(segments, results)]) / total
+    fps = total / max(elapsed.total_seconds(), 0.001)
+    return "encoded {0} frames, {1:.2f} fps, {2:.2f} kb/s" \
+           .format(total, fps, kbps)
+
+def segment_files(args, segments):
+    return [segment_file(args.outFile, i) for i in range(len(segments))]
+
+def read_segment_bitrates(args, segments):
+    bitrates = []
+    for name in segment_files(args, segments):
+        if not os.path.isfile(name + ".bitrate.txt"):
+            return None
+
+        with open(name + ".bitrate.txt", "r") as f:
+            bitrates.append(int(f.read().strip()))
+
+    return bitrates
+
+def probe_bitrate(args,
+                  log,
+                  print=print,
+                  working_dir=None,
+                  Popen=subprocess.Popen,
+                  threads=None):
+    """Encodes --probe short samples of the input with the first pass
+    settings in parallel, returns (return code, estimated kb/s)."""
+    total_frames = args.opt.total_frames or \
+                   probe_total_frames(args, working_dir, Popen)
+    if not total_frames:
+        print("Can't detect frame count of the input, " +
+              "please specify it with --total-frames")
+        return 1, None
+
+    samples = sample_ranges(total_frames, args.opt.probe,
+                            args.opt.probe_frames)
+    if not samples:
+        print("The samples would cover the whole input, " +
+              "running a full 1st pass instead")
+        return 0, None
+
+    probe_args = AttrDict(args)
+    probe_args.outFile = os.path.splitext(args.outFile)[0] + ".probe.264"
+    if threads:
+        workers = min(args.opt.segment_workers or len(samples), len(samples))
+        probe_args.extra_args_1pass += thread_args(max(1, threads // workers))
+
+    msg = "Probing bitrate with {0} samples of {1} frames".format(
+        len(samples), args.opt.probe_frames)
+    print(msg, file=log)
+    print(msg)
+    log.flush()
+    set_track_pass(args, "probe")
+    start = datetime.now()
+    try:
+        return_code, results = run_segments(
+            probe_args, samples, pass1_cmdline, log, print, working_dir, Popen)
+    finally:
+        for name in segment_files(probe_args, samples):
+            for f in [name, name + ".qpfile", name + ".x264_stats",
+                      name + ".x264_stats.mbtree"]:
+                if os.path.isfile(f):
+                    os.remove(f)
+
+    if return_code:
+        return return_code, None
+
+    summary = summarize_segments(samples, results, datetime.now() - start)
+    estimate = parse_encode_result_line(summary)["bitrate"]
+    msg = "Estimated bitrate: {0} kb/s ({1})".format(estimate, summary)
+    print("")
+    print(msg, file=log)
+    print(msg)
+    print("")
+    return 0, estimate
+
+def fast_pass1_cmdline(args, bitrate):
+    """First pass that only has to produce the stats for pass 2: turbo
+    settings at the target bitrate instead of a slow crf pass. A
+    --slow-firstpass given on the command line is kept."""
+    fast_args = AttrDict(args)
+    fast_args.extra_args_1pass += " --bitrate {0}".format(bitrate)
+    cmdline = pass1_cmdline(fast_args)
+    if re.search(r"(^|\s)--slow-firstpass\b", args.extra_args_1pass):
+        return cmdline
+
+    return re.sub(r"\s--slow-firstpass\b", "", cmdline)
+
+def thread_args(threads):
+    return " --threads {0} --lookahead-threads {1}" \
+           .format(threads, max(1, threads // 6))
+
+history = None
+if history_file != "":
+    history = History(history_file or
+                      os.path.join(tempfile.gettempdir(), ".encx264_history"))
+
+def record_pass(args, name, return_code, result, working_dir=None,
+                on_metrics=None, **fields):
+    """Writes the metrics of the pass that just finished, see metrics_jsonl
+    in encx264_defaults.py, and adds it to the history."""
+    if not metrics_jsonl and not metrics_prom and not on_metrics and \
+       not history:
+        return
+
+    output_bytes = None
+    out_name = os.path.join(working_dir or "", args.outFile)
+    if not return_code and (name == "2" or "pass2" not in args.params) and \
+       os.path.isfile(out_name):
+        output_bytes = os.path.getsize(out_name)
+
+    result = result or {}
+    if result.get("piper"):
+        # where the pipe waited, see piper --stats
+        fields["piper"] = result["piper"]
+
+    if fields.get("segments"):
+        fields["segment_workers"] = min(
+            args.opt.segment_workers or fields["segments"],
+            fields["segments"])
+
+    record = args.usage.record(
+        target=args.target,
+        output=os.path.abspath(out_name),
+        return_code=return_code or 0,
+        frames=result.get("frames"),
+        fps=result.get("fps"),
+        bitrate=result.get("bitrate"),
+        resolution=result.get("resolution"),
+        output_bytes=output_bytes,
+        input=os.path.abspath(os.path.join(working_dir or "", args.inFile)),
+        x264=x264_build(args.x264_exec.strip('"')),
+        version=version,
+        **fields)
+    record["pass"] = name
+    write_metrics(record, metrics_jsonl, metrics_prom)
+    if history:
+        history.add(record)
+    if on_metrics:
+        on_metrics(record)
+
+@contextmanager
+def open_progress_track(args):
+    if not progress_track:
+        yield None
+        return
+
+    track = ProgressTrack(args.outFile + ".progress.csv", args.append_log)
+    try:
+        yield track
+    finally:
+        track.close()
+
+def check_frame_cache(args, print):
+    """Whether --frame-cache can be used, tells why not."""
+    if "pass2" not in args.params:
+        print("--frame-cache can only be used with 2pass targets")
+    elif args.opt.segments > 1:
+        print("--frame-cache can't be used together with --segments")
+    elif os.path.abspath(args.inFile_2pass) != os.path.abspath(args.inFile):
+        print("--frame-cache can't be used together with --infile-2pass")
+    elif not frameserver_cmd:
+        print("--frame-cache needs frameserver_cmd, see encx264_defaults.py")
+    elif frame_cache_compress not in compressors:
+        print("Invalid frame_cache_compress:", frame_cache_compress)
+    else:
+        return True
+
+    return False
+
+@contextmanager
+def open_frame_cache(args, print, working_dir, Popen):
+    if not args.opt.frame_cache:
+        yield None
+        return
+
+    cache = FrameCache(frameserver_cmd.format(inFile=args.inFile),
+                       args.inFile, args.outFile, print, working_dir,
+                       frame_cache_dir, frame_cache_size_mb * 1024 * 1024,
+                       frame_cache_compress, Popen,
+                       group_buffer_mb * 1024 * 1024)
+    try:
+        yield cache
+    finally:
+        cache.close()
+
+def set_track_pass(args, name):
+    if args.progress_track:
+        args.progress_track.flush()
+        args.progress_track.current_pass = name
+
 def encode_impl(raw_args=None,
                 print=print,
                 working_dir=None,
-                Popen=subprocess.Popen):
+                Popen=subprocess.Popen,
+                threads=None,
+                on_event=None,
+                on_metrics=None,
+                cgroup=None):
     args = get_params(raw_args, print, working_dir)
 
     if not args:
         return 1
 
+    # receives the parsed x264 output, see x264_output.py
+    args.on_event = on_event
+    args.cgroup = cgroup
+
+    if args.opt.probe and "pass2" not in args.params:
+        print("--probe can only be used with 2pass targets")
+        return 1
+
+    if args.opt.probe and args.opt.segments > 1:
+        print("--probe can't be used together with --segments")
+        return 1
+
+    if args.opt.frame_cache and not check_frame_cache(args, print):
+        return 1
+
+    segments = None
+    seg_bitrates = None
+    if args.opt.segments > 1:
+        segments = plan_segments(args, print, working_dir, Popen)
+        if not segments:
+            return 1
+
+    budget = threads
+    if threads:
+        if segments:
+            workers = min(args.opt.segment_workers or len(segments),
+                          len(segments))
+            threads = max(1, threads // workers)
+
+        # appended after "--threads auto" of common_params, so they win
+        args.extra_args += thread_args(threads)
+        args.extra_args_1pass += thread_args(threads)
+
     start = pass1time = datetime.now()
 
     print("")
@@ -321,58 +830,138 @@ def encode_impl(raw_args=None,
     print("Current time: " + str(start))
     print("")
 
-    with open(args.outFile + ".log",
-              args.append_log and "a" or "w",
-              buffering=1) as log:
+    # block buffered, flushed at the start and the end of every pass
+    with open(args.outFile + ".log", args.append_log and "a" or "w") as log, \
+         open_progress_track(args) as track, \
+         open_frame_cache(args, print, working_dir, Popen) as frame_cache:
+        args.progress_track = track
+        if segments:
+            msg = "Segment mode: {0} segments, {1} workers: {2}".format(
+                len(segments),
+                args.opt.segment_workers or len(segments),
+                ' '.join(["{0}+{1}".format(*x) for x in segments]))
+            print(msg, file=log)
+            print(msg)
+            print("")
+
         if args.passN <= 1:
             if os.path.isfile(args.statsFile):
                 os.remove(args.statsFile)
-                
-            cmdline = ('{x264_exec} {params[common_pre]} {common_params} {common_params_pass1} ' + \
-                       '{params[common]} {params[pass1]} ' + \
-                       '{extra_args_1pass} "{inFile}"') \
-                      .format(**args).format(**args)
-            # format 2 times to substitute parameters in target
-
-            print("First pass command line:", cmdline, file=log)
+
+            args.usage = PassUsage()
+
+            estimate = None
+            if args.opt.probe and args.bitrate == -1:
+                return_code, estimate = probe_bitrate(
+                    args, log, print, working_dir, Popen, budget)
+                if return_code:
+                    return return_code
+
+            cmdline = pass1_cmdline(args)
+            if estimate and not args.opt.probe_verify:
+                cmdline = fast_pass1_cmdline(
+                    args, int(estimate * args.opt.bitrate_ratio))
+
+            cache = None
+            cached = None
+            if pass1_cache_size_mb and "pass2" in args.params and \
+               not segments and not estimate and args.bitrate == -1:
+                cache = Pass1Cache(pass1_cache_dir,
+                                   pass1_cache_size_mb * 1024 * 1024)
+                cache_key = cache.key(args, cmdline, working_dir)
+                if cache_key:
+                    cached = cache.fetch(cache_key, args.statsFile)
+                else:
+                    print("Warning: Not using the 1st pass cache,",
+                          cache.unhashable)
+                    cache = None
+
+            # x264 reads the frames the cache captures from stdin
+            shown = frame_cache and cached is None and \
+                    frame_cache.piped_cmdline(cmdline) or cmdline
+            print("First pass command line:", shown, file=log)
             print("", file=log)
-            print("First pass command line:", cmdline)
+            log.flush()
+            set_track_pass(args, "1")
+            print("First pass command line:", shown)
             print("")
 
-            p =  Popen(cmdline,
-                      stdout = subprocess.PIPE,
-                      stderr = subprocess.STDOUT,
-                      cwd = working_dir,
-                      creationflags = args.priority_value,
-                      universal_newlines = True)
-
-            try:
-                for l in p.stdout:
-                    if l.startswith("["):
-                        if log_progress:
-                            log.write(l)
-                            
-                        print(l.strip().ljust(78),end='\r')
-                    else:
-                        log.write(l)
-                        print(l,end='')
-                        if args.bitrate == -1:
-                            m = parse_encode_result_line(l)
-                            if m:
-                                args.bitrate = m["bitrate"]
-                                with open(args.outFile + ".bitrate.txt","w") \
-                                     as f:
-                                    f.write(str(args.bitrate))
-            except:
-                p.kill()
-                raise
-
+            if cached is not None:
+                msg = "Reusing cached 1st pass result: {0} kb/s".format(cached)
+                print(msg, file=log)
+                print(msg)
+                return_code, result = 0, {"bitrate": cached}
+            elif segments:
+                return_code, results = run_segments(
+                    args, segments, pass1_cmdline, log, print,
+                    working_dir, Popen)
+                result = None
+                if not return_code:
+                    summary = summarize_segments(segments, results,
+                                                 datetime.now() - start)
+                    log.write(summary + "\n")
+                    print("")
+                    print(summary)
+                    if on_event:
+                        on_event(parse_line(summary))
+
+                    result = parse_encode_result_line(summary)
+                    result["resolution"] = results[0] and \
+                                           results[0].get("resolution")
+                    seg_bitrates = [r and r["bitrate"] or 0 for r in results]
+                    for name, bitrate in zip(segment_files(args, segments),
+                                             seg_bitrates):
+                        with open(name + ".bitrate.txt", "w") as f:
+                            f.write(str(bitrate))
+            else:
+                return_code, result = run_pass(
+                    args, cmdline, log, print, working_dir,
+                    frame_cache and frame_cache.capture_popen(Popen) or Popen)
+                if cache and not return_code and result:
+                    cache.store(cache_key, args.statsFile, result["bitrate"])
+
+            if estimate and result and args.opt.probe_verify:
+                msg = "Probe estimate: {0} kb/s, 1st pass: {1} kb/s, " \
+                      "error: {2:+.1f}%".format(
+                          estimate, result["bitrate"],
+                          (estimate - result["bitrate"]) * 100.0 /
+                          max(result["bitrate"], 1))
+                print(msg, file=log)
+                print("")
+                print(msg)
+            elif estimate and not return_code:
+                # pass 2 gets the estimate, not what the fast pass hit,
+                # the metrics keep what it hit
+                args.bitrate = estimate
+                with open(args.outFile + ".bitrate.txt","w") as f:
+                    f.write(str(args.bitrate))
+
+            record_pass(args, "1", return_code, result, working_dir,
+                        on_metrics, cached=cached is not None,
+                        segments=segments and len(segments) or None,
+                        probe_bitrate=estimate)
+
+            if args.bitrate == -1 and result:
+                args.bitrate = result["bitrate"]
+                with open(args.outFile + ".bitrate.txt","w") as f:
+                    f.write(str(args.bitrate))
+
+            log.flush()
             print("")
             print("")
-            return_code = check_return_code(p)
             if return_code:
                 return return_code
 
+            if frame_cache:
+                # let the capture finish writing, closing the cache on the
+                # --1pass-only return would cut it short
+                frame_cache.wait()
+
+            if segments and "pass2" not in args.params:
+                seg_files = segment_files(args, segments)
+                if all([os.path.isfile(x) for x in seg_files]):
+                    join_segments(seg_files, args.outFile)
+
             pass1time = datetime.now()
             print("1st pass completed.")
             print("Current time: " + str(pass1time))
@@ -398,44 +987,71 @@ def encode_impl(raw_args=None,
                     return 1
 
             args.bitrate = int(args.bitrate * args.opt.bitrate_ratio)
+
+            if segments and args.opt.bitrate == -1:
+                # keep the bitrate distribution of the crf pass
+                seg_bitrates = seg_bitrates or \
+                               read_segment_bitrates(args, segments)
+                if seg_bitrates:
+                    seg_bitrates = [int(x * args.opt.bitrate_ratio)
+                                    for x in seg_bitrates]
             
-            cmdline = ('{x264_exec} {params[common_pre]} {common_params} {common_params_pass2} ' + \
-                       '{params[common]} {params[pass2]} ' + \
-                       '{extra_args} "{inFile_2pass}"') \
-                      .format(**args).format(**args)
+            cmdline = pass2_cmdline(args)
+            pass2_popen = not segments and frame_cache and \
+                          frame_cache.replay_popen(Popen)
+            shown = pass2_popen and frame_cache.piped_cmdline(cmdline) or \
+                    cmdline
 
-            print("Second pass command line:", cmdline, file=log)
+            print("Second pass command line:", shown, file=log)
             print("", file=log)
-            print("Second pass command line:", cmdline)
+            log.flush()
+            set_track_pass(args, "2")
+            args.usage = PassUsage()
+            print("Second pass command line:", shown)
             print("")
 
-            
-            p =  Popen(cmdline,
-                      stdout = subprocess.PIPE,
-                      stderr = subprocess.STDOUT,
-                      cwd = working_dir,
-                      creationflags = args.priority_value,
-                      universal_newlines = True)
-
-            try:
-                for l in p.stdout:
-                    if l.startswith("["):
-                        if log_progress:
-                            log.write(l)
-                        print(l.strip().ljust(78),end='\r')
-                    else:
-                        log.write(l)
-                        print(l,end='')
-            except:
-                p.kill()
-                raise
-
+            if segments:
+                return_code, results = run_segments(
+                    args, segments, pass2_cmdline, log, print,
+                    working_dir, Popen, bitrates=seg_bitrates)
+                result = None
+                if not return_code:
+                    join_segments(segment_files(args, segments),
+                                  args.outFile)
+                    summary = summarize_segments(segments, results,
+                                                 datetime.now() - pass1time)
+                    log.write(summary + "\n")
+                    print("")
+                    print(summary)
+                    if on_event:
+                        on_event(parse_line(summary))
+
+                    result = parse_encode_result_line(summary)
+                    result["resolution"] = results[0] and \
+                                           results[0].get("resolution")
+            else:
+                if pass2_popen:
+                    msg = "Reading the frames cached by the 1st pass"
+                    print(msg, file=log)
+                    print(msg)
+                    print("")
+
+                return_code, result = run_pass(args, cmdline, log, print,
+                                               working_dir,
+                                               pass2_popen or Popen)
+
+            record_pass(args, "2", return_code, result, working_dir,
+                        on_metrics,
+                        segments=segments and len(segments) or None)
+            log.flush()
             print("")
             print("")
-            return_code = check_return_code(p)
             if return_code:
                 return return_code
-            
+
+            if frame_cache:
+                frame_cache.close(remove=True)
+
             pass2time = datetime.now()
             print("2nd pass completed.")
             print("Current time: " + str(pass2time))
@@ -448,9 +1064,19 @@ def encode(args=None,
            print=print,
            working_dir=None,
            int_handler=None,
-           Popen=subprocess.Popen):
+           Popen=subprocess.Popen,
+           threads=None,
+           on_event=None,
+           on_metrics=None,
+           cgroup=None):
+    """cgroup is the task's (see create_cgroup), without one the encode
+    gets its own if cgroup_root is set."""
+    own_cgroup = not cgroup and cgroup_root and create_cgroup(cgroup_root)
     try:
-        return encode_impl(args, print, working_dir=working_dir, Popen=Popen)
+        return encode_impl(args, print, working_dir=working_dir, Popen=Popen,
+                           threads=threads, on_event=on_event,
+                           on_metrics=on_metrics,
+                           cgroup=cgroup or own_cgroup)
     except KeyboardInterrupt:
         print("")
         print("")
@@ -459,6 +1085,9 @@ def encode(args=None,
             return int_handler()
         
         return 1
+    finally:
+        if own_cgroup:
+            remove_cgroup(own_cgroup)
         
 if __name__ == "__main__":
     encode()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Stand-in for x264 used by the benchmarks (see bench.py), prints x264's
+progress and summary output without encoding anything. It understands the
+x264 options the script relies on (--frames, --seek, --pass, --stats,
+--output, --bitrate, --crf), reads stdin to the end if the input is "-"
+and is controlled by environment variables:
+
+    FAKE_X264_FRAMES    frames of the input, default 2000
+    FAKE_X264_FPS       encoding speed, 0 for as fast as possible
+    FAKE_X264_EXIT      exit code, default 0
+    FAKE_X264_FAIL_AT   frame to exit with FAKE_X264_EXIT at, instead of
+                        after the summary
+
+Point x264_path (or a target's "x264_path") at this file to run the whole
+script without x264. It must be executable, so this only works where
+scripts can be run directly, not on Windows."""
+
+import os
+import sys
+import time
+from threading import Thread
+
+def option(args, name, default=None):
+    value = default
+    for i in range(len(args) - 1):
+        if args[i] == name:
+            value = args[i + 1]
+
+    return value
+
+def main(args):
+    frames = int(option(args, "--frames",
+                        os.getenv("FAKE_X264_FRAMES", "2000")))
+    seek = int(option(args, "--seek", "0"))
+    fps = float(os.getenv("FAKE_X264_FPS", "0"))
+    exit_code = int(os.getenv("FAKE_X264_EXIT", "0"))
+    fail_at = os.getenv("FAKE_X264_FAIL_AT")
+    fail_at = fail_at and int(fail_at)
+    output = option(args, "--output")
+    stats = option(args, "--stats")
+    first_pass = option(args, "--pass") == "1"
+    bitrate = option(args, "--bitrate")
+    if bitrate:
+        kbps = float(bitrate)
+    else:
+        kbps = 40000.0 / (float(option(args, "--crf", "20")) + 1)
+
+    reader = None
+    if args and args[-1] == "-":
+        def read_input():
+            while sys.stdin.buffer.read(1 << 20):
+                pass
+
+        reader = Thread(target=read_input)
+        reader.daemon = True
+        reader.start()
+
+    # x264 writes everything but the stream to stderr
+    out = sys.stderr
+    out.write("avs [info]: 1920x1080p 1:1 @ 24000/1001 fps (cfr)\n")
+    out.write("x264 [info]: using cpu capabilities: MMX2 SSE2Fast SSSE3\n")
+    out.write("x264 [info]: profile High, level 4.1\n")
+    out.flush()
+
+    start = time.time()
+    for i in range(1, frames + 1):
+        if fps:
+            delay = start + i / fps - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        if fail_at and i >= fail_at:
+            out.write("\nx264 [error]: fake failure at frame {0}\n".format(i))
+            return exit_code
+
+        elapsed = max(time.time() - start, 0.001)
+        current_fps = i / elapsed
+        eta = int((frames - i) / current_fps)
+        out.write("[{0:.1f}%] {1}/{2} frames, {3:.2f} fps, {4:.2f} kb/s, "
+                  "eta {5}:{6:02d}:{7:02d}\r".format(
+                      i * 100.0 / frames, i, frames, current_fps,
+                      kbps + seek % 100, eta // 3600, eta // 60 % 60,
+                      eta % 60))
+
+    if reader:
+        reader.join()
+
+    elapsed = max(time.time() - start, 0.001)
+    out.write("\n")
+    out.write("x264 [info]: frame I:{0}  Avg QP:17.12  size:123456\n"
+              .format(frames // 250 + 1))
+    if not first_pass:
+        out.write("x264 [info]: SSIM Mean Y:0.9812345 (17.264db)\n")
+
+    out.write("encoded {0} frames, {1:.2f} fps, {2:.2f} kb/s\n".format(
+        frames, frames / elapsed, kbps + seek % 100))
+    out.flush()
+
+    if output and output != os.devnull and output.upper() != "NUL":
+        with open(output, "wb") as f:
+            # roughly the size the bitrate gives at 24 fps, capped
+            f.write(b"\0" * min(int(kbps * 125 * frames / 24), 1 << 20))
+
+    if stats and first_pass:
+        with open(stats, "w") as f:
+            f.write("#options: fake\n")
+
+        with open(stats + ".mbtree", "wb") as f:
+            f.write(b"\0" * 16)
+
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,333 @@
+import hashlib
+import lzma
+import mmap
+import os
+import subprocess
+import tempfile
+import zlib
+from threading import Thread
+from time import time
+from .utils import split_cmd_line, reads_input, gen_cmd_line
+from .piper import tee, set_pipe_size, chunk_size
+
+__all__ = ["FrameCache", "compressors"]
+
+# files left by encodes that failed or were interrupted are removed after
+stale_secs = 24 * 3600
+
+# name: (compressor, decompressor, file extension). The fastest levels,
+# the 2nd pass must not wait for the decompression
+compressors = {
+    "": (None, None, ".y4m"),
+    "zlib": (lambda: zlib.compressobj(1), zlib.decompressobj, ".y4m.zlib"),
+    "lzma": (lambda: lzma.LZMACompressor(preset=0), lzma.LZMADecompressor,
+             ".y4m.xz"),
+}
+
+class CacheWriter:
+    """Sink of the tee writing the frames to a file, gives up (the write
+    fails, so the tee drops it) once the file grows past limit bytes or the
+    cache was closed."""
+
+    def __init__(self, cache, name, limit):
+        self.cache = cache
+        self.name = name
+        self.limit = limit
+        self.size = 0
+        self.full = False
+        compressor = compressors[cache.compress][0]
+        self.compressor = compressor and compressor()
+        self.f = open(name, "wb")
+
+    def write(self, chunk):
+        if self.cache.aborted:
+            raise OSError("The frame cache was closed")
+
+        if self.compressor:
+            chunk = self.compressor.compress(chunk)
+
+        self.size += len(chunk)
+        if self.size > self.limit:
+            self.full = True
+            raise OSError("The frame cache is full")
+
+        self.f.write(chunk)
+
+    def close(self):
+        if self.compressor and not self.full:
+            data = self.compressor.flush()
+            self.size += len(data)
+            self.f.write(data)
+
+        try:
+            # the size recorded for it must be what's on disk
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        finally:
+            self.f.close()
+
+class FrameCache:
+    """Decoded frames of the 1st pass of an encode, so the 2nd pass doesn't
+    run the filters again. The 1st pass x264 reads the y4m output of the
+    frameserver through a tee that also writes it to a file in cache_dir,
+    the 2nd pass x264 reads that file instead, memory mapped if it isn't
+    compressed. The size of the file is recorded next to it (.size), and
+    checked before it is read. The file is removed once the 2nd pass
+    succeeded. Files of failed encodes are kept for a 2nd pass run later,
+    until they are a day old or the directory grows past max_size
+    bytes."""
+
+    def __init__(self, cmd, in_file, out_file, print=print,
+                 working_dir=None, cache_dir=None,
+                 max_size=64 * 1024 * 1024 * 1024, compress="",
+                 Popen=subprocess.Popen, buffer_size=64 * 1024 * 1024):
+        self.cmd = cmd
+        self.in_file = in_file
+        self.print = print
+        self.working_dir = working_dir
+        self.cache_dir = cache_dir or \
+                         os.path.join(tempfile.gettempdir(), "encx264_frames")
+        self.max_size = max_size
+        self.compress = compress
+        self.Popen = Popen
+        self.buffer_size = buffer_size
+        self.aborted = False
+        self.threads = []
+        self.frameservers = []
+
+        st = os.stat(in_file)
+        key = hashlib.sha1("|".join([
+            cmd, os.path.abspath(in_file), str(st.st_size),
+            str(int(st.st_mtime)), os.path.abspath(out_file)])
+            .encode("utf-8")).hexdigest()
+        self.name = os.path.join(self.cache_dir,
+                                 key + compressors[compress][2])
+        self.size_name = self.name + ".size"
+
+    def evict(self):
+        """Removes stale files, and the least recently used ones while the
+        directory is larger than max_size. Returns the size of the rest."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+                if time() - st.st_mtime > stale_secs:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+
+            entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+
+            if path.endswith(".tmp") or path.endswith(".size"):
+                # being written by another encode, or goes with its file
+                continue
+
+            try:
+                os.remove(path)
+                total -= size
+                os.remove(path + ".size")
+            except OSError:
+                pass
+
+        return total
+
+    def wrap(self, Popen, run):
+        """Popen starting x264 with its input on stdin, which run(stdin, p)
+        feeds in a thread."""
+        def popen(cmd, **kwargs):
+            piped = reads_input(cmd, self.in_file)
+            if piped is None:
+                return Popen(cmd, **kwargs)
+
+            kwargs["stdin"] = subprocess.PIPE
+            p = Popen(piped, **kwargs)
+            stdin, p.stdin = p.stdin, None
+            thread = Thread(target=run, args=(stdin, p))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            return p
+
+        return popen
+
+    def piped_cmdline(self, cmdline):
+        """cmdline as the Popen of wrap() runs it, for the log."""
+        piped = reads_input(split_cmd_line(cmdline), self.in_file)
+        if piped is None:
+            return cmdline
+
+        return isinstance(piped, str) and piped or gen_cmd_line(piped)
+
+    def capture_popen(self, Popen):
+        """Popen for the 1st pass, its input is written to the cache."""
+        return self.wrap(Popen, self.capture)
+
+    def replay_popen(self, Popen):
+        """Popen for the 2nd pass reading the cached frames, None if there
+        aren't any."""
+        self.wait()
+        if not self.complete():
+            return None
+
+        os.utime(self.name)
+        os.utime(self.size_name)
+        return self.wrap(Popen, self.replay)
+
+    def complete(self):
+        """Whether the cached frames are there and as long as when they
+        were written. Incomplete files (cut short by a crash, or by
+        someone else) are removed."""
+        if not os.path.isfile(self.name):
+            return False
+
+        try:
+            with open(self.size_name, "r") as f:
+                size = int(f.read())
+
+            if os.path.getsize(self.name) == size:
+                return True
+        except (OSError, ValueError):
+            pass
+
+        self.print("Warning: The frame cache is incomplete, the 2nd pass "
+                   "reads the input again")
+        self.remove()
+        return False
+
+    def remove(self):
+        for name in [self.name, self.size_name]:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def capture(self, stdin, x264):
+        writer = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            limit = self.max_size - self.evict()
+            writer = CacheWriter(self, self.name + ".tmp", limit)
+        except OSError as e:
+            self.print("Warning: Can't write the frame cache:", e)
+
+        try:
+            p = self.Popen(split_cmd_line(self.cmd),
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE,
+                           cwd=self.working_dir)
+        except OSError as e:
+            self.print("Can't start the frameserver:", e)
+            stdin.close()
+            if writer:
+                writer.close()
+                os.remove(writer.name)
+
+            return
+
+        self.frameservers.append(p)
+        for f in [p.stdout, stdin]:
+            set_pipe_size(f.fileno(), chunk_size)
+
+        sinks = [stdin] + (writer and [writer] or [])
+        failed = tee(p.stdout, sinks, self.buffer_size)
+        if stdin in failed:
+            # x264 exited early
+            p.kill()
+
+        p.stdout.close()
+        code = p.wait()
+        if not writer:
+            return
+
+        if writer.full:
+            self.print("Warning: The frame cache would grow past "
+                       "frame_cache_size_mb, the 2nd pass reads the input "
+                       "again")
+
+        try:
+            # complete if the frameserver got to the end and every frame
+            # was written, even if close() was called meanwhile
+            if code or failed:
+                os.remove(writer.name)
+            else:
+                with open(self.size_name, "w") as f:
+                    f.write(str(writer.size))
+
+                os.replace(writer.name, self.name)
+        except OSError as e:
+            self.print("Warning: Can't write the frame cache:", e)
+
+    def replay(self, stdin, x264):
+        decompressor = compressors[self.compress][1]
+        try:
+            with open(self.name, "rb") as f:
+                if decompressor:
+                    decompressor = decompressor()
+                    while not self.aborted:
+                        data = f.read(chunk_size)
+                        if not data:
+                            if not decompressor.eof:
+                                raise EOFError("The file is truncated")
+
+                            break
+
+                        stdin.write(decompressor.decompress(data))
+                else:
+                    self.replay_mapped(f, stdin)
+        except BrokenPipeError:
+            # x264 exited, it tells why
+            pass
+        except (OSError, ValueError, EOFError, zlib.error, lzma.LZMAError) \
+               as e:
+            # x264 must not take a truncated input for the whole
+            self.print("Can't read the frame cache:", e)
+            x264.kill()
+            # a rerun reads the input instead
+            self.remove()
+
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+    def replay_mapped(self, f, stdin):
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+
+            with memoryview(m) as view:
+                for pos in range(0, len(view), chunk_size):
+                    if self.aborted:
+                        break
+
+                    stdin.write(view[pos:pos + chunk_size])
+        finally:
+            m.close()
+
+    def wait(self):
+        for thread in list(self.threads):
+            thread.join()
+
+    def close(self, remove=False):
+        """Stops what is still running, and removes the cached frames if
+        remove. A capture that is still being written is dropped, wait()
+        for it first to keep it."""
+        self.aborted = True
+        for p in self.frameservers:
+            try:
+                p.kill()
+            except OSError:
+                pass
+
+        self.wait()
+        if remove:
+            self.remove()
@@ -2,6 +2,7 @@ from .update import update
 from .task import task_do_command
 from .version import print_version
 from .piper import piper_subcommand
+from .bench import bench_subcommand
 import os
 
 __all__ = ["functions"]
@@ -13,4 +14,5 @@ functions = {
     "task": task_do_command,
     "piper": piper_subcommand,
     "version": print_version,
+    "bench": bench_subcommand,
 }
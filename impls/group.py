@@ -0,0 +1,242 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread, Timer
+from .utils import split_cmd_line, reads_input
+from .piper import tee, set_pipe_size, chunk_size
+from .encx264_impl import encode, get_params, parse_args, pop_arg, \
+                          frameserver_cmd, group_buffer_mb, \
+                          group_join_timeout
+
+__all__ = ["encode_group", "group_member_params"]
+
+# options that make x264 read the input more than once per pass
+unsupported_options = ["--segments", "--probe", "--infile-2pass",
+                       "--frame-cache"]
+
+class GroupInput:
+    """Feeds the x264 processes of a group from a single frameserver.
+
+    Every x264 that reads the input joins the current round with its
+    stdin. Once all members that are still encoding have joined, the
+    frameserver is started and its output is teed to them, so the filters
+    run once per round instead of once per encode. Rounds line up with the
+    passes, a member whose 1st pass came from the cache simply joins the
+    others' 1st pass round with its 2nd pass. A round starts without the
+    stragglers after join_timeout seconds, cancel() gives up on waiting."""
+
+    def __init__(self, cmd, members, Popen, working_dir, buffer_size,
+                 join_timeout=None):
+        self.cmd = cmd
+        self.live = members
+        self.Popen = Popen
+        self.working_dir = working_dir
+        self.buffer_size = buffer_size
+        self.join_timeout = join_timeout
+        self.cond = Condition()
+        self.waiting = []
+        self.threads = []
+        self.timer = None
+        self.cancelled = False
+        # (round, exit code) of frameservers that failed
+        self.failures = []
+
+    def join(self, stdin):
+        with self.cond:
+            if self.cancelled:
+                # x264 sees the end of its input and fails
+                stdin.close()
+                return
+
+            self.waiting.append(stdin)
+            if len(self.waiting) == 1 and self.join_timeout is not None:
+                self.timer = Timer(self.join_timeout, self.join_timed_out,
+                                   args=(len(self.threads),))
+                self.timer.daemon = True
+                self.timer.start()
+
+            self.start_if_complete()
+
+    def join_timed_out(self, rounds):
+        with self.cond:
+            # unless the round started meanwhile
+            if len(self.threads) == rounds and self.waiting:
+                self.start_round()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            if self.timer:
+                self.timer.cancel()
+
+            for sink in self.waiting:
+                sink.close()
+
+            self.waiting = []
+
+    def leave(self):
+        with self.cond:
+            self.live -= 1
+            self.start_if_complete()
+
+    def start_if_complete(self):
+        if self.waiting and len(self.waiting) >= self.live:
+            self.start_round()
+
+    def start_round(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        sinks = self.waiting
+        self.waiting = []
+        thread = Thread(target=self.run_round,
+                        args=(len(self.threads) + 1, sinks))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def run_round(self, index, sinks):
+        try:
+            p = self.Popen(split_cmd_line(self.cmd),
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE,
+                           cwd=self.working_dir)
+        except OSError:
+            for sink in sinks:
+                sink.close()
+
+            with self.cond:
+                self.failures.append((index, None))
+            return
+
+        # a whole chunk of the tee fits into each pipe
+        for f in [p.stdout] + sinks:
+            set_pipe_size(f.fileno(), chunk_size)
+
+        failed = tee(p.stdout, sinks, self.buffer_size)
+        if len(failed) == len(sinks):
+            # every x264 exited early
+            p.kill()
+
+        p.stdout.close()
+        if p.wait() and len(failed) < len(sinks):
+            with self.cond:
+                self.failures.append((index, p.returncode))
+
+    def wait(self):
+        with self.cond:
+            threads = list(self.threads)
+
+        for thread in threads:
+            thread.join()
+
+def group_member_params(targets, args):
+    """Parameter lists of the encodes of a group, one per target. The
+    output must contain {target}, by default it's <input>.<target>.mp4.
+    Returns an error message instead if args don't suit a group."""
+    for option in unsupported_options:
+        if option in args:
+            return "{0} can't be used in a group".format(option)
+
+    opt, rest = parse_args([targets[0]] + list(args))
+    pop_arg(rest)
+    in_file = opt.inFile or pop_arg(rest)
+    out_file = opt.outFile or pop_arg(rest)
+    if not in_file:
+        return "You have not specified input file!"
+
+    members = []
+    for target in targets:
+        if out_file:
+            if "{target}" not in out_file:
+                return "The output of a group must contain {target}"
+
+            member = [target] + [x.replace("{target}", target) for x in args]
+        else:
+            member = [target] + list(args) + [
+                "--outfile",
+                "{0}.{1}.mp4".format(os.path.splitext(in_file)[0], target)]
+
+        if not get_params(member):
+            return "Invalid parameters for target {0}".format(target)
+
+        members.append(member)
+
+    return members
+
+def encode_group(members,
+                 print=print,
+                 working_dir=None,
+                 int_handler=None,
+                 Popen=subprocess.Popen,
+                 threads=None,
+                 on_event=None,
+                 on_metrics=None,
+                 cgroup=None):
+    """Runs the encodes of members (parameter lists of encode()) at the
+    same time, every x264 reading the output of frameserver_cmd instead of
+    the input. Returns None on success like encode()."""
+    if not frameserver_cmd:
+        print("Groups need frameserver_cmd, see encx264_defaults.py")
+        return 1
+
+    params = [get_params(x, print, working_dir) for x in members]
+    if None in params:
+        return 1
+
+    in_file = params[0].inFile
+    if [p for p in params if p.inFile != in_file]:
+        print("All encodes of a group must have the same input")
+        return 1
+
+    group_input = GroupInput(frameserver_cmd.format(inFile=in_file),
+                             len(members), Popen, working_dir,
+                             group_buffer_mb * 1024 * 1024,
+                             group_join_timeout)
+
+    def member_popen(cmd, **kwargs):
+        piped = reads_input(cmd, in_file)
+        if piped is None:
+            return Popen(cmd, **kwargs)
+
+        kwargs["stdin"] = subprocess.PIPE
+        p = Popen(piped, **kwargs)
+        # the tee writes and closes it
+        stdin, p.stdin = p.stdin, None
+        group_input.join(stdin)
+        return p
+
+    def run(member):
+        try:
+            return encode(member,
+                          print,
+                          working_dir=working_dir,
+                          int_handler=int_handler,
+                          Popen=member_popen,
+                          threads=threads and
+                                  max(1, threads // len(members)),
+                          on_event=on_event,
+                          on_metrics=on_metrics,
+                          cgroup=cgroup)
+        finally:
+            group_input.leave()
+
+    with ThreadPoolExecutor(len(members)) as executor:
+        try:
+            codes = list(executor.map(run, members))
+        except BaseException:
+            # don't leave members blocked on a round that never starts
+            group_input.cancel()
+            raise
+
+    group_input.wait()
+    for index, code in group_input.failures:
+        print("The frameserver failed in round {0} (code {1})"
+              .format(index, code))
+
+    failures = [x for x in codes if x]
+    if failures:
+        return failures[0]
+
+    return group_input.failures and 1 or None
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import tempfile
+from threading import Lock
+from time import time
+
+__all__ = ["History", "x264_build"]
+
+def x264_build(path):
+    """Short id of an x264 executable, changes whenever it's replaced."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+
+    return hashlib.sha1("{0}:{1}:{2}".format(
+        os.path.abspath(path), st.st_size, int(st.st_mtime))
+        .encode("utf-8")).hexdigest()[:12]
+
+class History:
+    """Throughput and peak memory of finished passes per target, pass,
+    resolution and x264 build, and the frame counts and resolutions of the
+    inputs that went through them, stored as one JSON file. Used to predict
+    how long a queued task will take and how much memory it needs before
+    x264 can tell."""
+
+    def __init__(self, file_name, max_inputs=5000):
+        self.file_name = file_name
+        self.max_inputs = max_inputs
+        self.lock = Lock()
+        self.data = None
+        # bumped on every change, lets callers cache predictions
+        self.version = 0
+
+    def read(self):
+        try:
+            with open(self.file_name, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+
+        data.setdefault("passes", {})
+        data.setdefault("inputs", {})
+        return data
+
+    def load(self):
+        with self.lock:
+            if self.data is None:
+                self.data = self.read()
+                self.version += 1
+
+            return self.data
+
+    def add(self, record):
+        """Adds a metrics record (see metrics.py) of a successful pass."""
+        if record.get("return_code") or record.get("cached") or \
+           not record.get("frames") or not record.get("wall_secs"):
+            return
+
+        key = "|".join([str(record.get("target")), str(record.get("pass")),
+                        record.get("resolution") or "",
+                        record.get("x264") or ""])
+        with self.lock:
+            # other encodes may have written it meanwhile
+            data = self.read()
+            entry = data["passes"].setdefault(
+                key, {"count": 0, "frames": 0, "secs": 0.0})
+            entry["count"] += 1
+            entry["frames"] += record["frames"]
+            entry["secs"] += record["wall_secs"]
+            entry["last"] = time()
+            if record.get("peak_rss_bytes"):
+                # segments run several x264 at once, only one is measured
+                rss = record["peak_rss_bytes"] * \
+                      max(record.get("segment_workers") or 1, 1)
+                entry["rss"] = max(entry.get("rss", 0), rss)
+
+            if record.get("input") and not record.get("segments"):
+                inputs = data["inputs"]
+                inputs[record["input"]] = [record["frames"], time(),
+                                           record.get("resolution")]
+                if len(inputs) > self.max_inputs:
+                    oldest = sorted(inputs.items(), key=lambda x: x[1][1])
+                    for name, _ in oldest[:len(inputs) - self.max_inputs]:
+                        del inputs[name]
+
+            try:
+                self.write(data)
+            except OSError as e:
+                print("Warning: Can't write encode history:", e)
+
+            self.data = data
+            self.version += 1
+
+    def write(self, data):
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=os.path.basename(self.file_name) + ".",
+            dir=os.path.dirname(self.file_name) or ".")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+
+        os.replace(tmp_name, self.file_name)
+
+    def input_frames(self, name):
+        entry = self.load()["inputs"].get(name)
+        return entry and entry[0] or None
+
+    def input_resolution(self, name):
+        entry = self.load()["inputs"].get(name)
+        return entry and len(entry) > 2 and entry[2] or None
+
+    def peak_rss(self, target, pass_name, resolution=None):
+        """(largest peak memory, resolution) of the passes of target, from
+        the passes at resolution if there are any. None if not known."""
+        prefix = "{0}|{1}|".format(target, pass_name)
+        best = None
+        for key, entry in self.load()["passes"].items():
+            if not key.startswith(prefix) or not entry.get("rss"):
+                continue
+
+            entry_resolution = key.split("|")[2]
+            rank = (entry_resolution == resolution, entry.get("last", 0))
+            if best is None or rank > best[0]:
+                best = (rank, entry["rss"], entry_resolution)
+
+        return best and best[1:] or None
+
+    def predict(self, target, pass_name, frames=None, resolution=None):
+        """Predicted seconds of a pass, None if nothing like it has run.
+        Uses the fps of the most recently used x264 build, and the average
+        length of the passes if the frame count isn't known."""
+        prefix = "{0}|{1}|".format(target, pass_name)
+        best = None
+        for key, entry in self.load()["passes"].items():
+            if not key.startswith(prefix):
+                continue
+
+            if resolution and key.split("|")[2] != resolution:
+                continue
+
+            if best is None or entry.get("last", 0) > best.get("last", 0):
+                best = entry
+
+        if not best:
+            return None
+
+        if frames:
+            return frames * best["secs"] / max(best["frames"], 1)
+
+        return best["secs"] / best["count"]
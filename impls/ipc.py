@@ -0,0 +1,165 @@
+import json
+import os
+import socket
+from threading import Thread, Condition
+
+__all__ = ["JsonConnection", "IpcServer", "connect", "local_address",
+           "ipc_request"]
+
+class JsonConnection:
+    """Newline delimited JSON messages over a stream socket."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rwb")
+
+    def send(self, obj):
+        self.file.write(json.dumps(obj).encode("utf-8") + b"\n")
+        self.file.flush()
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            return None
+
+        return json.loads(line.decode("utf-8"))
+
+    def request(self, obj):
+        self.send(obj)
+        return self.receive()
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.sock.close()
+
+def local_address(path):
+    """Unix domain socket at path, or a loopback TCP port recorded in path
+    where unix sockets are not available."""
+    if hasattr(socket, "AF_UNIX"):
+        return path
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, "r") as f:
+        try:
+            return ("127.0.0.1", int(f.read().strip()))
+        except ValueError:
+            return None
+
+def connect(address, timeout=None):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except:
+        sock.close()
+        raise
+
+    sock.settimeout(None)
+    return JsonConnection(sock)
+
+def ipc_request(address, request, timeout=5):
+    """Sends one request, returns the reply or None if nobody is
+    listening at address."""
+    if not address:
+        return None
+
+    try:
+        conn = connect(address, timeout)
+    except OSError:
+        return None
+
+    try:
+        return conn.request(request)
+    finally:
+        conn.close()
+
+class IpcServer:
+    """Accepts connections on a background thread and answers every
+    request with handler(request). Handlers are called from connection
+    threads, so they must do their own synchronization."""
+
+    def __init__(self, address, handler, local_path=None):
+        self.handler = handler
+        self.busy = 0
+        self.cond = Condition()
+        self.unix_path = None
+        if isinstance(address, str):
+            if os.path.exists(address):
+                # stale socket of a daemon that didn't exit cleanly
+                os.remove(address)
+
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(address)
+            self.unix_path = address
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(address)
+
+        self.address = self.sock.getsockname()
+        self.local_path = local_path
+        if local_path and not self.unix_path:
+            with open(local_path, "w") as f:
+                f.write(str(self.address[1]))
+
+        self.sock.listen(16)
+
+    def start(self):
+        thread = Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                # closed
+                return
+
+            thread = Thread(target=self.handle_connection, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def handle_connection(self, sock):
+        conn = JsonConnection(sock)
+        try:
+            while True:
+                request = conn.receive()
+                if request is None:
+                    break
+
+                with self.cond:
+                    self.busy += 1
+
+                try:
+                    conn.send(self.handler(request))
+                finally:
+                    with self.cond:
+                        self.busy -= 1
+                        self.cond.notify_all()
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self, timeout=5):
+        self.sock.close()
+        # let replies that are being sent go out before the process exits
+        with self.cond:
+            self.cond.wait_for(lambda: self.busy == 0, timeout)
+
+        for path in [self.unix_path, self.local_path]:
+            if path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,179 @@
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+from datetime import datetime
+from threading import Lock
+
+__all__ = ["PassUsage", "write_metrics"]
+
+write_lock = Lock()
+
+prom_line_pat = re.compile(r"^(\w+)\{(.*)\} (\S+)$")
+
+# record field -> (metric, help), summed over all passes
+prom_counters = [
+    ("wall_secs", "encx264_wall_seconds_total",
+     "Wall time of the passes"),
+    ("cpu_secs", "encx264_cpu_seconds_total",
+     "User and system cpu time of x264 and its children"),
+    ("frames", "encx264_frames_total", "Encoded frames"),
+    ("output_bytes", "encx264_output_bytes_total", "Size of the outputs"),
+]
+
+# record field -> (metric, help), of the last pass
+prom_gauges = [
+    ("fps", "encx264_last_fps", "Average fps of the last pass"),
+    ("bitrate", "encx264_last_bitrate_kbps", "Bitrate of the last pass"),
+    ("peak_rss_bytes", "encx264_last_peak_rss_bytes",
+     "Peak resident memory of the largest process of the last pass"),
+]
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+class PassUsage:
+    """Resource usage of the processes of one pass, collected with wait4()
+    as they exit. Segments share one instance, so it's locked. Where wait4
+    isn't available (Windows), or a process was reaped elsewhere (a poll()
+    while killing the encode), the cpu usage is unknown and only the wall
+    time is recorded, see "usage_known"."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start = datetime.now()
+        self.user = 0.0
+        self.sys = 0.0
+        self.maxrss = 0
+        self.known = False
+        self.missed = False
+
+    def wait(self, p):
+        """Reaps p (a Popen) and adds its usage, call it before
+        p.communicate() once its output has been read."""
+        if not hasattr(os, "wait4"):
+            return
+
+        if p.returncode is not None:
+            with self.lock:
+                self.missed = True
+            return
+
+        try:
+            _, status, ru = os.wait4(p.pid, 0)
+        except ChildProcessError:
+            # reaped by a poll() meanwhile, its usage is gone
+            with self.lock:
+                self.missed = True
+            return
+
+        p.returncode = exit_code(status)
+        # kilobytes, but bytes on macOS
+        maxrss = ru.ru_maxrss * (sys.platform != "darwin" and 1024 or 1)
+        with self.lock:
+            self.user += ru.ru_utime
+            self.sys += ru.ru_stime
+            self.maxrss = max(self.maxrss, maxrss)
+            self.known = True
+
+    def record(self, **fields):
+        """The metrics record of the pass, fields (target, pass, fps...)
+        are added as they are."""
+        end = datetime.now()
+        # a partial sum would pass for a cheap pass
+        known = self.known and not self.missed
+        record = {
+            "time": end.isoformat(),
+            "host": platform.node(),
+            "usage_known": known,
+            "wall_secs": round((end - self.start).total_seconds(), 3),
+            "cpu_user_secs": known and round(self.user, 3) or None,
+            "cpu_sys_secs": known and round(self.sys, 3) or None,
+            "cpu_secs": known and round(self.user + self.sys, 3) or None,
+            "peak_rss_bytes": known and self.maxrss or None,
+        }
+        record.update(fields)
+        return record
+
+def prom_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+                     .replace("\n", "\\n")
+
+def read_prom(name):
+    """{(metric, labels): value} of a file written by write_prom."""
+    values = {}
+    if not os.path.isfile(name):
+        return values
+
+    with open(name, "r") as f:
+        for line in f:
+            m = prom_line_pat.match(line.strip())
+            if m:
+                try:
+                    values[(m.group(1), m.group(2))] = float(m.group(3))
+                except ValueError:
+                    pass
+
+    return values
+
+def write_prom(name, record):
+    values = read_prom(name)
+    labels = 'target="{0}",pass="{1}"'.format(
+        prom_escape(record.get("target")), prom_escape(record.get("pass")))
+    key = ("encx264_passes_total", labels)
+    values[key] = values.get(key, 0) + 1
+    for field, metric, _ in prom_counters:
+        if record.get(field) is not None:
+            key = (metric, labels)
+            values[key] = values.get(key, 0) + record[field]
+
+    for field, metric, _ in prom_gauges:
+        if record.get(field) is not None:
+            values[(metric, labels)] = record[field]
+
+    helps = [("encx264_passes_total", "Finished passes")] + \
+            [(metric, text) for _, metric, text in prom_counters] + \
+            [(metric, text) for _, metric, text in prom_gauges]
+    lines = []
+    for metric, text in helps:
+        series = sorted([(l, v) for (m, l), v in values.items()
+                         if m == metric])
+        if not series:
+            continue
+
+        lines.append("# HELP {0} {1}".format(metric, text))
+        lines.append("# TYPE {0} {1}".format(
+            metric, metric.endswith("_total") and "counter" or "gauge"))
+        for l, v in series:
+            lines.append("{0}{{{1}}} {2}".format(metric, l,
+                                                 repr(float(v))))
+
+    # scrapers must never see a half written file
+    fd, tmp_name = tempfile.mkstemp(prefix=os.path.basename(name) + ".",
+                                    dir=os.path.dirname(name) or ".")
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    os.chmod(tmp_name, 0o644)
+    os.replace(tmp_name, name)
+
+def write_metrics(record, jsonl_file=None, prom_file=None):
+    """Appends record to jsonl_file and adds it to the totals in prom_file
+    (Prometheus text format, e.g. for node_exporter's textfile collector).
+    Encodes running in parallel in one process are serialized, separate
+    processes may lose an update of the Prometheus file."""
+    try:
+        with write_lock:
+            if jsonl_file:
+                with open(jsonl_file, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+            if prom_file:
+                write_prom(prom_file, record)
+    except OSError as e:
+        print("Warning: Can't write metrics:", e)
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+__all__ = ["Pass1Cache"]
+
+# scripts smaller than this are hashed by content, anything else (video
+# files fed to x264 directly) by size and mtime
+script_size_limit = 1024 * 1024
+
+quoted_pat = re.compile(r'"([^"]+)"|\'([^\']+)\'')
+
+# scripts are followed into the scripts they import
+script_extensions = [".avs", ".avsi", ".vpy", ".py"]
+# what a script may depend on without naming the file: the environment,
+# and python modules (other than vapoursynth itself) found on sys.path
+env_pat = re.compile(r"\b(environ|getenv|GetEnv|SetEnv)\b", re.I)
+python_import_pat = re.compile(
+    r"^\s*(?:from\s+(\S+)\s+import|import\s+([\w.]+))", re.M)
+hashable_modules = ["vapoursynth", "os", "sys", "functools", "math"]
+
+def file_signature(name):
+    st = os.stat(name)
+    return "{0}:{1}:{2}".format(os.path.abspath(name), st.st_size,
+                                int(st.st_mtime))
+
+def referenced_files(text, base_dir):
+    """Existing files mentioned as quoted strings in text."""
+    files = []
+    for m in quoted_pat.finditer(text):
+        name = os.path.join(base_dir, m.group(1) or m.group(2))
+        if os.path.isfile(name) and name not in files:
+            files.append(name)
+
+    return files
+
+def unhashable_reason(name, text):
+    """Why the output of the script name can't be pinned down by hashing
+    the files it names, None if it can."""
+    if env_pat.search(text):
+        return "{0} reads the environment".format(name)
+
+    if os.path.splitext(name)[1].lower() in (".vpy", ".py"):
+        for m in python_import_pat.finditer(text):
+            module = (m.group(1) or m.group(2)).split(".")[0]
+            if module not in hashable_modules:
+                return "{0} imports {1}".format(name, module)
+
+    return None
+
+def dir_size(path):
+    return sum([os.path.getsize(os.path.join(path, x))
+                for x in os.listdir(path)])
+
+class Pass1Cache:
+    """First pass results (bitrate, stats and mbtree files) stored under a
+    hash of everything that influences them. Entries are directories in
+    cache_dir, their mtime is bumped on every hit and the least recently
+    used ones are removed once the cache grows past max_size bytes.
+
+    Scripts are hashed with the files they name and the scripts those
+    import. key() returns None, with the reason in self.unhashable, for
+    scripts that depend on something else (the environment, python
+    modules), as a cached result could be stale."""
+
+    def __init__(self, cache_dir=None, max_size=4096 * 1024 * 1024):
+        self.cache_dir = cache_dir or \
+                         os.path.join(tempfile.gettempdir(), "encx264_cache")
+        self.max_size = max_size
+        self.unhashable = None
+
+    def key(self, args, cmdline, working_dir=None):
+        h = hashlib.sha1()
+        h.update(os.path.abspath(os.path.join(
+            working_dir or "", args.outFile)).encode("utf-8"))
+        normalized = cmdline.replace(args.statsFile, "<stats>")
+        normalized = re.sub(r"\s--(lookahead-)?threads\s+\S+", "", normalized)
+        h.update(normalized.encode("utf-8"))
+
+        h.update(file_signature(args.x264_exec.strip('"')).encode("utf-8"))
+
+        skip = [os.path.abspath(x) for x in
+                [args.statsFile, args.x264_exec.strip('"')]]
+        sources = [x for x in referenced_files(cmdline, working_dir or "")
+                   if os.path.abspath(x) not in skip]
+        seen = []
+        while sources:
+            name = sources.pop(0)
+            if os.path.abspath(name) in seen:
+                continue
+
+            seen.append(os.path.abspath(name))
+            if os.path.splitext(name)[1].lower() not in script_extensions \
+               or os.path.getsize(name) >= script_size_limit:
+                h.update(file_signature(name).encode("utf-8"))
+                continue
+
+            with open(name, "rb") as f:
+                script = f.read()
+
+            text = script.decode("utf-8", "replace")
+            self.unhashable = unhashable_reason(name, text)
+            if self.unhashable:
+                return None
+
+            h.update(script)
+            sources += referenced_files(text, os.path.dirname(name))
+
+        return h.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, stats_file):
+        """Copies the cached stats to stats_file and returns the bitrate,
+        or None on a miss."""
+        path = self.entry(key)
+        try:
+            with open(os.path.join(path, "bitrate.txt"), "r") as f:
+                bitrate = int(f.read().strip())
+
+            shutil.copyfile(os.path.join(path, "stats"), stats_file)
+            if os.path.isfile(os.path.join(path, "stats.mbtree")):
+                shutil.copyfile(os.path.join(path, "stats.mbtree"),
+                                stats_file + ".mbtree")
+
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return bitrate
+
+    def store(self, key, stats_file, bitrate):
+        path = self.entry(key)
+        if os.path.isdir(path) or not os.path.isfile(stats_file):
+            return
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(prefix=key + ".", suffix=".tmp",
+                                        dir=self.cache_dir)
+            shutil.copyfile(stats_file, os.path.join(tmp_path, "stats"))
+            if os.path.isfile(stats_file + ".mbtree"):
+                shutil.copyfile(stats_file + ".mbtree",
+                                os.path.join(tmp_path, "stats.mbtree"))
+
+            with open(os.path.join(tmp_path, "bitrate.txt"), "w") as f:
+                f.write(str(bitrate))
+
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # stored by another encode meanwhile
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+            self.evict()
+        except OSError as e:
+            print("Warning: Can't store 1st pass result in cache:", e)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path) and not name.endswith(".tmp"):
+                entries.append((os.path.getmtime(path), dir_size(path), path))
+
+        entries.sort()
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in entries[:-1]:
+            if total <= self.max_size:
+                break
+
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -1,56 +1,467 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import struct
 import sys
 import subprocess
+from queue import Queue
+from threading import Event, Thread
+from time import time
 
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+    termios = None
 
-def main(argv):
-    if argv[0] == "--del-last-arg":
-        argv = argv[1:-1]
+__all__ = ["tee", "set_pipe_size", "PipeStats", "piper_subcommand"]
+
+# per consumer buffer of the tee, and the size of a single read
+default_buffer_mb = 64
+chunk_size = 1024 * 1024
+
+# Linux, the constants are only in fcntl since Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+F_GETPIPE_SZ = getattr(fcntl, "F_GETPIPE_SZ", 1032)
+
+# --stats: how often the pipes are looked at, and the default interval of
+# the summaries in seconds, 0 for only the final one
+stats_sample_secs = 0.01
+default_stats_interval = 30
+# the final summary, the task runner records what follows as JSON
+stats_prefix = "piper stats: "
+
+
+def set_pipe_size(fd, size):
+    """Enlarges the pipe fd to size bytes, or as close to it as an
+    unprivileged process may (/proc/sys/fs/pipe-max-size). Returns the new
+    size, None where pipes can't be resized."""
+    if not fcntl or not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+
+    try:
+        with open("/proc/sys/fs/pipe-max-size", "r") as f:
+            max_size = int(f.read())
+
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, min(size, max_size))
+    except (OSError, ValueError):
+        return None
+
+def pipe_check(fd, full):
+    """Function telling whether the pipe fd is full (or empty), for
+    PipeStats. None where pipes can't be looked at."""
+    if not fcntl or not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        size = fcntl.fcntl(fd, F_GETPIPE_SZ)
+    except OSError:
+        return None
+
+    def check():
+        try:
+            n = struct.unpack("i", fcntl.ioctl(fd, termios.FIONREAD,
+                                               b"\0" * 4))[0]
+        except OSError:
+            return False
+
+        if full:
+            # a blocked writer waits for a whole page to be free
+            return n > size - 4096
+
+        return not n
+
+    return check
+
+def process_usage(pid):
+    """(cpu seconds, bytes written) of the process pid and the children it
+    waited for, from /proc. None if not known, bytes may be None."""
+    try:
+        with open("/proc/{0}/stat".format(pid), "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+
+        # utime, stime, cutime, cstime
+        cpu = sum([int(x) for x in fields[11:15]]) / \
+              float(os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+    written = None
+    try:
+        with open("/proc/{0}/io".format(pid), "r") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    written = int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+
+    return cpu, written
+
+def process_exited(p):
+    """Whether p has exited, without reaping it."""
+    if not hasattr(os, "waitid"):
+        return p.poll() is not None
+
+    try:
+        return os.waitid(os.P_PID, p.pid,
+                         os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except ChildProcessError:
+        return True
+
+class PipeStats:
+    """Where a pipeline waits, for --stats. While the producer runs, the
+    pipes are looked at every stats_sample_secs: a full pipe means the
+    producer is blocked on it, an empty one that the consumer waits for
+    data. With the cpu time of every process this tells whether the
+    frameserver or x264 holds the encode back. Linux only, elsewhere just
+    the time is known."""
+
+    def __init__(self, processes, interval=default_stats_interval):
+        # the producer first
+        self.processes = processes
+        self.interval = interval
+        self.producer_checks = []
+        self.consumer_checks = [[] for p in processes[1:]]
+        self.blocked = 0.0
+        self.waiting = [0.0] * (len(processes) - 1)
+        self.sampled = 0.0
+        self.usage = [None] * len(processes)
+        self.final = set()
+        self.start = time()
+        self.producer_done = False
+        self.stopped = Event()
+        self.thread = None
+
+    def watch_producer(self, check):
+        if check:
+            self.producer_checks.append(check)
+
+    def watch_consumer(self, index, check):
+        if check:
+            self.consumer_checks[index].append(check)
+
+    def start_sampling(self):
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        last = last_print = time()
+        while not self.stopped.wait(stats_sample_secs):
+            now = time()
+            if not self.producer_done:
+                self.sample(now - last)
+
+            last = now
+            if self.interval and now - last_print >= self.interval:
+                last_print = now
+                self.update_usage()
+                print(self.summary_line(), flush=True)
+
+    def sample(self, secs):
+        if process_exited(self.processes[0]):
+            # the rest is the consumers finishing, not waiting
+            self.producer_done = True
+            return
+
+        if [c for c in self.producer_checks if c()]:
+            self.blocked += secs
+
+        for i, checks in enumerate(self.consumer_checks):
+            if [c for c in checks if c()]:
+                self.waiting[i] += secs
+
+        self.sampled += secs
+
+    def update_usage(self):
+        for i, p in enumerate(self.processes):
+            if i not in self.final:
+                self.usage[i] = process_usage(p.pid) or self.usage[i]
+
+    def wait(self, index):
+        """Waits for process index to exit and takes its final usage
+        before p.wait() reaps it."""
+        p = self.processes[index]
+        if hasattr(os, "waitid") and p.returncode is None:
+            try:
+                os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+            except ChildProcessError:
+                return
+
+        self.usage[index] = process_usage(p.pid) or self.usage[index]
+        self.final.add(index)
+
+    def summary(self):
+        secs = time() - self.start
+        written = self.usage[0] and self.usage[0][1]
+        ret = {
+            "secs": round(secs, 3),
+            "bytes": written,
+            "mb_per_sec": written and
+                          round(written / 1048576.0 / max(secs, 0.001), 1),
+            "sampled_secs": round(self.sampled, 3),
+            "producer_blocked_secs": round(self.blocked, 3),
+            "consumer_waiting_secs": [round(x, 3) for x in self.waiting],
+            "cpu_secs": [x and round(x[0], 3) for x in self.usage],
+            "bottleneck": None,
+        }
+        # the side the other one waits for, if anybody waits much. With
+        # several consumers the producer holds back only if all of them wait
+        waiting = min(self.waiting or [0])
+        if max(self.blocked, waiting) > self.sampled * 0.1:
+            ret["bottleneck"] = self.blocked > waiting and "consumer" or \
+                                "producer"
+
+        return ret
+
+    def summary_line(self):
+        summary = self.summary()
+        sampled = max(self.sampled, 0.001)
+        cores = [x is not None and "{0:.2f}".format(x / summary["secs"])
+                 or "?" for x in summary["cpu_secs"]]
+        return "piper: {0} MB, {1} MB/s, producer blocked {2:.0f}%, " \
+               "consumer waiting {3}, cpu {4} cores".format(
+                   summary["bytes"] is not None and
+                   "{0:.0f}".format(summary["bytes"] / 1048576.0) or "?",
+                   summary["mb_per_sec"] or "?",
+                   self.blocked * 100 / sampled,
+                   "/".join(["{0:.0f}%".format(x * 100 / sampled)
+                             for x in self.waiting]),
+                   "/".join(cores))
+
+    def print_summary(self):
+        print(self.summary_line())
+        print(stats_prefix + json.dumps(self.summary()), flush=True)
+
+def wait_process(p, stats=None, index=0):
+    if stats:
+        stats.wait(index)
+
+    return p.wait()
+
+def tee(source, sinks, buffer_size=default_buffer_mb * 1024 * 1024,
+        stats=None):
+    """Copies source to every sink until EOF, closing them at the end.
+    Every sink has its own writer thread and a queue of at most
+    buffer_size bytes, so a slow sink holds back the source only once its
+    buffer is full. A sink that fails (its reader exited) is dropped, and
+    reading stops when no sink is left. Returns the list of sinks that
+    failed. A consumer with an empty queue counts as waiting in stats."""
+    depth = max(buffer_size // chunk_size, 1)
+    queues = [Queue(depth) for x in sinks]
+    failed = []
+    if stats:
+        for i, queue in enumerate(queues):
+            stats.watch_consumer(i, queue.empty)
+
+    def write(sink, queue):
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+
+            if sink in failed:
+                # keep draining so the reader never blocks on us
+                continue
+
+            try:
+                sink.write(chunk)
+            except (OSError, ValueError):
+                failed.append(sink)
+
+        try:
+            sink.close()
+        except (OSError, ValueError):
+            pass
+
+    threads = [Thread(target=write, args=x) for x in zip(sinks, queues)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
     try:
-        splitter_index = argv.index("----")
-    except ValueError:
+        while len(failed) < len(sinks):
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+
+            for queue in queues:
+                queue.put(chunk)
+    finally:
+        for queue in queues:
+            queue.put(None)
+
+        for thread in threads:
+            thread.join()
+
+    return failed
+
+# options taking a value, and their defaults
+value_options = {
+    "--buffer-mb": default_buffer_mb,
+    "--pipe-size-kb": 0,
+    "--stats-interval": default_stats_interval,
+}
+
+def parse_options(argv):
+    options = {"del_last_arg": False, "stats": False}
+    for name, default in value_options.items():
+        options[name[2:].replace("-", "_")] = default
+
+    while argv and argv[0].startswith("--") and argv[0] != "----":
+        if argv[0] == "--del-last-arg":
+            options["del_last_arg"] = True
+            argv = argv[1:]
+        elif argv[0] == "--stats":
+            options["stats"] = True
+            argv = argv[1:]
+        elif argv[0] in value_options and len(argv) > 1:
+            options[argv[0][2:].replace("-", "_")] = int(argv[1])
+            argv = argv[2:]
+        else:
+            break
+
+    if options["del_last_arg"]:
+        argv = argv[:-1]
+
+    return options, argv
+
+def split_commands(argv):
+    commands = [[]]
+    for arg in argv:
+        if arg == "----":
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+
+    return commands
+
+def kill(p, name):
+    try:
+        if p and p.poll() is None:
+            print(name, "is still alive, killing...")
+            p.kill()
+    except Exception:
+        pass
+
+def main(argv):
+    options, argv = parse_options(argv)
+    if "----" not in argv:
         print("No splitter found.")
         sys.exit(1)
 
-    cmd1 = argv[:splitter_index]
-    cmd2 = argv[splitter_index+1:]
-    if not cmd1:
-        print("Command 1 is empty")
-        sys.exit(1)
+    commands = split_commands(argv)
+    for i, cmd in enumerate(commands):
+        if not cmd:
+            print("Command", i + 1, "is empty")
+            sys.exit(1)
 
-    if not cmd2:
-        print("Command 2 is empty")
-        sys.exit(1)
+    for i, cmd in enumerate(commands):
+        print("Command {0}:".format(i + 1), cmd)
 
-    print("Command 1:", cmd1)
-    print("Command 2:", cmd2)
+    if len(commands) > 2:
+        sys.exit(main_tee(commands[0], commands[1:], options))
 
+    cmd1, cmd2 = commands
+    pipe_size = options["pipe_size_kb"] * 1024
     p1 = None
     p2 = None
     try:
         p1 = subprocess.Popen(cmd1, stdout=subprocess.PIPE)
+        if pipe_size:
+            set_pipe_size(p1.stdout.fileno(), pipe_size)
+
         p2 = subprocess.Popen(cmd2, stdin=p1.stdout)
+        if options["stats"]:
+            sys.exit(wait_direct_stats(p1, p2, options["stats_interval"]))
+
         p1.stdout.close()
         p1.stdout = None
         p1.wait()
         p2.wait()
         sys.exit(p2.returncode)
     finally:
-        try:
-            if p1 and p1.poll():
-                print("Process 1 is still alive, killing...")
-                p1.kill()
-        except Exception:
-            pass
+        kill(p1, "Process 1")
+        kill(p2, "Process 2")
 
-        try:
-            if p2 and p2.poll():
-                print("Process 2 is still alive, killing...")
-                p2.kill()
-        except Exception:
-            pass
+def wait_direct_stats(p1, p2, interval):
+    """Waits for the commands of a direct pipe, looking at it meanwhile.
+    Returns the exit code of the consumer."""
+    # piper keeps the read end until the consumer exits, otherwise the
+    # producer would never see it go
+    fd = p1.stdout.fileno()
+    stats = PipeStats([p1, p2], interval)
+    stats.watch_producer(pipe_check(fd, True))
+    stats.watch_consumer(0, pipe_check(fd, False))
+    stats.start_sampling()
+    wait_process(p2, stats, 1)
+    stats.stop()
+    p1.stdout.close()
+    p1.stdout = None
+    wait_process(p1, stats, 0)
+    stats.print_summary()
+    return p2.returncode
+
+def main_tee(producer_cmd, consumer_cmds, options):
+    """Decodes once, feeds every consumer. Returns the first non-zero exit
+    code of the consumers, or that of the producer."""
+    pipe_size = options["pipe_size_kb"] * 1024
+    producer = None
+    consumers = []
+    stats = None
+    try:
+        producer = subprocess.Popen(producer_cmd, stdout=subprocess.PIPE)
+        for cmd in consumer_cmds:
+            consumers.append(subprocess.Popen(cmd, stdin=subprocess.PIPE))
+
+        if pipe_size:
+            for f in [producer.stdout] + [p.stdin for p in consumers]:
+                set_pipe_size(f.fileno(), pipe_size)
+
+        if options["stats"]:
+            stats = PipeStats([producer] + consumers,
+                              options["stats_interval"])
+            stats.watch_producer(pipe_check(producer.stdout.fileno(), True))
+            stats.start_sampling()
+
+        failed = tee(producer.stdout, [p.stdin for p in consumers],
+                     options["buffer_mb"] * 1024 * 1024, stats)
+        if len(failed) == len(consumers):
+            # nobody is reading anymore
+            producer.kill()
+
+        if stats:
+            stats.stop()
+
+        codes = [wait_process(p, stats, i + 1)
+                 for i, p in enumerate(consumers)]
+        producer.stdout.close()
+        code = wait_process(producer, stats, 0)
+        for i, x in enumerate(codes):
+            if x:
+                print("Command {0} exited with code {1}".format(i + 2, x))
+
+        if stats:
+            stats.print_summary()
+
+        failures = [x for x in codes if x]
+        return failures and failures[0] or code
+    finally:
+        kill(producer, "Process 1")
+        for i, p in enumerate(consumers):
+            kill(p, "Process {0}".format(i + 2))
 
 
 def piper_subcommand():
@@ -0,0 +1,126 @@
+import os
+import re
+
+__all__ = ["CpuAllocator", "placement_supported", "parse_cpulist",
+           "numa_nodes", "set_affinity", "set_process_affinity"]
+
+placement_policies = ["spread", "node"]
+
+def placement_supported():
+    return hasattr(os, "sched_setaffinity")
+
+def parse_cpulist(s):
+    cpus = []
+    for part in s.strip().split(","):
+        if not part:
+            continue
+
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += range(int(first), int(last) + 1)
+        else:
+            cpus.append(int(part))
+
+    return cpus
+
+def numa_nodes(sys_dir="/sys/devices/system/node"):
+    """{node id: [cpu, ...]} limited to the cpus this process may use. Falls
+    back to a single node if the kernel doesn't expose the topology."""
+    allowed = set(os.sched_getaffinity(0))
+    nodes = {}
+    if os.path.isdir(sys_dir):
+        for name in os.listdir(sys_dir):
+            m = re.match(r"node(\d+)$", name)
+            if not m:
+                continue
+
+            with open(os.path.join(sys_dir, name, "cpulist"), "r") as f:
+                cpus = [x for x in parse_cpulist(f.read()) if x in allowed]
+
+            if cpus:
+                nodes[int(m.group(1))] = cpus
+
+    return nodes or {0: sorted(allowed)}
+
+def set_affinity(pid, cpus):
+    os.sched_setaffinity(pid, cpus)
+
+def set_process_affinity(pid, cpus):
+    """Moves every thread of a running process to cpus."""
+    task_dir = "/proc/{0}/task".format(pid)
+    tids = os.path.isdir(task_dir) and os.listdir(task_dir) or [pid]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(int(tid), cpus)
+        except OSError:
+            # exited meanwhile
+            pass
+
+class CpuAllocator:
+    """Hands out disjoint cpu sets to running encodes.
+
+    "node" keeps a set on the NUMA node with the most free cpus, so the
+    encode's memory is allocated locally (first touch); "spread" takes free
+    cpus from all nodes. When there are no free cpus left, share() hands
+    out the least loaded ones instead."""
+
+    def __init__(self, nodes=None):
+        self.nodes = nodes or numa_nodes()
+        # number of encodes pinned to each cpu
+        self.load = dict([(x, 0) for v in self.nodes.values() for x in v])
+
+    def free(self, node):
+        return [x for x in self.nodes[node] if not self.load[x]]
+
+    def allowed(self, allowed_nodes):
+        return [k for k in sorted(self.nodes)
+                if allowed_nodes is None or k in allowed_nodes]
+
+    def allocate(self, count, policy="node", allowed_nodes=None):
+        """Free cpus for an encode, None if there are none."""
+        nodes = self.allowed(allowed_nodes)
+        if not nodes:
+            return None
+
+        if policy == "node":
+            node = max(nodes, key=lambda k: len(self.free(k)))
+            cpus = self.free(node)[:count]
+        else:
+            cpus = []
+            # round robin over nodes
+            pools = [self.free(k) for k in nodes]
+            while len(cpus) < count and any(pools):
+                for pool in pools:
+                    if pool and len(cpus) < count:
+                        cpus.append(pool.pop(0))
+
+        if not cpus:
+            return None
+
+        return self.take(cpus)
+
+    def share(self, count, policy="node", allowed_nodes=None):
+        """The least loaded cpus (of the least loaded node with "node"),
+        for an encode that allocate() found no free cpus for."""
+        nodes = self.allowed(allowed_nodes)
+        if not nodes:
+            return None
+
+        if policy == "node":
+            nodes = [min(nodes, key=lambda k: float(
+                sum([self.load[x] for x in self.nodes[k]])) /
+                len(self.nodes[k]))]
+
+        pool = [x for k in nodes for x in self.nodes[k]]
+        return self.take(sorted(pool, key=lambda x: self.load[x])[:count])
+
+    def take(self, cpus):
+        for x in cpus:
+            self.load[x] += 1
+
+        return sorted(cpus)
+
+    def release(self, cpus):
+        for x in cpus:
+            if self.load.get(x):
+                self.load[x] -= 1
@@ -0,0 +1,226 @@
+import ctypes
+import os
+import platform
+import re
+import signal
+import tempfile
+
+__all__ = ["priority_levels", "process_args", "process_tree",
+           "create_cgroup", "remove_cgroup", "suspend_supported",
+           "suspend_processes", "resume_processes"]
+
+priority_levels = ["idle", "below_normal", "normal", "above_normal", "high"]
+
+# Windows priority classes, passed as creationflags
+priority_classes = {
+    "idle": 0x40,
+    "below_normal": 0x4000,
+    "normal": 0x20,
+    "above_normal": 0x8000,
+    "high": 0x80,
+}
+
+# POSIX: nice level, (io scheduling class, level) and cgroup v2 cpu.weight.
+# Raising the priority above normal needs CAP_SYS_NICE, without it the
+# process just keeps the runner's nice level.
+nice_values = {
+    "idle": 19,
+    "below_normal": 10,
+    "normal": 0,
+    "above_normal": -5,
+    "high": -10,
+}
+
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+ioprio_values = {
+    "idle": (IOPRIO_CLASS_IDLE, 0),
+    "below_normal": (IOPRIO_CLASS_BE, 7),
+    "normal": (IOPRIO_CLASS_BE, 4),
+    "above_normal": (IOPRIO_CLASS_BE, 2),
+    "high": (IOPRIO_CLASS_BE, 0),
+}
+
+cpu_weights = {
+    "idle": 1,
+    "below_normal": 50,
+    "normal": 100,
+    "above_normal": 200,
+    "high": 500,
+}
+
+ioprio_syscalls = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+}
+
+cpu_max_period = 100000
+
+libc = None
+cgroup_warned = False
+
+def ioprio_set(ioclass, level):
+    nr = ioprio_syscalls.get(platform.machine())
+    if not libc or not nr:
+        return
+
+    libc.syscall(nr, IOPRIO_WHO_PROCESS, 0,
+                 (ioclass << IOPRIO_CLASS_SHIFT) | level)
+
+def write_cgroup_file(path, name, value):
+    with open(os.path.join(path, name), "w") as f:
+        f.write(value)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+
+    return True
+
+def remove_stale_cgroups(root):
+    """Removes the empty cgroups left behind by processes that are gone,
+    the ones of running runners are theirs to remove."""
+    for name in os.listdir(root):
+        m = re.match(r"enc-(\d+)-", name)
+        if not name.startswith("enc-") or m and pid_alive(int(m.group(1))):
+            continue
+
+        try:
+            # fails while a process is still in it
+            os.rmdir(os.path.join(root, name))
+        except OSError:
+            pass
+
+def create_cgroup(root):
+    """Creates a cgroup under root for the processes of one task (or of
+    one encode outside the task runner), returns its path, or None if root
+    isn't usable. remove_cgroup() removes it once they have exited."""
+    global cgroup_warned
+    if os.name == "nt":
+        return None
+
+    try:
+        remove_stale_cgroups(root)
+        try:
+            write_cgroup_file(root, "cgroup.subtree_control", "+cpu")
+        except OSError:
+            # already enabled, or managed by someone else
+            pass
+
+        return tempfile.mkdtemp(prefix="enc-{0}-".format(os.getpid()),
+                                dir=root)
+    except OSError as e:
+        if not cgroup_warned:
+            cgroup_warned = True
+            print("Warning: Can't set up cgroup in", root, "-", e)
+
+        return None
+
+def remove_cgroup(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        # a process is still in it, remove_stale_cgroups() gets it later
+        pass
+
+def set_cgroup_limits(path, weight, max_cores=None):
+    try:
+        write_cgroup_file(path, "cpu.weight", str(weight))
+        write_cgroup_file(path, "cpu.max", "{0} {1}".format(
+            max_cores and int(max_cores * cpu_max_period) or "max",
+            cpu_max_period))
+    except OSError:
+        pass
+
+def process_args(priority, cgroup=None, cpu_weight=None, cpu_max=None):
+    """Keyword arguments for Popen that start a process with priority,
+    inside cgroup (see create_cgroup) if given."""
+    global libc
+    if os.name == "nt":
+        return {"creationflags": priority_classes[priority]}
+
+    if libc is None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+        except OSError:
+            libc = False
+
+    if cgroup:
+        # every process of the task shares the cgroup, the limits are
+        # those of the last one started
+        set_cgroup_limits(cgroup, cpu_weight or cpu_weights[priority],
+                          cpu_max)
+
+    def preexec():
+        # runs in the child, errors must not prevent x264 from starting
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice_values[priority])
+        except OSError:
+            pass
+
+        ioprio_set(*ioprio_values[priority])
+        if cgroup:
+            try:
+                write_cgroup_file(cgroup, "cgroup.procs", "0")
+            except OSError:
+                pass
+
+    return {"preexec_fn": preexec}
+
+def process_tree(pid):
+    """pid followed by all its descendants, parents first. Only Linux
+    exposes the process tree, elsewhere that's just pid."""
+    pids = [pid]
+    if not os.path.isdir("/proc"):
+        return pids
+
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open(os.path.join("/proc", name, "stat"), "r") as f:
+                # the command name may contain spaces and parentheses
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+
+        children.setdefault(ppid, []).append(int(name))
+
+    i = 0
+    while i < len(pids):
+        pids += children.get(pids[i], [])
+        i += 1
+
+    return pids
+
+def suspend_supported():
+    return hasattr(signal, "SIGSTOP")
+
+def signal_processes(procs, sig):
+    for p in list(procs):
+        if p.poll() is not None:
+            continue
+
+        for pid in process_tree(p.pid):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+def suspend_processes(procs):
+    signal_processes(procs, signal.SIGSTOP)
+
+def resume_processes(procs):
+    signal_processes(procs, signal.SIGCONT)
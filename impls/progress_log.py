@@ -0,0 +1,65 @@
+import os
+from threading import Lock
+from time import time
+
+__all__ = ["ProgressSampler", "ProgressTrack"]
+
+class ProgressSampler:
+    """Decides which progress events are worth logging: at most one every
+    interval seconds and/or every step percent. With neither set every
+    event is logged."""
+
+    def __init__(self, interval=None, step=None):
+        self.interval = interval
+        self.step = step
+        self.last_time = None
+        self.last_percent = None
+
+    def due(self, event):
+        now = time()
+        percent = event.percent
+        if self.last_time is not None:
+            if self.interval and now - self.last_time < self.interval:
+                return False
+
+            if self.step and percent is not None and \
+               self.last_percent is not None and \
+               percent - self.last_percent < self.step:
+                return False
+
+        self.last_time = now
+        if percent is not None:
+            self.last_percent = percent
+
+        return True
+
+class ProgressTrack:
+    """Progress of an encode as CSV, one row per sampled progress event.
+    Shared by the segments of a pass, so writes are locked."""
+
+    columns = ["time", "pass", "segment", "percent", "frames", "total",
+               "fps", "kbps", "eta"]
+
+    def __init__(self, name, append=False):
+        new = not append or not os.path.isfile(name)
+        self.file = open(name, append and "a" or "w")
+        self.lock = Lock()
+        self.start = time()
+        self.current_pass = ""
+        if new:
+            self.file.write(",".join(self.columns) + "\n")
+
+    def write(self, event, segment=None):
+        values = [round(time() - self.start, 1), self.current_pass,
+                  segment, event.percent, event.frames, event.total,
+                  event.fps, event.kbps, event.eta]
+        line = ",".join(["" if x is None else str(x) for x in values])
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,92 @@
+import os
+import re
+
+__all__ = ["host_memory", "x264_memory", "parse_resolution",
+           "resource_names", "format_bytes"]
+
+# resources the task runner hands out besides the slots
+resource_names = ["mem", "io"]
+
+# used when the resolution of an input isn't known yet
+assumed_resolution = (1920, 1080)
+
+resolution_pat = re.compile(r"^(\d+)x(\d+)")
+
+def host_memory():
+    """Physical memory in bytes, None if it can't be found out."""
+    if hasattr(os, "sysconf"):
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError):
+            return None
+
+    if os.name == "nt":
+        import ctypes
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong),
+                        ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong),
+                        ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong),
+                        ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong),
+                        ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+
+    return None
+
+def parse_resolution(resolution):
+    """(width, height) of "1920x1080p" as x264 prints it, or None."""
+    m = resolution and resolution_pat.match(resolution)
+    if not m:
+        return None
+
+    return int(m.group(1)), int(m.group(2))
+
+def option(cmdline, name, default):
+    # x264 takes the last one
+    values = re.findall(r"(?:^|\s)" + re.escape(name) + r"[\s=]+(\d+)",
+                        cmdline)
+    return values and int(values[-1]) or default
+
+def x264_memory(cmdline, resolution=None, cores=1):
+    """Rough peak memory in bytes of x264 running cmdline on an input of
+    resolution ("1920x1080p"). Every frame x264 holds at full resolution
+    is counted: references, B-frames waiting to be encoded, one per frame
+    thread and the lookahead queue."""
+    width, height = parse_resolution(resolution) or assumed_resolution
+    pixels = width * height
+    depth = 1
+    if re.search(r"--(input|output|bit)-depth[\s=]+1[0-6]\b|high10",
+                 cmdline):
+        depth = 2
+
+    ref = option(cmdline, "--ref", 3)
+    bframes = option(cmdline, "--bframes", 3)
+    lookahead = option(cmdline, "--rc-lookahead", 40)
+    if re.search(r"--no-mbtree\b", cmdline) and \
+       not re.search(r"--vbv-maxrate[\s=]+[1-9]", cmdline):
+        # only used for frame type decision then
+        lookahead = min(lookahead, bframes + 1)
+
+    threads = option(cmdline, "--threads", 0) or int(cores * 1.5)
+    sync_lookahead = option(cmdline, "--sync-lookahead", bframes + 1)
+    # the picture with 3 half-pel planes and per macroblock data
+    reference_frames = (ref + bframes + threads + 1) * pixels * depth * 4.5
+    # the picture and its quarter resolution copies
+    lookahead_frames = (lookahead + sync_lookahead) * pixels * depth * 2.5
+    return int(32 * 1024 * 1024 + reference_frames + lookahead_frames)
+
+def format_bytes(n):
+    for unit in ["B", "K", "M"]:
+        if n < 1024:
+            return "{0}{1}".format(int(n), unit)
+
+        n /= 1024.0
+
+    return "{0:.1f}G".format(n)
@@ -0,0 +1,653 @@
+import os
+from heapq import heappush, heappop, heapify, nsmallest
+from queue import Queue, Empty
+from time import time
+from uuid import uuid4
+from .utils import AttrDict
+from .placement import CpuAllocator, placement_supported
+from .dag import task_depends, find_cycle, downstream_lengths
+
+__all__ = ["Scheduler", "Runner", "task_states", "cpu_count",
+           "thread_share", "task_priority"]
+
+task_states = AttrDict({(k, k) for k in ["waiting",
+                                         "running",
+                                         "completed",
+                                         "error"]})
+
+# how many of the most urgent tasks of a slot class are looked at when the
+# first one doesn't fit into the free resources
+backfill_depth = 32
+
+# suspended processes don't do I/O but keep their memory
+released_when_suspended = ["io"]
+
+# upper bound of a single wait, so that the main thread stays responsive to
+# Ctrl-C on platforms where blocking waits can't be interrupted
+idle_timeout = 5
+
+def cpu_count():
+    if hasattr(os, "sched_getaffinity"):
+        # respects taskset / container cpu sets
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+def thread_share(cores, slot, max_slots):
+    return max(1, min(cores, cores * slot // max(max_slots, 1)))
+
+def task_priority(t):
+    return t.get("priority", 0)
+
+class Runner(AttrDict):
+    """Display state of a running task, written by its encode thread."""
+    def __init__(self, task, tag):
+        self.task = task
+        self.tag = tag
+        self.msg = ""
+        self.title_msg = ""
+        self.encode_result = None
+        # metrics records of the passes run by the encode, see metrics.py
+        self.metrics = []
+        # last progress event of the encode, see x264_output.py
+        self.progress = None
+        # x264 thread budget, None to let x264 decide
+        self.threads = None
+        # cpu set the encode is pinned to
+        self.cpus = None
+        # resources (see Scheduler) taken by the task
+        self.resources = {}
+        # processes started by the encode, and when they were suspended
+        self.procs = []
+        self.suspended_at = None
+        # suspended by pause(), stays suspended until unpause()
+        self.paused = False
+        self.started_at = time()
+        # set for tasks leased to a remote worker
+        self.worker = None
+        # identifies the lease, so a worker whose lease expired and was
+        # handed to another one can't report on the task anymore
+        self.lease_token = None
+        self.lease_timeout = 0
+        self.lease_expiry = 0
+
+class Scheduler:
+    """Single threaded scheduler. All task state changes happen on the
+    thread calling run(); encode threads only post events to it.
+
+    Waiting tasks whose dependencies are satisfied are kept in one heap per
+    slot class, ordered by priority, then longest first by estimate(t) if
+    given, then list position. With critical_path, the length is that of
+    the longest chain of dependents the task starts (in estimated seconds,
+    then in tasks), so the tasks holding up most of the remaining work run
+    first. Tasks still waiting for dependencies are parked under each
+    unfinished parent, so picking the next task never scans the whole task
+    list. Tasks in a dependency cycle fail.
+
+    When a task can't start because lower priority tasks hold the slots,
+    those are suspended (see suspend/resume) and resumed once the slots are
+    free again.
+
+    Besides the slots, tasks can be limited by capacity, {resource: limit}
+    (e.g. memory), resources(t) returning what t needs of each. A task only
+    starts if its needs fit into what running tasks leave free, otherwise
+    a less demanding task of the same priority that fits is started
+    instead. A task that doesn't fit even on an idle machine runs alone."""
+
+    def __init__(self,
+                 tasks,
+                 max_slots,
+                 launch,
+                 on_change=None,
+                 on_redraw=None,
+                 refresh_rate=1,
+                 keep_alive=False,
+                 cores=None,
+                 placement=None,
+                 suspend=None,
+                 resume=None,
+                 estimate=None,
+                 critical_path=False,
+                 resources=None,
+                 capacity=None):
+        self.tasks = tasks
+        self.max_slots = max_slots
+        self.slots = max_slots
+        self.launch = launch
+        self.on_change = on_change or (lambda: None)
+        self.on_redraw = on_redraw or (lambda: None)
+        self.refresh_rate = refresh_rate
+        self.keep_alive = keep_alive
+        self.cores = cores
+        self.placement = placement
+        self.allocator = None
+        if placement and placement_supported():
+            self.allocator = CpuAllocator()
+        self.suspend = suspend
+        self.resume = resume
+        self.estimate = estimate
+        self.critical_path = critical_path
+        self.resources = resources
+        self.capacity = dict([(k, v) for k, v in (capacity or {}).items()
+                              if v])
+        self.used = dict([(k, 0) for k in self.capacity])
+        self.events = Queue()
+        self.runners = {}
+        self.exit_code = None
+        self.handlers = {
+            "output": self.handle_output,
+            "exit": self.handle_exit,
+            "call": self.handle_call,
+            "wake": lambda: None,
+        }
+        self.rebuild()
+
+    def rebuild(self):
+        self.index = {}
+        self.position = {}
+        self.dependents = {}
+        self.ready = {}
+        self.lengths = None
+        for i, t in enumerate(self.tasks):
+            self.index[t.id] = t
+            self.position[t.id] = i
+
+        self.fail_cycles()
+        for t in self.tasks:
+            if t.state == task_states.waiting:
+                self.enqueue(t)
+
+    def fail_cycles(self):
+        while True:
+            cycle = find_cycle([t for t in self.tasks
+                                if t.state == task_states.waiting])
+            if not cycle:
+                return
+
+            for id in cycle:
+                self.index[id].set_state(task_states.error,
+                                         "dependency cycle")
+
+    def length(self, t):
+        """(seconds, tasks) t is ordered by in the ready heap."""
+        if not self.critical_path:
+            return (self.estimate and self.estimate(t) or 0, 0)
+
+        if self.lengths is None:
+            def weight(x):
+                if x.state in (task_states.waiting, task_states.running):
+                    return self.estimate and self.estimate(x)
+
+            self.lengths = downstream_lengths(self.tasks, weight)
+
+        return self.lengths.get(t.id, (0, 1))
+
+    def enqueue(self, t):
+        deps = [self.index.get(id) for id in task_depends(t)]
+        if None in deps:
+            t.set_state(task_states.error, "dependency not found")
+            self.fail_dependents(t)
+            return
+
+        for dep in deps:
+            if dep.state == task_states.error:
+                t.set_state(dep.state, dep.state_message)
+                self.fail_dependents(t)
+                return
+
+        pending = [dep for dep in deps if dep.state != task_states.completed]
+        if pending:
+            for dep in pending:
+                self.dependents.setdefault(dep.id, []).append(t)
+
+            return
+
+        secs, count = self.length(t)
+        heappush(self.ready.setdefault(t.slot, []),
+                 (-task_priority(t), -secs, -count, self.position[t.id],
+                  t.id))
+
+    def add_task(self, t):
+        self.index[t.id] = t
+        self.position[t.id] = len(self.tasks) - 1
+        # chains of the tasks it depends on got longer
+        self.lengths = None
+        if t.state == task_states.waiting:
+            self.enqueue(t)
+
+    def fail_dependents(self, t):
+        for child in self.dependents.pop(t.id, []):
+            if child.state == task_states.waiting:
+                child.set_state(t.state, t.state_message)
+                self.fail_dependents(child)
+
+    def active_runners(self):
+        return [r for r in self.runners.values()
+                if not r.worker and not r.suspended_at]
+
+    def demand(self, t):
+        if not self.capacity or not self.resources:
+            return {}
+
+        return self.resources(t) or {}
+
+    def fits(self, demand, names=None):
+        if names is None:
+            names = self.capacity
+
+        for name in names:
+            if name in self.capacity and \
+               self.used[name] + demand.get(name, 0) > self.capacity[name]:
+                return False
+
+        return True
+
+    def acquire(self, runner, names=None):
+        if names is None:
+            names = self.capacity
+
+        for name in names:
+            if name in self.used:
+                self.used[name] += runner.resources.get(name, 0)
+
+    def release(self, runner, names=None):
+        if names is None:
+            names = self.capacity
+
+        for name in names:
+            if name in self.used:
+                self.used[name] -= runner.resources.get(name, 0)
+
+    def startable(self, t):
+        return t and t.state == task_states.waiting and not t.get("paused")
+
+    def backfill(self, heap):
+        """Most urgent entry of heap with the priority of the first one
+        whose task fits into the free resources, None if there is none."""
+        for entry in nsmallest(backfill_depth, heap):
+            if entry[0] != heap[0][0]:
+                break
+
+            t = self.index.get(entry[-1])
+            if self.startable(t) and self.fits(self.demand(t)):
+                return entry
+
+        return None
+
+    def peek(self, avail_slots=None, idle=None, local=True):
+        """Heap entry of the most urgent task that fits (by priority, then
+        length), ties go to the smallest slot class. Tasks run by this
+        process (local) must fit into the free resources too."""
+        ready_slots = sorted([k for k, v in self.ready.items() if v])
+        if not ready_slots:
+            return None
+
+        if avail_slots is None:
+            avail_slots = self.slots
+            idle = not self.active_runners()
+
+        if idle:
+            # make sure at least 1 task can be run
+            avail_slots = max(ready_slots[-1], avail_slots)
+
+        best = None
+        for slot in ready_slots:
+            if slot > avail_slots:
+                break
+
+            heap = self.ready[slot]
+            while heap and not self.startable(self.index.get(heap[0][-1])):
+                heappop(heap)
+
+            if not heap:
+                continue
+
+            entry = heap[0]
+            if local and not idle and self.capacity and \
+               not self.fits(self.demand(self.index[entry[-1]])):
+                entry = self.backfill(heap)
+
+            if entry and (best is None or entry[:3] < best[:3]):
+                best = entry
+
+        return best
+
+    def pick(self, avail_slots=None, idle=None, local=True):
+        entry = self.peek(avail_slots, idle, local)
+        if entry is None:
+            return None
+
+        t = self.index[entry[-1]]
+        heap = self.ready[t.slot]
+        if heap[0] is entry:
+            heappop(heap)
+        else:
+            heap.remove(entry)
+            heapify(heap)
+
+        return t
+
+    def preempt(self):
+        """Suspends running tasks of lower priority than the most urgent
+        ready task, if that makes room for it."""
+        if not self.suspend:
+            return False
+
+        entry = self.peek(float("inf"))
+        if entry is None:
+            return False
+
+        t = self.index[entry[-1]]
+        active = self.active_runners()
+        victims = [r for r in active
+                   if task_priority(r.task) < task_priority(t)]
+        # least urgent, most recently added first
+        victims.sort(key=lambda r: (task_priority(r.task),
+                                    -self.position[r.task.id]))
+        chosen = []
+        free = self.slots
+        for r in victims:
+            if free >= t.slot:
+                break
+
+            chosen.append(r)
+            free += r.task.slot
+
+        if not chosen or (free < t.slot and len(chosen) < len(active)):
+            return False
+
+        for r in chosen:
+            self.suspend_runner(r)
+
+        return True
+
+    def suspend_runner(self, runner):
+        self.suspend(runner)
+        runner.suspended_at = time()
+        self.slots += runner.task.slot
+        self.release(runner, released_when_suspended)
+        self.unplace(runner)
+        runner.task.set_state(task_states.running, "suspended")
+
+    def resume_runner(self, runner):
+        t = runner.task
+        self.slots -= t.slot
+        self.acquire(runner, released_when_suspended)
+        t.set_state(task_states.running)
+        self.place(runner, adjust_threads=False)
+        self.resume(runner)
+        t.suspended_secs = t.get("suspended_secs", 0) + \
+                           time() - runner.suspended_at
+        runner.suspended_at = None
+
+    def resume_suspended(self):
+        """Resumes the most urgent suspended task if it fits and nothing
+        more urgent is waiting."""
+        suspended = [r for r in self.runners.values()
+                     if r.suspended_at and not r.paused]
+        if not suspended:
+            return False
+
+        runner = min(suspended, key=lambda r: (-task_priority(r.task),
+                                               self.position[r.task.id]))
+        entry = self.peek(float("inf"))
+        if entry is not None and -entry[0] > task_priority(runner.task):
+            return False
+
+        if (runner.task.slot > self.slots or
+            not self.fits(runner.resources, released_when_suspended)) and \
+           self.active_runners():
+            return False
+
+        self.resume_runner(runner)
+        return True
+
+    def pause(self, t):
+        """Keeps t from starting, or suspends it if it's running, until
+        unpause(t)."""
+        runner = self.runners.get(t.id)
+        if runner:
+            if runner.worker or not self.suspend:
+                raise ValueError("Task {0} can't be paused while running"
+                                 .format(runner.tag))
+
+            if not runner.suspended_at:
+                self.suspend_runner(runner)
+
+            runner.paused = True
+            t.state_message = "paused"
+        elif t.state != task_states.waiting:
+            raise ValueError("Only waiting or running tasks can be paused")
+
+        t.paused = True
+
+    def unpause(self, t):
+        t.paused = False
+        runner = self.runners.get(t.id)
+        if runner:
+            # resumed by start_ready() once its slots are free
+            runner.paused = False
+            t.state_message = "suspended"
+        elif t.state == task_states.waiting:
+            self.enqueue(t)
+
+    def start_ready(self):
+        started = False
+        while self.exit_code is None and self.max_slots > 0:
+            if self.resume_suspended():
+                started = True
+                continue
+
+            t = self.pick()
+            if not t:
+                if self.preempt():
+                    started = True
+                    continue
+
+                break
+
+            t.set_state(task_states.running)
+            self.slots -= t.slot
+            runner = Runner(t, str(self.position[t.id]))
+            runner.threads = self.thread_budget(t)
+            runner.resources = self.demand(t)
+            self.acquire(runner)
+            self.place(runner)
+            self.runners[t.id] = runner
+            self.launch(self, runner)
+            started = True
+
+        if started:
+            self.on_change()
+
+    def has_ready(self):
+        return any(self.ready.values())
+
+    def thread_budget(self, t):
+        """Cores for a task that is being started: its slot's share of the
+        machine, or everything that is left if nothing else is queued.
+        x264 can't change its thread count later, so "rebalancing" happens
+        as tasks start and finish with the cores free at that moment."""
+        if not self.cores:
+            return None
+
+        used = sum([r.threads or 0 for r in self.active_runners()])
+        free = max(self.cores - used, 1)
+        if not self.has_ready():
+            return free
+
+        return min(thread_share(self.cores, t.slot, self.max_slots), free)
+
+    def place(self, runner, adjust_threads=True):
+        if not self.allocator:
+            return
+
+        policy, nodes = self.placement(runner.task)
+        if not policy:
+            return
+
+        t = runner.task
+        count = runner.threads or \
+                thread_share(cpu_count(), t.slot, self.max_slots)
+        runner.cpus = self.allocator.allocate(count, policy, nodes)
+        if not runner.cpus:
+            # more tasks than cpus, share the least loaded ones rather than
+            # leaving the encode unpinned
+            runner.cpus = self.allocator.share(count, policy, nodes)
+            if runner.cpus:
+                t.state_message = "sharing cpus " + \
+                                  ",".join(map(str, runner.cpus))
+
+        if runner.cpus and runner.threads and adjust_threads:
+            runner.threads = len(runner.cpus)
+
+    def unplace(self, runner):
+        if runner.cpus:
+            self.allocator.release(runner.cpus)
+            runner.cpus = None
+
+    def post(self, *event):
+        self.events.put(event)
+
+    def abort(self, exit_code):
+        self.exit_code = exit_code
+        self.post("wake")
+
+    def call(self, func, timeout=None):
+        """Runs func on the scheduler thread and returns (ok, result), where
+        result is the error message if func raised. Raises queue.Empty if
+        the scheduler doesn't get to it within timeout."""
+        reply = Queue()
+        self.post("call", func, reply)
+        return reply.get(timeout=timeout)
+
+    def handle_call(self, func, reply):
+        try:
+            reply.put((True, func()))
+        except Exception as e:
+            reply.put((False, str(e)))
+
+    def handle_output(self, runner):
+        pass
+
+    def lease(self, worker, free_slots, max_slots, timeout):
+        """Hands a ready task to a remote worker. The task is put back into
+        the queue if the lease isn't renewed within timeout seconds."""
+        t = self.pick(free_slots, free_slots >= max_slots, local=False)
+        if not t:
+            return None
+
+        t.set_state(task_states.running, "on " + worker)
+        runner = Runner(t, str(self.position[t.id]))
+        runner.worker = worker
+        runner.lease_token = uuid4().hex
+        runner.lease_timeout = timeout
+        runner.lease_expiry = time() + timeout
+        self.runners[t.id] = runner
+        self.on_change()
+        return runner
+
+    def renew(self, id, token):
+        """Extends the lease of task id, returns None if token isn't the
+        current lease of the task."""
+        runner = self.runners.get(id)
+        if not runner or not runner.worker or runner.lease_token != token:
+            return None
+
+        runner.lease_expiry = time() + runner.lease_timeout
+        return runner
+
+    def requeue(self, runner, message=''):
+        t = runner.task
+        self.runners.pop(t.id, None)
+        t.set_state(task_states.waiting, message)
+        self.enqueue(t)
+        self.on_change()
+
+    def expire_leases(self):
+        now = time()
+        for runner in list(self.runners.values()):
+            if runner.worker and runner.lease_expiry < now:
+                self.requeue(runner,
+                             "requeued, lost " + runner.worker)
+
+    def handle_exit(self, runner, ret, error=None):
+        t = runner.task
+        self.runners.pop(t.id, None)
+        if runner.suspended_at:
+            # killed while suspended, its slots are already free
+            t.suspended_secs = t.get("suspended_secs", 0) + \
+                               time() - runner.suspended_at
+            self.release(runner, [x for x in self.capacity
+                                  if x not in released_when_suspended])
+        elif not runner.worker:
+            self.slots += t.slot
+            self.release(runner)
+            self.unplace(runner)
+
+        if runner.metrics:
+            t.metrics = runner.metrics
+
+        if ret is None:
+            # interrupted, leave the task for the next run
+            return
+
+        if ret or error:
+            t.set_state(task_states.error,
+                        error or "code {0}, {1}".format(ret, runner.msg))
+            self.fail_dependents(t)
+        else:
+            t.set_state(task_states.completed)
+            if runner.encode_result:
+                t.encode_result = runner.encode_result
+                t.state_message = "{fps} fps, {bitrate} kbps" \
+                                  .format(**runner.encode_result)
+
+            for child in self.dependents.pop(t.id, []):
+                # the last parent to complete queues it
+                if child.state == task_states.waiting and \
+                   all([self.index[id].state == task_states.completed
+                        for id in task_depends(child)
+                        if id in self.index]):
+                    self.enqueue(child)
+
+        self.on_change()
+
+    def run(self):
+        try:
+            self.run_loop()
+        finally:
+            # suspended encodes can't notice that we are exiting
+            for runner in list(self.runners.values()):
+                if runner.suspended_at:
+                    self.resume_runner(runner)
+
+        self.on_redraw()
+        return self.exit_code
+
+    def run_loop(self):
+        self.start_ready()
+        self.on_redraw()
+        dirty = False
+        next_redraw = time() + self.refresh_rate
+        while (self.runners or self.keep_alive) and self.exit_code is None:
+            if dirty:
+                timeout = max(next_redraw - time(), 0)
+            else:
+                timeout = idle_timeout
+
+            try:
+                event = self.events.get(timeout=timeout)
+            except Empty:
+                pass
+            else:
+                self.handlers[event[0]](*event[1:])
+                self.start_ready()
+                dirty = True
+
+            self.expire_leases()
+
+            if dirty and time() >= next_redraw:
+                self.on_redraw()
+                dirty = False
+                next_redraw = time() + self.refresh_rate
@@ -0,0 +1,141 @@
+import os
+import re
+import shutil
+from bisect import bisect_left
+
+__all__ = ["segment_ranges", "read_keyframes", "find_cmdline_arg",
+           "rewrite_segment_cmdline", "join_segments", "segment_file"]
+
+default_keyint = 250
+
+def find_cmdline_arg(cmdline, name):
+    """Returns the value of the last occurrence of a x264 option in
+    a rendered command line, or None if it isn't there."""
+    matches = re.findall(r'(?:^| ){}\s+("[^"]*"|\S+)'.format(re.escape(name)),
+                         cmdline)
+    if not matches:
+        return None
+
+    return matches[-1].strip('"')
+
+def read_keyframes(qpfile):
+    keyframes = []
+    with open(qpfile, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1] in ("I", "K"):
+                try:
+                    keyframes.append(int(parts[0]))
+                except ValueError:
+                    pass
+
+    keyframes.sort()
+    return keyframes
+
+def segment_ranges(total_frames, count, keyframes=None, keyint=None):
+    """Splits [0, total_frames) into at most count ranges.
+
+    Boundaries are snapped to the nearest keyframe from the qpfile if one
+    is within half a GOP, otherwise to a multiple of keyint, so that every
+    segment starts where the unsegmented encode would likely place an IDR
+    frame anyway."""
+    keyint = keyint or default_keyint
+    keyframes = keyframes or []
+    bounds = [0]
+    for i in range(1, count):
+        target = int(round(total_frames * i / count))
+        boundary = target - target % keyint
+        pos = bisect_left(keyframes, target)
+        candidates = keyframes[max(pos - 1, 0):pos + 1]
+        candidates = [k for k in candidates if abs(k - target) <= keyint // 2]
+        if candidates:
+            boundary = min(candidates, key=lambda k: abs(k - target))
+
+        if bounds[-1] < boundary < total_frames:
+            bounds.append(boundary)
+
+    bounds.append(total_frames)
+    return [(bounds[i], bounds[i+1] - bounds[i])
+            for i in range(len(bounds) - 1)]
+
+def sample_ranges(total_frames, count, frames):
+    """count ranges of frames each, spread evenly over the input, or None
+    if they would cover all of it anyway."""
+    if count * frames >= total_frames:
+        return None
+
+    step = total_frames / count
+    return [(int(step * i + (step - frames) / 2), frames)
+            for i in range(count)]
+
+def segment_file(file_name, index):
+    """out.264 -> out.seg000.264"""
+    return "{0}.seg{1:03d}.264".format(os.path.splitext(file_name)[0], index)
+
+def _shift_qpfile(src, dst, start, frames):
+    with open(src, "r") as fin, open(dst, "w") as fout:
+        for line in fin:
+            parts = line.split()
+            try:
+                n = int(parts[0])
+            except (ValueError, IndexError):
+                continue
+
+            if start <= n < start + frames:
+                fout.write(' '.join([str(n - start)] + parts[1:]) + "\n")
+
+def _shift_zones(zones, start, frames):
+    ret = []
+    for zone in zones.split("/"):
+        parts = zone.split(",", 2)
+        if len(parts) < 3:
+            continue
+
+        zone_start = max(int(parts[0]) - start, 0)
+        zone_end = min(int(parts[1]) - start, frames - 1)
+        if zone_start > zone_end:
+            continue
+
+        ret.append("{0},{1},{2}".format(zone_start, zone_end, parts[2]))
+
+    return "/".join(ret)
+
+def rewrite_segment_cmdline(cmdline, seg_out, start, frames,
+                            working_dir=None):
+    """Rewrites frame-numbered side files (qpfile, zones) in a rendered
+    command line so that they are relative to the segment. Relative paths
+    in cmdline are relative to working_dir, where x264 runs."""
+    qpfile = find_cmdline_arg(cmdline, "--qpfile")
+    if qpfile:
+        seg_qpfile = seg_out + ".qpfile"
+        _shift_qpfile(os.path.join(working_dir or "", qpfile), seg_qpfile,
+                      start, frames)
+        cmdline = re.sub(r'--qpfile\s+("[^"]*"|\S+)',
+                         lambda m: '--qpfile "{0}"'.format(seg_qpfile),
+                         cmdline)
+
+    zones = find_cmdline_arg(cmdline, "--zones")
+    if zones:
+        seg_zones = _shift_zones(zones, start, frames)
+        cmdline = re.sub(r' --zones\s+("[^"]*"|\S+)',
+                         lambda m: seg_zones and
+                                   ' --zones "{0}"'.format(seg_zones) or '',
+                         cmdline)
+
+    return cmdline
+
+def join_segments(seg_files, out_file):
+    """Concatenates raw H.264 elementary streams. Every segment starts with
+    its own SPS/PPS and an IDR frame, so plain concatenation is valid.
+    The segments and the files of their passes are removed."""
+    with open(out_file, "wb") as fout:
+        for name in seg_files:
+            with open(name, "rb") as fin:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+
+    for name in seg_files:
+        os.remove(name)
+        for f in [name + ".qpfile", name + ".x264_stats",
+                  name + ".x264_stats.mbtree", name + ".bitrate.txt"]:
+            if os.path.isfile(f):
+                os.remove(f)
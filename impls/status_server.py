@@ -0,0 +1,197 @@
+import hmac
+import json
+import re
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+from socketserver import ThreadingMixIn
+from threading import Thread, Condition, Lock
+from time import time
+
+__all__ = ["StatusServer"]
+
+control_pat = re.compile(r"^/tasks/(\d+)/(pause|resume|reset)$")
+task_pat = re.compile(r"^/tasks/(\d+)$")
+
+# SSE comment sent when there's nothing new, so proxies keep the stream
+keepalive_secs = 15
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        # the status display owns the console
+        pass
+
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        """Whether the request carries the server's token, as a bearer
+        token or (for EventSource, which can't set headers) a token query
+        parameter. Anything goes if the server has none."""
+        token = self.server.token
+        if not token:
+            return True
+
+        given = self.headers.get("Authorization", "")
+        if given.startswith("Bearer "):
+            given = given[len("Bearer "):]
+        else:
+            query = parse_qs(self.path.partition("?")[2])
+            given = query.get("token", [""])[0]
+
+        if hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+            return True
+
+        self.send_json({"error": "Invalid token"}, 401)
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path == "/events":
+            self.stream_events()
+            return
+
+        if path in ("", "/status"):
+            self.send_json(self.server.status())
+            return
+
+        m = task_pat.match(path)
+        if m:
+            tasks = self.server.status().get("tasks", [])
+            index = int(m.group(1))
+            if index < len(tasks):
+                self.send_json(tasks[index])
+            else:
+                self.send_json({"error": "No such task"}, 404)
+
+            return
+
+        self.send_json({"error": "Not found"}, 404)
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+
+        # a form on another site can't send a JSON content type without
+        # the browser asking first (CORS preflight), which is never allowed
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != \
+           "application/json":
+            self.send_json({"error": "Content-Type must be "
+                                     "application/json"}, 415)
+            return
+
+        m = control_pat.match(self.path.split("?", 1)[0].rstrip("/"))
+        if not m:
+            self.send_json({"error": "Not found"}, 404)
+            return
+
+        reply = self.server.control(m.group(2), m.group(1))
+        self.send_json(reply, "error" in reply and 409 or 200)
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        server = self.server
+        with server.cond:
+            server.clients += 1
+            seq = server.seq
+
+        try:
+            while not server.closed:
+                with server.cond:
+                    server.cond.wait_for(
+                        lambda: server.seq != seq or server.closed,
+                        keepalive_secs)
+                    events = server.seq != seq and server.events or []
+                    seq = server.seq
+
+                if events:
+                    data = "".join(["event: progress\ndata: {0}\n\n"
+                                    .format(json.dumps(x)) for x in events])
+                else:
+                    data = ": keepalive\n\n"
+
+                self.wfile.write(data.encode("utf-8"))
+                self.wfile.flush()
+        except OSError:
+            # client went away
+            pass
+        finally:
+            with server.cond:
+                server.clients -= 1
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    """HTTP/JSON view of the task runner.
+
+        GET /status, GET /tasks/<id>
+        GET /events (server-sent progress events)
+        POST /tasks/<id>/pause|resume|reset
+
+    snapshot() builds the status and runs on the scheduler thread, it is
+    called at most once every max_age seconds however often the status is
+    requested. control(command, id) returns a daemon reply. Progress events
+    are handed over by publish(), which does nothing while no client is
+    listening. With a token, every request must carry it (see
+    StatusHandler.authorized), POST requests must be application/json."""
+
+    daemon_threads = True
+
+    def __init__(self, address, snapshot, control, max_age=1, token=None):
+        HTTPServer.__init__(self, address, StatusHandler)
+        self.token = token
+        self.snapshot = snapshot
+        self.control = control
+        self.max_age = max_age
+        self.cache = None
+        self.cache_time = 0
+        self.cache_lock = Lock()
+        self.cond = Condition()
+        self.clients = 0
+        self.seq = 0
+        self.events = []
+        self.closed = False
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def status(self):
+        with self.cache_lock:
+            if self.cache is None or time() - self.cache_time >= self.max_age:
+                self.cache = self.snapshot()
+                self.cache_time = time()
+
+            return self.cache
+
+    def publish(self, make_events):
+        """make_events() is only called if somebody is listening."""
+        if not self.clients:
+            return
+
+        events = make_events()
+        if not events:
+            return
+
+        with self.cond:
+            self.events = events
+            self.seq += 1
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        self.shutdown()
+        self.server_close()
@@ -1,26 +1,43 @@
 from collections import UserDict
 import os
-import json
 import sys
+import tempfile
 from optparse import OptionParser
 from .utils import gen_cmd_line, AttrDict
-from .encx264_impl import encode, get_params, parse_encode_result_line
-from threading import Thread, Lock, Event
+from .encx264_impl import encode, get_params, parse_args, pop_arg, \
+                          task_thread_budget, cpu_placement, encode_targets, \
+                          task_status_http, task_order, history, \
+                          task_worker_token, cgroup_root, \
+                          pass1_cmdline, pass2_cmdline, \
+                          task_memory_limit_mb, task_io_limit_mbps
+from .x264_output import event_types
+from .placement import set_affinity, set_process_affinity
+from .priority import suspend_supported, suspend_processes, \
+                      resume_processes, process_tree, create_cgroup, \
+                      remove_cgroup
+from .scheduler import Scheduler, task_states, cpu_count
+from .resources import host_memory, x264_memory, format_bytes
+from .dag import task_depends, find_cycle, topological_order, \
+                 downstream_lengths
+from .taskdb import TaskStore
+from .ipc import IpcServer, local_address, ipc_request
+from .status_server import StatusServer
+from .group import encode_group, group_member_params
+from queue import Empty
+import socket
+import hmac
+import ipaddress
+from threading import Thread, Lock
 from uuid import uuid4
-from time import sleep
-from .console import clear as console_clear, colors as c_colors
-from .console import get_cursor_position, set_cursor_position, \
-                     get_text_color, set_text_color, \
-                     clear_line_remaining, set_title
+from time import sleep, time
+from datetime import timedelta
+from .console import colors as c_colors, get_text_color, set_text_color, \
+                     status_screen
 from io import StringIO
 import subprocess
 
 __all__ = ["task_do_command"]
 
-task_states = AttrDict({(k, k) for k in ["waiting",
-                                         "running",
-                                         "completed",
-                                         "error"]})
 
 state_colors = {
     task_states.error: c_colors.FOREGROUND_RED |
@@ -34,16 +51,30 @@ state_colors = {
 
 popen_lock = Lock()
 
-def popen_hook(*args, **kwargs):
-    creation_flags = kwargs.get("creationflags", 0)
-    # DETACHED_PROCESS, prevent x264 from changing console title
-    creation_flags |= 0x8
-    kwargs["creationflags"] = creation_flags
+def popen_hook(*args, cpus=None, **kwargs):
+    if os.name == "nt":
+        creation_flags = kwargs.get("creationflags", 0)
+        # DETACHED_PROCESS, prevent x264 from changing console title
+        creation_flags |= 0x8
+        kwargs["creationflags"] = creation_flags
+
+    if cpus:
+        preexec = kwargs.get("preexec_fn")
+        def pin():
+            # children (piper, frameservers) inherit the cpu set
+            set_affinity(0, cpus)
+            if preexec:
+                preexec()
+
+        kwargs["preexec_fn"] = pin
 
     # hack for fixing http://bugs.python.org/issue12739
     with popen_lock:
         return subprocess.Popen(*args, **kwargs)
 
+dirty_tasks = {}
+pending_ops = []
+
 class Task(AttrDict):
     def __init__(self,
                  params=None,
@@ -52,7 +83,7 @@ class Task(AttrDict):
                  working_dir=None,
                  state=task_states.waiting,
                  data=None):
-        self.id = str(uuid4())
+        dict.__setitem__(self, "id", str(uuid4()))
         self.params = params
         self.slot = slot
         self.state = state
@@ -62,6 +93,13 @@ class Task(AttrDict):
         if data:
             self.update(data)
 
+    def __setitem__(self, key, value):
+        # remember what changed so task_save() only journals the delta
+        dict.__setitem__(self, key, value)
+        dirty_tasks.setdefault(self["id"], (self, set()))[1].add(key)
+
+    __setattr__ = __setitem__
+
     def set_state(self, state, message=''):
         self.state = state
         self.state_message = message
@@ -80,11 +118,15 @@ tasks = []
 task_save_lock = Lock()
 
 default_task_file = os.getenv("ENCX264_TASK_FILE") or \
-                    os.path.expandvars("%TEMP%\\.encx264_task")
+                    os.path.join(tempfile.gettempdir(), ".encx264_task")
+
+task_store = TaskStore(default_task_file)
 
-def task_add_internal(params, slot=1, depends=None):
+def task_add_internal(params, slot=1, depends=None, target=None):
     t = Task(params, slot=slot, depends=depends, working_dir=os.path.abspath("."))
+    t.target = target
     tasks.append(t)
+    pending_ops.append(("add", t))
     return t
     
 def task_add(params):
@@ -96,113 +138,435 @@ def task_add(params):
     if "pass2" in p.params:
         if "--pass" not in params and "--1pass-only" not in params:
             t1 = task_add_internal(["--1pass-only"] + params,
-                                   p.params.get("slot_pass1", 1))
+                                   p.params.get("slot_pass1", 1),
+                                   target=p.target)
             task_add_internal(["--pass", "2", "--append-log"] + params,
                               p.params.get("slot_pass2", 2),
-                              depends=t1.id)
+                              depends=[t1.id],
+                              target=p.target)
         else:
             task_add_internal(params,
                               p.params.get(
                                   "slot_pass" + str(p.passN),
-                                  p.passN))
+                                  p.passN),
+                              target=p.target)
     else:
-        task_add_internal(params, p.params.get("slot", 2))
+        task_add_internal(params, p.params.get("slot", 2), target=p.target)
+
+def task_add_group(args):
+    """add_group <targets separated by ","> <normal encode parameters>"""
+    if len(args) < 2:
+        print("Usage: add_group <targets separated by \",\"> "
+              "<encode parameters>")
+        return 1
+
+    members = group_member_params(args[0].split(","), args[1:])
+    if isinstance(members, str):
+        print(members)
+        return 1
+
+    slot = 0
+    for member in members:
+        params = encode_targets[member[0]]
+        if "pass2" in params:
+            slot += max(params.get("slot_pass1", 1),
+                        params.get("slot_pass2", 2))
+        else:
+            slot += params.get("slot", 2)
+
+    t = task_add_internal(args, slot=slot)
+    t.group = members
+
+def task_add_cmd(args):
+    """add_cmd <parent IDs separated by ","> <command>"""
+    if len(args) < 2:
+        print("Usage: add_cmd <parent IDs separated by \",\"> <command>")
+        return 1
+
+    parents = [tasks[int(x)].id for x in args[0].split(",") if x]
+    t = task_add_internal([], slot=0, depends=parents)
+    t.command = gen_cmd_line(args[1:])
+
+def task_set_depends(args):
+    """set_depends <task ID> [<parent IDs>]"""
+    t = tasks[int(args[0])]
+    depends = [tasks[int(x)].id for x in args[1:]]
+    cycle = find_cycle([x for x in tasks if x is not t] +
+                       [AttrDict(id=t.id, depends=depends)])
+    if cycle:
+        raise ValueError("Dependency cycle: " + " -> ".join(
+            [str(task_index(id)) for id in cycle + cycle[:1]]))
+
+    t.depends = depends
+
+def task_index(id):
+    for i, t in enumerate(tasks):
+        if t.id == id:
+            return i
+
+    return None
+
+def task_title(t):
+    if t.get("command"):
+        return "<cmd> " + t.command
+
+    if t.get("group"):
+        return "<group> " + gen_cmd_line(t.params)
+
+    return gen_cmd_line(t.params)
+
+def task_placement(t):
+    """(policy, allowed NUMA nodes) for the task's target, see
+    cpu_placement in encx264_defaults.py."""
+    params = encode_targets.get(t.get("target"), {})
+    return (params.get("cpu_placement", cpu_placement),
+            params.get("cpu_nodes"))
 
 def task_remove(ids):
     ids = list(ids)
     ids.sort(reverse=True)
     for id in ids:
+        pending_ops.append(("remove", tasks[id]))
         del tasks[id]
         
 def task_reset(ids):
     for id in ids:
         tasks[id].set_state(task_states.waiting)
 
-def task_list(print=print):
-    old_color = get_text_color()
+# (target, pass, input file, 1st pass only) of tasks by id
+task_info_cache = {}
+# (history version, seconds) by task id
+estimate_cache = {}
+# (history version, resources) by task id
+resource_cache = {}
+
+# inputs that are read by a frameserver instead of x264
+script_extensions = [".avs", ".avsi", ".vpy"]
+
+def task_info(t):
+    info = task_info_cache.get(t.id)
+    if info is None:
+        opt, args = parse_args(list(t.params))
+        target = opt.target or pop_arg(args)
+        in_file = opt.inFile or pop_arg(args)
+        if in_file:
+            in_file = os.path.abspath(os.path.join(t.working_dir or "",
+                                                   in_file))
+
+        info = (t.get("target") or target, opt.passN == 2 and "2" or "1",
+                in_file, opt.p1_only)
+        task_info_cache[t.id] = info
+
+    return info
+
+def task_estimate(t):
+    """Predicted seconds of t from the history of finished encodes, None
+    if nothing like it has run yet."""
+    if not history or t.get("command"):
+        return None
+
+    cached = estimate_cache.get(t.id)
+    if cached and cached[0] == history.version:
+        return cached[1]
+
+    target, pass_name, in_file, _ = task_info(t)
+    frames = history.input_frames(in_file)
+    resolution = history.input_resolution(in_file)
+    if t.get("group"):
+        # the members run side by side, each with all its passes
+        secs = 0
+        for member in t.group:
+            passes = "pass2" in encode_targets.get(member[0], {}) and \
+                     ["1", "2"] or ["1"]
+            member_secs = [predict_pass(member[0], x, frames, resolution)
+                           for x in passes]
+            if None in member_secs:
+                secs = None
+                break
+
+            secs = max(secs, sum(member_secs))
+    else:
+        secs = predict_pass(target, pass_name, frames, resolution)
+
+    estimate_cache[t.id] = (history.version, secs)
+    return secs
+
+def predict_pass(target, pass_name, frames, resolution):
+    """history.predict() from the passes at the input's resolution, or at
+    any resolution if it isn't known or target hasn't run at it yet."""
+    secs = None
+    if resolution:
+        secs = history.predict(target, pass_name, frames, resolution)
+
+    if secs is None:
+        secs = history.predict(target, pass_name, frames)
+
+    return secs
+
+def task_resources(t):
+    """{"mem": bytes, "io": bytes per second} t is expected to use, see
+    task_memory_limit_mb in encx264_defaults.py."""
+    if t.get("command"):
+        return {}
+
+    version = history and history.version
+    cached = resource_cache.get(t.id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    resources = {}
+    _, pass_name, in_file, _ = task_info(t)
+    if t.get("group"):
+        mems = [encode_memory(x, t.working_dir) for x in t.group]
+    else:
+        mems = [encode_memory(t.params, t.working_dir, pass_name)]
+
+    if None not in mems:
+        resources["mem"] = int(sum(mems))
+        secs = task_estimate(t)
+        if secs and os.path.splitext(in_file)[1].lower() not in \
+                    script_extensions:
+            resources["io"] = os.path.getsize(in_file) / secs
+
+    resource_cache[t.id] = (version, resources)
+    return resources
+
+def encode_memory(params, working_dir, pass_name=None):
+    """Estimated peak memory of the x264 of an encode, of its heavier pass
+    if pass_name isn't given. None if the parameters are invalid."""
+    p = get_params(list(params), print=lambda *args, **kwargs: None,
+                   working_dir=working_dir)
+    if not p:
+        return None
+
+    if pass_name is None:
+        pass_name = "pass2" in p.params and "2" or "1"
+
+    resolution = history and history.input_resolution(p.inFile)
+    cmdline = pass_name == "2" and pass2_cmdline(p) or pass1_cmdline(p)
+    mem = x264_memory(cmdline, resolution, cpu_count())
+    known = history and history.peak_rss(p.target, pass_name, resolution)
+    if known:
+        # what the earlier runs took, scaled to this resolution
+        rss, known_resolution = known
+        mem = rss * mem / x264_memory(cmdline, known_resolution, cpu_count())
+    elif p.opt.segments > 1:
+        mem *= min(p.opt.segment_workers or p.opt.segments, p.opt.segments)
+
+    return mem
+
+def task_capacity():
+    """Limits of the resources returned by task_resources()."""
+    mem = task_memory_limit_mb and task_memory_limit_mb * 1024 * 1024
+    if task_memory_limit_mb is None:
+        mem = host_memory()
+        mem = mem and mem * 0.8
+
+    return {"mem": mem, "io": task_io_limit_mbps * 1024 * 1024}
+
+def task_remaining(t, runner=None):
+    if runner:
+        if runner.progress and runner.progress.eta is not None:
+            return runner.progress.eta
+
+        secs = task_estimate(t)
+        return secs is not None and \
+               max(secs - (time() - runner.started_at), 0) or None
+
+    if t.state == task_states.waiting:
+        return task_estimate(t)
+
+    return None
+
+def queue_eta(runners, max_slots):
+    """(seconds until the queue is done, whether all tasks had an
+    estimate). Assumes the slots stay busy, so it's a rough guess."""
+    running = dict([(r.task.id, r) for r in runners])
+    longest = 0
+    work = 0
+    known = True
+    for t in tasks:
+        runner = running.get(t.id)
+        if not runner and t.state != task_states.waiting:
+            continue
+
+        secs = task_remaining(t, runner)
+        if secs is None:
+            known = False
+            continue
+
+        work += secs * t.slot
+        if runner:
+            longest = max(longest, secs)
+
+    return max(longest, work / max(max_slots, 1)), known
+
+def format_secs(secs):
+    return str(timedelta(seconds=int(secs)))
+
+def task_rows(runners=[]):
+    """Two rows of (color, text) for every task."""
+    running = dict([(r.task.id, r) for r in runners])
+    entries = []
     for i in range(len(tasks)):
         task = tasks[i]
         color = task.state in state_colors and \
                 state_colors[task.state] or \
                 state_colors[""]
-        set_text_color(color)
-        print("[{0}] {1}".format(i,
-                                 gen_cmd_line(task.params)))
-        
-        set_text_color(c_colors.FOREGROUND_INTENSITY)
-        print("    (", end='')
-        set_text_color(color)
-        print(task.get_state_display(), end='')
-        set_text_color(c_colors.FOREGROUND_INTENSITY)
-        print(") slot={slot},dir={dir}" \
-              .format(slot=task.slot, 
-                      dir=task.working_dir))
+        info = ") slot={slot},dir={dir}".format(slot=task.slot,
+                                                dir=task.working_dir)
+        if task.get("priority"):
+            info += ",priority={0}".format(task.priority)
+        if task.get("paused"):
+            info += ",paused"
+        if task_depends(task):
+            info += ",after={0}".format("+".join(
+                [str(task_index(id)) for id in task_depends(task)]))
+        if task.get("suspended_secs"):
+            info += ",suspended={0}s".format(int(task.suspended_secs))
+        runner = running.get(task.id)
+        if runner and runner.resources.get("mem"):
+            info += ",mem={0}".format(format_bytes(runner.resources["mem"]))
+        if task.state in (task_states.waiting, task_states.running):
+            remaining = task_remaining(task, runner)
+            if remaining is not None:
+                info += ",eta={0}".format(format_secs(remaining))
+
+        entries.append([
+            [(color, "[{0}] {1}".format(i, task_title(task)))],
+            [(c_colors.FOREGROUND_INTENSITY, "    ("),
+             (color, task.get_state_display()),
+             (c_colors.FOREGROUND_INTENSITY, info)],
+        ])
+
+    return entries
+
+def task_list(print=print):
+    old_color = get_text_color()
+    for entry in task_rows():
+        for row in entry:
+            for color, text in row:
+                set_text_color(color)
+                print(text, end='')
+
+            print("")
         
     set_text_color(old_color)
 
-def task_clear():
-    tasks[:] = []
+def task_dag(print=print):
+    """Tasks in dependency order, indented by their depth, and the critical
+    path of the remaining ones."""
+    order = topological_order(tasks)
+    depth = {}
+    for t in order:
+        depth[t.id] = max([depth.get(id, -1) + 1
+                           for id in task_depends(t)] + [0])
+        line = "{0}[{1}] {2}  {3}".format("  " * depth[t.id],
+                                          task_index(t.id),
+                                          t.get_state_display(),
+                                          task_title(t))
+        if task_depends(t):
+            line += "  <- " + " ".join(
+                [str(task_index(id)) for id in task_depends(t)])
+
+        print(line)
 
-def get_task_by_uuid(id):
-    l = [t for t in tasks if t.id == id]
-    if l:
-        return l[0]
+    cycle = find_cycle(tasks)
+    if cycle:
+        print("Dependency cycle:", " -> ".join(
+            [str(task_index(id)) for id in cycle + cycle[:1]]))
 
-def padded_print(*args, **kwargs):
-    if kwargs.get("end", "\n") == '':
-        print(*args, **kwargs)
+    remaining = [t for t in order
+                 if t.state in (task_states.waiting, task_states.running)]
+    if not remaining:
         return
-        
-    kwargs["end"] = ""
-    print(*args, **kwargs)
-    clear_line_remaining()
-
-def print_status(threads, state):
-    if "console_cleared" not in state:
-        console_clear()
-        state["console_cleared"] = True
-        
-    last_pos = get_cursor_position()
-    set_cursor_position(0, 0)
-        
-    task_list(padded_print)
 
-    title_msgs = []
+    lengths = downstream_lengths(remaining, task_estimate)
+    children = {}
+    for t in remaining:
+        for id in task_depends(t):
+            children.setdefault(id, []).append(t)
 
-    running_tasks_title_printed = False
-    for i in range(len(threads)):
-        thread_obj = threads[i][1]
-        msg = thread_obj.msg
-        if msg:
-            if not running_tasks_title_printed:
-                padded_print("")
-                padded_print("Running tasks:")
-                running_tasks_title_printed = True
-                
-            padded_print(msg)
+    roots = [t for t in remaining
+             if not [id for id in task_depends(t) if id in lengths]]
+    path = [max(roots, key=lambda t: lengths[t.id])]
+    while path[-1].id in children:
+        path.append(max(children[path[-1].id],
+                        key=lambda t: lengths[t.id]))
+
+    secs, _ = lengths[path[0].id]
+    print("")
+    print("Critical path:", " -> ".join(
+        [str(task_index(t.id)) for t in path]), end="")
+    print(secs and ", {0} estimated".format(format_secs(secs)) or "")
 
-        if thread_obj.title_msg:
-            title_msgs.append(thread_obj.title_msg)
+def task_pause(ids, paused):
+    for id in ids:
+        tasks[id].paused = paused
 
-    current_pos = get_cursor_position()
-    for i in range(last_pos[1] - current_pos[1]):
-        padded_print("")
+def task_clear():
+    tasks[:] = []
+    pending_ops.append(("clear", None))
+
+def print_status(runners, state):
+    if "screen" not in state:
+        state.screen = status_screen()
+
+    progress = []
+    title_msgs = []
+    color = c_colors.FOREGROUND_GREY
+    for runner in runners:
+        msg = runner.msg
+        if msg:
+            if not progress:
+                progress.append([])
+                progress.append([(color, "Running tasks:")])
+                
+            progress.append([(color, msg)])
 
-    set_cursor_position(*current_pos)
+        if runner.title_msg:
+            title_msgs.append(runner.title_msg)
 
     completed = len([t for t in tasks if t.state == task_states.completed])
     new_title = "ENCX264 - {0} / {1} completed" \
                 .format(completed, len(tasks))
 
+    eta, known = queue_eta(runners, state.get("max_slots", 1))
+    if eta:
+        new_title += " - ETA {0}{1}".format(format_secs(eta),
+                                            not known and "+" or "")
+
     if title_msgs:
         new_title += ' - ' + ' '.join(title_msgs)
-    set_title(new_title)
 
-def task_run_impl(self, global_state, tasks):
-    task_tag = ' '
+    state.screen.draw(task_rows(runners), progress, new_title)
+
+def run_task(runner, should_exit, on_output=None):
+    """Runs the encode of runner.task, returns (return code, error).
+    Raises MainThreadExiting once should_exit() returns True, and
+    KeyboardInterrupt if the encode was interrupted."""
+    current_task = runner.task
+    task_tag = runner.tag
+    def on_event(event):
+        if event.type == event_types.progress:
+            runner.progress = event
+            runner.title_msg = '[{0}] {1}'.format(
+                task_tag,
+                event.percent is None and
+                    "{0} frames".format(event.frames) or
+                    "{0:.1f}%".format(event.percent))
+        else:
+            runner.title_msg = ''
+
+        if event.type == event_types.summary:
+            runner.encode_result = {
+                "fps": event.fps,
+                "bitrate": int(event.kbps),
+                "frames": event.frames,
+            }
+
     def check_global_exit_code():
-        if global_state.exit_code is not None:
-            global_state.event.set()
+        if should_exit():
             raise MainThreadExiting()
             
     def print_hook(*args, **kwargs):
@@ -212,209 +576,543 @@ def task_run_impl(self, global_state, tasks):
         else:
             line = ' '.join(args).strip()
             if line:
-                self.msg = '[{0}] {1}'.format(task_tag, line)
+                runner.msg = '[{0}] {1}'.format(task_tag, line)
 
             if line.startswith("aborted at input"):
                 # x264's return code will be 0,
                 # so we must manually raise an error
                 raise KeyboardInterrupt()
 
-            if line.startswith("["):
-                percentage = line[1:line.index(']')]
-                self.title_msg = '[{0}] {1}'.format(task_tag, percentage)
-            else:
-                self.title_msg = ''
-
-            result = parse_encode_result_line(line)
-            if result:
-                self.encode_result = result
+            if on_output:
+                on_output()
 
     def int_handler():
         # re-raise so that the outer handler can catch it
         raise KeyboardInterrupt()
 
+    def runner_popen(*args, **kwargs):
+        p = popen_hook(*args, cpus=runner.cpus, **kwargs)
+        runner.procs.append(p)
+        if runner.suspended_at:
+            # started while the task was being suspended
+            suspend_processes([p])
+
+        return p
+
+    sleep(current_task.get("start_delay_secs", 0))
+    # one cgroup for every x264 the task starts
+    cgroup = cgroup_root and create_cgroup(cgroup_root)
     try:
-        while True:
-            current_task = None
-            check_global_exit_code()
-            
-            with global_state.lock:
-                if not any([t.state == task_states.waiting for t in tasks]):
-                    self.msg = ""
-                    global_state.event.set()
-                    return
-
-                if global_state.running_tasks > 0:
-                    avail_slots = global_state.slots
-                else:
-                    # make sure at least 1 task can be run
-                    avail_slots = max([t.slot for t in tasks])
-
-                for i in range(1, avail_slots + 1):
-                    avail_tasks = \
-                        [x for x in tasks
-                         if x.slot == i and x.state == task_states.waiting]
-                    
-                    for t in avail_tasks:
-                        if t.depends:
-                            dep = get_task_by_uuid(t.depends)
-                            if not dep:
-                                t.set_state(task_states.error, 
-                                            "dependency not found")
-                                continue
-
-                            if dep.state == task_states.error:
-                                t.set_state(dep.state, dep.state_message)
-                                global_state.event.set()
-                                continue
-
-                            if dep.state != task_states.completed:
-                                continue
-
-                        current_task = t
-                        t.set_state(task_states.running)
-                        global_state.slots -= i
-                        global_state.running_tasks += 1
-                        break
-
-                    if current_task:
-                        break
+        if current_task.get("command"):
+            ret = run_command(current_task, print_hook, runner_popen)
+        else:
+            if current_task.get("group"):
+                run, params = encode_group, current_task.group
+            else:
+                run, params = encode, current_task.params
 
-            task_save()
-            if not current_task:
-                self.msg = ""
-                global_state.event.wait()
-                with global_state.lock:
-                    global_state.event.clear()
-                
-                continue
+            ret = run(params,
+                      print_hook,
+                      working_dir=current_task.working_dir,
+                      int_handler=int_handler,
+                      Popen=runner_popen,
+                      threads=runner.threads,
+                      on_event=on_event,
+                      on_metrics=runner.metrics.append,
+                      cgroup=cgroup)
+    finally:
+        if cgroup:
+            remove_cgroup(cgroup)
 
-            task_tag = str(tasks.index(current_task))
-            sleep(current_task.get("start_delay_secs", 0))
-            ret = encode(current_task.params,
-                         print_hook,
-                         working_dir=current_task.working_dir,
-                         int_handler=int_handler,
-                         Popen=popen_hook)
-
-            if ret == -1073741510:
-                # STATUS_CONTROL_C_EXIT
-                raise KeyboardInterrupt
-            
-            if ret:
-                current_task.set_state(
-                        task_states.error, 
-                        "code {0}, {1}".format(ret, self.msg))
+    if ret == -1073741510:
+        # STATUS_CONTROL_C_EXIT
+        raise KeyboardInterrupt
+
+    # encode() returns None on success, None means interrupted from here on
+    ret = ret or 0
+    error = None
+    completion_cmd = current_task.get("completion_cmd", "")
+    if not ret and completion_cmd:
+        cmd = completion_cmd.format(
+            task_id=task_tag,
+            params=gen_cmd_line(current_task.params),
+        )
+        try:
+            if os.name == "nt":
+                subprocess.call("cmd /c" + cmd,
+                                creationflags=subprocess.CREATE_NEW_CONSOLE)
             else:
-                current_task.set_state(task_states.completed)
-                if self.encode_result:
-                    current_task.state_message = \
-                        "{fps} fps, {bitrate} kbps" \
-                            .format(**self.encode_result)
-                    self.encode_result = None
-
-                completion_cmd = current_task.get("completion_cmd", "")
-                if completion_cmd:
-                    try:
-                        subprocess.call(
-                            "cmd /c" + completion_cmd.format(
-                                task_id=tasks.index(current_task),
-                                params=gen_cmd_line(current_task.params),
-                            ),
-                            creationflags=subprocess.CREATE_NEW_CONSOLE,
-                        )
-                    except Exception as e:
-                        current_task.set_state(
-                            task_states.error,
-                            "Failed to run completion command: " + str(e),
-                        )
-
-            self.msg = ''
+                subprocess.call(cmd, shell=True)
+        except Exception as e:
+            error = "Failed to run completion command: " + str(e)
 
-            task_save()
-            with global_state.lock:
-                global_state.slots += current_task.slot
-                global_state.running_tasks -= 1
-                global_state.event.set()
+    return ret, error
+
+def run_command(t, print_hook, Popen):
+    """Runs the command of a task added by add_cmd, its output goes to
+    print_hook like x264's."""
+    p = Popen(t.command,
+              shell=True,
+              cwd=t.working_dir,
+              stdin=subprocess.DEVNULL,
+              stdout=subprocess.PIPE,
+              stderr=subprocess.STDOUT,
+              universal_newlines=True,
+              errors="replace")
+    try:
+        for line in p.stdout:
+            print_hook(line.rstrip())
+    except BaseException:
+        p.kill()
+        raise
+    finally:
+        p.stdout.close()
+
+    return p.wait()
+
+def encode_task_thread(scheduler, runner):
+    try:
+        ret, error = run_task(runner,
+                              lambda: scheduler.exit_code is not None,
+                              lambda: scheduler.post("output", runner))
+        scheduler.post("exit", runner, ret, error)
                 
     except KeyboardInterrupt:
-        task_save()
         print("Interrupted by user.")
-        global_state.exit_code = 1
-        return
+        scheduler.post("exit", runner, None)
+        scheduler.abort(1)
     except MainThreadExiting:
-        task_save()
-        return
+        scheduler.post("exit", runner, None)
     except Exception as e:
-        self.msg = str(e)
+        runner.msg = str(e)
+        scheduler.post("exit", runner, 0, str(e))
         raise
-        
+
+def launch_encode(scheduler, runner):
+    Thread(target=encode_task_thread, args=(scheduler, runner)).start()
+
+def suspend_encode(runner):
+    suspend_processes(runner.procs)
+
+def resume_encode(runner):
+    if runner.cpus:
+        # the cpus may have been given to another task meanwhile
+        for p in list(runner.procs):
+            if p.poll() is None:
+                for pid in process_tree(p.pid):
+                    set_process_affinity(pid, runner.cpus)
+
+    resume_processes(runner.procs)
     
-def task_run(max_slots=2, refresh_rate=1):
+def daemon_address():
+    return local_address(task_store.task_file + ".sock")
+
+def daemon_alive():
+    return ipc_request(daemon_address(), {"command": "ping"}) is not None
+
+def daemon_execute(scheduler, request):
+    command = request.get("command")
+    args = request.get("args", [])
+    if command == "ping":
+        return {}
+
+    if command in ("list", "dag"):
+        return {"tasks": tasks}
+
+    if command == "stop":
+        scheduler.abort(0)
+        return {"message": "Daemon is stopping"}
+
+    if command in ("pause", "resume"):
+        for x in args:
+            t = tasks[int(x)]
+            if command == "pause":
+                scheduler.pause(t)
+            else:
+                scheduler.unpause(t)
+
+        task_save()
+        return {}
+
+    if command in worker_commands:
+        return worker_commands[command](scheduler, request)
+
+    if command == "add":
+        for d in request["tasks"]:
+            t = Task(data=d)
+            tasks.append(t)
+            pending_ops.append(("add", t))
+            scheduler.add_task(t)
+    else:
+        idle_ids = [i for i in range(len(tasks))
+                    if tasks[i].state != task_states.running]
+        if command in ("remove", "reset"):
+            busy = [x for x in args if int(x) not in idle_ids]
+            if busy:
+                return {"error": "Task {0} is running".format(busy[0])}
+        elif command == "clear":
+            command, args = "remove", idle_ids
+        elif command == "reset_all":
+            command, args = "reset", idle_ids
+
+        task_commands(args)[command]()
+        scheduler.rebuild()
+
+    task_save()
+    return {}
+
+def worker_lease(scheduler, request):
+    runner = scheduler.lease(request["worker"],
+                             request["slots"],
+                             request["max_slots"],
+                             scheduler.lease_timeout)
+    if not runner:
+        return {}
+
+    return {"task": runner.task, "tag": runner.tag,
+            "lease_token": runner.lease_token}
+
+def worker_renew(scheduler, request):
+    return {"lost": [id for id, token in request["leases"]
+                     if not scheduler.renew(id, token)]}
+
+def worker_progress(scheduler, request):
+    runner = scheduler.renew(request["lease"], request.get("lease_token"))
+    if not runner:
+        return {"error": "lease expired"}
+
+    runner.msg = '{0}: {1}'.format(runner.worker, request["msg"])
+    runner.title_msg = request["title_msg"]
+    scheduler.post("output", runner)
+    return {}
+
+def worker_complete(scheduler, request):
+    runner = scheduler.renew(request["lease"], request.get("lease_token"))
+    if not runner:
+        return {"error": "lease expired"}
+
+    runner.msg = request["msg"]
+    runner.encode_result = request["encode_result"]
+    runner.metrics = request.get("metrics") or []
+    if request["ret"] is None:
+        scheduler.requeue(runner, "requeued, interrupted on " + runner.worker)
+    else:
+        scheduler.handle_exit(runner, request["ret"], request["error"])
+
+    return {}
+
+# requests from remote workers, see worker.py
+worker_commands = {
+    "lease": worker_lease,
+    "renew": worker_renew,
+    "progress": worker_progress,
+    "complete": worker_complete,
+}
+
+def worker_token():
+    return os.environ.get("ENCX264_WORKER_TOKEN") or task_worker_token
+
+def worker_handler(scheduler, token):
+    """Handler of the port workers connect to. It only answers worker
+    commands, and only with the shared token if there is one."""
+    def handler(request):
+        if token and not hmac.compare_digest(
+                str(request.get("auth") or "").encode("utf-8"),
+                token.encode("utf-8")):
+            return {"error": "Invalid worker token"}
+
+        if request.get("command") not in worker_commands:
+            return {"error": "Not a worker command"}
+
+        return daemon_handler(scheduler, request)
+
+    return handler
+
+def task_status(scheduler):
+    """Everything the status server exposes, built on the scheduler
+    thread."""
+    runners = dict([(r.task.id, r) for r in scheduler.runners.values()])
+    entries = []
+    for i, t in enumerate(tasks):
+        entry = {
+            "index": i,
+            "id": t.id,
+            "params": task_title(t),
+            "depends": [task_index(id) for id in task_depends(t)],
+            "state": t.state,
+            "state_message": t.state_message,
+            "slot": t.slot,
+            "priority": t.get("priority", 0),
+            "paused": bool(t.get("paused")),
+            "encode_result": t.get("encode_result"),
+            "metrics": t.get("metrics"),
+            "eta": None,
+        }
+        runner = runners.get(t.id)
+        if runner:
+            progress = runner.progress and runner.progress.as_dict()
+            entry.update({
+                "msg": runner.msg,
+                "progress": progress,
+                "encode_result": runner.encode_result,
+                "threads": runner.threads,
+                "resources": runner.resources,
+                "suspended": runner.suspended_at is not None,
+                "worker": runner.worker,
+            })
+
+        if t.state in (task_states.waiting, task_states.running):
+            entry["eta"] = task_remaining(t, runner)
+
+        entries.append(entry)
+
+    waiting = len([t for t in tasks if t.state == task_states.waiting])
+    eta, known = queue_eta(runners.values(), scheduler.max_slots)
+    return {
+        "tasks": entries,
+        "slots": scheduler.slots,
+        "max_slots": scheduler.max_slots,
+        "capacity": scheduler.capacity,
+        "used": scheduler.used,
+        "waiting": waiting,
+        "running": len(runners),
+        "queue_eta": eta,
+        # some tasks had no estimate, the queue takes longer than that
+        "queue_eta_partial": not known,
+    }
+
+def progress_events(runners, state):
+    """Progress of the runners that changed since the last call."""
+    sent = state.setdefault("sent_progress", {})
+    events = []
+    for runner in runners:
+        if runner.progress is None or sent.get(runner.task.id) is runner.progress:
+            continue
+
+        sent[runner.task.id] = runner.progress
+        event = runner.progress.as_dict()
+        event["task"] = runner.tag
+        event["id"] = runner.task.id
+        events.append(event)
+
+    return events
+
+def status_handlers(scheduler):
+    def snapshot():
+        try:
+            ok, result = scheduler.call(lambda: task_status(scheduler),
+                                        timeout=30)
+        except Empty:
+            return {"error": "The task runner is not responding"}
+
+        return ok and result or {"error": result}
+
+    def control(command, index):
+        return daemon_handler(scheduler, {"command": command,
+                                          "args": [index]})
+
+    return snapshot, control
+
+def daemon_handler(scheduler, request):
+    try:
+        ok, result = scheduler.call(
+            lambda: daemon_execute(scheduler, request), timeout=30)
+    except Empty:
+        return {"error": "The daemon is not responding"}
+
+    if not ok:
+        return {"error": result}
+
+    return result
+
+def task_forward_command(command, args):
+    """Sends a command to the running daemon, returns None if there is no
+    daemon."""
+    global tasks
+    if not daemon_alive():
+        return None
+
+    request = {"command": command, "args": args}
+    if command in ("add", "add_cmd", "add_group"):
+        # parameters are validated here, relative to the caller's directory
+        tasks = []
+        if command == "add_cmd":
+            # parent IDs are indexes into the daemon's list
+            reply = ipc_request(daemon_address(), {"command": "list"},
+                                timeout=60)
+            if reply is None:
+                print("Lost connection to the task daemon")
+                return 1
+
+            tasks = [Task(data=d) for d in reply["tasks"]]
+
+        known = len(tasks)
+        if task_commands(args)[command]():
+            return 1
+
+        request = {"command": "add", "args": args, "tasks": tasks[known:]}
+
+    reply = ipc_request(daemon_address(), request, timeout=60)
+    if reply is None:
+        print("Lost connection to the task daemon")
+        return 1
+
+    if "error" in reply:
+        print(reply["error"])
+        return 1
+
+    if command in ("list", "dag"):
+        tasks = [Task(data=d) for d in reply["tasks"]]
+        task_commands(args)[command]()
+    elif reply.get("message"):
+        print(reply["message"])
+
+    return 0
+    
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+def task_run(max_slots=2,
+             refresh_rate=1,
+             daemon=False,
+             listen=None,
+             lease_timeout=60):
+    if daemon_alive():
+        print("The task daemon is already running")
+        return 1
+
+    if listen:
+        listen = parse_address(listen)
+        if not worker_token() and not is_loopback(listen[0]):
+            print("Listening on", listen[0], "needs a worker token, set "
+                  "task_worker_token in encx264_targets.py or "
+                  "ENCX264_WORKER_TOKEN")
+            return 1
+
+    status_address = None
+    if task_status_http:
+        host, _, port = task_status_http.rpartition(":")
+        status_address = (host or "127.0.0.1", int(port))
+        if not worker_token() and not is_loopback(status_address[0]):
+            print("Serving status on", status_address[0], "needs a worker "
+                  "token, set task_worker_token in encx264_targets.py or "
+                  "ENCX264_WORKER_TOKEN")
+            return 1
+
     for t in tasks:
         if t.state == task_states.running:
             t.set_state(task_states.waiting)
 
-    state = AttrDict()
-    state.lock = Lock()
-    state.event = Event()
-    state.slots = max_slots
-    state.exit_code = None
-    state.running_tasks = 0
+    state = AttrDict(max_slots=max_slots)
+    status_server = None
+    def redraw():
+        runners = list(scheduler.runners.values())
+        print_status(runners, state)
+        if status_server:
+            status_server.publish(lambda: progress_events(runners, state))
+
+    scheduler = Scheduler(tasks,
+                          max_slots,
+                          launch_encode,
+                          on_change=task_save,
+                          on_redraw=redraw,
+                          refresh_rate=refresh_rate,
+                          keep_alive=daemon,
+                          cores=task_thread_budget and cpu_count() or None,
+                          placement=task_placement,
+                          suspend=suspend_supported() and suspend_encode
+                                  or None,
+                          resume=resume_encode,
+                          estimate=task_order == "critical_path" and
+                                   task_estimate or None,
+                          critical_path=task_order == "critical_path",
+                          resources=task_resources,
+                          capacity=task_capacity())
+    scheduler.lease_timeout = lease_timeout
 
-    threads = []
+    servers = []
+    handler = lambda request: daemon_handler(scheduler, request)
+    if daemon:
+        servers.append(IpcServer(
+            hasattr(socket, "AF_UNIX") and daemon_address() or
+                ("127.0.0.1", 0),
+            handler,
+            local_path=task_store.task_file + ".sock").start())
+
+    if listen:
+        servers.append(IpcServer(
+            listen, worker_handler(scheduler, worker_token())).start())
+
+    if status_address:
+        token = not is_loopback(status_address[0]) and worker_token() or None
+        status_server = StatusServer(status_address,
+                                     *status_handlers(scheduler),
+                                     max_age=refresh_rate, token=token)
+        servers.append(status_server.start())
 
     try:
-        for i in range(max_slots):
-            thread_state = AttrDict({
-                "id": i, "msg": "", 
-                "title_msg": "",
-            })
-            thread = Thread(target=task_run_impl,
-                            args=(thread_state, state, tasks))
-            thread.start()
-            threads.append((thread, thread_state))
-
-        while any([t[0].is_alive() for t in threads]):
-            print_status(threads, state)
-            if state.exit_code is not None:
-                state.event.set()
-                task_save()
-                sys.exit(state.exit_code)
-                
-            sleep(refresh_rate)
+        exit_code = scheduler.run()
+        if exit_code:
+            task_save()
+            sys.exit(exit_code)
 
-        print_status(threads, state)
         print("")
-        print("All tasks are completed")
+        print(daemon and "Daemon stopped" or "All tasks are completed")
             
     except KeyboardInterrupt:
+        scheduler.exit_code = 1
         task_save()
         print("Interrupted by user.")
-        state.exit_code = 1
-        state.event.set()
         sys.exit(1)
+    finally:
+        for server in servers:
+            server.close()
 
-def task_save(task_file=default_task_file):
+def task_save():
     with task_save_lock:
-        if tasks:
-            with open(task_file, "w") as f:
-                json.dump(tasks, f)
+        records = []
+        added = set()
+        for op, t in pending_ops:
+            if op == "add":
+                records.append({"op": op, "task": t})
+                added.add(t.id)
+            elif op == "remove":
+                records.append({"op": op, "id": t.id})
+            else:
+                records.append({"op": op})
+
+        alive = None
+        if pending_ops:
+            alive = set([t.id for t in tasks])
+
+        for id, (t, keys) in dirty_tasks.items():
+            if id in added or (alive is not None and id not in alive):
+                continue
+
+            records.append({"op": "set", "id": id,
+                            "data": {k: t[k] for k in keys if k in t}})
+
+        pending_ops[:] = []
+        dirty_tasks.clear()
+
+        if not tasks or task_store.should_compact():
+            task_store.compact(tasks)
         else:
-            if os.path.isfile(task_file):
-                os.remove(task_file)
+            task_store.append(records)
 
 def task_load(task_file=default_task_file):
-    global tasks
-    if os.path.isfile(task_file):
-        try:
-            with open(task_file, "r") as f:
-                tasks = json.load(f, object_hook=lambda d:Task(data=d))
-        except ValueError:
-            print("Warning: The task database is corrupted")
-            tasks = []
-    else:
-        tasks = []
+    global tasks, task_store
+    task_store = TaskStore(task_file)
+    tasks = task_store.load(lambda d: Task(data=d))
+    pending_ops[:] = []
+    dirty_tasks.clear()
 
 def task_set_param(param_name, *args):
     args = list(args)
@@ -448,46 +1146,112 @@ def task_help():
     print("Commands:")
     print("list")
     print("add <normal encode parameters>")
+    print("add_group <targets separated by \",\"> "
+          "<normal encode parameters>")
+    print(   "    * Encodes the input to all targets at once, running the")
+    print(   "      frameserver (frameserver_cmd) once for all of them")
+    print("add_cmd <parent IDs separated by \",\"> <command>")
+    print(   "    * Runs the command once all parent tasks are completed,")
+    print(   "      it doesn't take a slot")
+    print("set_depends <task ID> [<parent IDs>]")
+    print(   "    * The task starts once all parent tasks are completed")
+    print("dag")
+    print(   "    * Shows the tasks in dependency order and the critical path")
     print("remove <one or more task IDs>")
     print("clear")
     print("reset <one or more task IDs>")
     print("reset_all")
     print("clear")
     print("set_start_delay [<optional task ID>] <delay seconds>")
+    print("set_priority [<optional task ID>] <priority>")
+    print("pause <one or more task IDs>")
+    print("resume <one or more task IDs>")
+    print(   "    * Paused tasks don't start, running ones are suspended")
+    print(   "    * Tasks with higher priority run first, running tasks with")
+    print(   "      lower priority are suspended to make room for them")
     print("set_completion_cmd [<optional task ID>] <command>")
     print(   "    * You can use following parameter placeholders in command:")
     print(   "        # {param}")
     print(   "        # {task_id}")
     print(r"""    ex: encx264 !task set_completion_cmd echo {param}""")
     print("run [max slots] [output refresh rate]")
+    print("daemon [max slots] [output refresh rate]")
+    print(   "    * Like run, but keeps running and accepts list/add/remove/")
+    print(   "      clear/reset/set_* commands while tasks are running")
+    print("stop")
+    print(   "    * Stops the task daemon")
+    print("serve <[host:]port> [max local slots] [output refresh rate]")
+    print(   "    * Like daemon, and hands tasks to workers connecting to port")
+    print("worker <coordinator host:port> [max slots] [worker name]")
+    print(   "    * Runs tasks leased from a coordinator started with serve")
 
-def task_do_command():
-    if len(sys.argv) < 3:
-        task_help()
-        return
-    
-    command = sys.argv[2]
-    args = sys.argv[3:]
-    commands = {
+def task_worker(address, max_slots=2, name=None):
+    from .worker import run_worker
+    return run_worker(parse_address(address), int(max_slots), name,
+                      worker_token())
+
+def parse_run_args(args):
+    return [("." in x and float or int)(x) for x in args]
+
+def task_commands(args):
+    return {
         "help": task_help,
         "list": task_list,
         "add": lambda: task_add(args),
+        "add_cmd": lambda: task_add_cmd(args),
+        "add_group": lambda: task_add_group(args),
+        "set_depends": lambda: task_set_depends(args),
+        "dag": task_dag,
         "remove": lambda: task_remove([int(x) for x in args]),
         "clear": task_clear,
         "reset": lambda: task_reset([int(x) for x in args]),
         "reset_all": lambda: task_reset(range(len(tasks))),
         "set_start_delay": 
             lambda: task_set_param("start_delay_secs", *[int(x) for x in args]),
+        "set_priority":
+            lambda: task_set_param("priority", *[int(x) for x in args]),
         "set_completion_cmd": lambda: task_set_completion_cmd(*args),
-        "run": lambda: eval('task_run(' + ','.join(args) + ')')
+        "pause": lambda: task_pause([int(x) for x in args], True),
+        "resume": lambda: task_pause([int(x) for x in args], False),
+        "run": lambda: task_run(*parse_run_args(args)),
+        "daemon": lambda: task_run(*parse_run_args(args), daemon=True),
+        "stop": lambda: print("The task daemon is not running"),
+        "serve": lambda: task_run(*parse_run_args(args[1:] or ["0"]),
+                                  daemon=True, listen=args[0]),
+        "worker": lambda: task_worker(*args),
     }
+
+# commands that go to the daemon instead of the task file if it's running
+daemon_commands = ["list", "add", "add_cmd", "add_group", "remove", "clear",
+                   "reset", "reset_all", "set_start_delay", "set_priority",
+                   "set_completion_cmd", "set_depends", "dag", "pause",
+                   "resume", "stop"]
+
+def task_do_command():
+    if len(sys.argv) < 3:
+        task_help()
+        return
+    
+    command = sys.argv[2]
+    args = sys.argv[3:]
+    commands = task_commands(args)
     if command not in commands:
         print("Invalid command", command)
         task_help()
         return 1
 
+    if command in daemon_commands:
+        ret = task_forward_command(command, args)
+        if ret is not None:
+            sys.exit(ret)
+
     task_load()
-    ret = commands[command]()
+    try:
+        ret = commands[command]()
+    except ValueError as e:
+        print(e)
+        return 1
+
     task_save()
 
     sys.exit(ret)
@@ -0,0 +1,109 @@
+import json
+import os
+
+__all__ = ["TaskStore"]
+
+class TaskStore:
+    """Task database made of a snapshot and an append-only journal.
+
+    The snapshot is the plain JSON list older versions wrote, so existing
+    databases load as-is. State changes are appended to <file>.journal as
+    one JSON object per line, and folded into a new snapshot once the
+    journal grows past compact_threshold records. Replaying a record twice
+    is harmless, so a crash between writing the snapshot and removing the
+    journal doesn't lose anything."""
+
+    def __init__(self, task_file, compact_threshold=1000):
+        self.task_file = task_file
+        self.journal_file = task_file + ".journal"
+        self.compact_threshold = compact_threshold
+        self.journal_records = 0
+
+    def load(self, make_task):
+        tasks = []
+        if os.path.isfile(self.task_file):
+            try:
+                with open(self.task_file, "r") as f:
+                    tasks = [make_task(d) for d in json.load(f)]
+            except ValueError:
+                print("Warning: The task database is corrupted")
+                tasks = []
+
+        self.journal_records = 0
+        if os.path.isfile(self.journal_file):
+            good_size = 0
+            with open(self.journal_file, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # the last write was interrupted
+                        break
+
+                    good_size += len(line)
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        continue
+
+                    tasks = self.replay(tasks, record, make_task)
+                    self.journal_records += 1
+
+            if good_size != os.path.getsize(self.journal_file):
+                with open(self.journal_file, "r+b") as f:
+                    f.truncate(good_size)
+
+        return tasks
+
+    def replay(self, tasks, record, make_task):
+        op = record.get("op")
+        if op == "clear":
+            return []
+
+        if op == "add":
+            t = make_task(record["task"])
+            for i in range(len(tasks)):
+                if tasks[i]["id"] == t["id"]:
+                    tasks[i] = t
+                    break
+            else:
+                tasks.append(t)
+        elif op == "set":
+            for t in tasks:
+                if t["id"] == record["id"]:
+                    dict.update(t, record["data"])
+                    break
+        elif op == "remove":
+            tasks = [t for t in tasks if t["id"] != record["id"]]
+
+        return tasks
+
+    def append(self, records):
+        if not records:
+            return
+
+        # one write per batch, a torn tail is cut off by load()
+        with open(self.journal_file, "a") as f:
+            f.write(''.join([json.dumps(r) + "\n" for r in records]))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.journal_records += len(records)
+
+    def should_compact(self):
+        return self.journal_records >= self.compact_threshold
+
+    def compact(self, tasks):
+        if tasks:
+            tmp_file = self.task_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(tasks, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_file, self.task_file)
+        elif os.path.isfile(self.task_file):
+            os.remove(self.task_file)
+
+        if os.path.isfile(self.journal_file):
+            os.remove(self.journal_file)
+
+        self.journal_records = 0
@@ -1,3 +1,5 @@
+import os
+import shlex
 from collections import UserDict
 
 class AttrDict(dict):
@@ -9,3 +11,26 @@ class AttrDict(dict):
 def gen_cmd_line(args):
     return ' '.join([(' ' in x or x == "") and \
                      ('"{0}"'.format(x)) or x for x in args])
+
+def split_cmd_line(cmd_line):
+    """Windows takes the command line as is, elsewhere Popen needs a list."""
+    if os.name == "nt":
+        return cmd_line
+
+    return shlex.split(cmd_line)
+
+def reads_input(cmd, in_file):
+    """cmd reading y4m from stdin instead of in_file, None if cmd doesn't
+    read in_file."""
+    if isinstance(cmd, str):
+        # Windows, see split_cmd_line
+        quoted = '"{0}"'.format(in_file)
+        if cmd.rstrip().endswith(quoted):
+            return cmd.rstrip()[:-len(quoted)] + "--demuxer y4m -"
+
+        return None
+
+    if cmd and os.path.abspath(cmd[-1]) == os.path.abspath(in_file):
+        return cmd[:-1] + ["--demuxer", "y4m", "-"]
+
+    return None
@@ -0,0 +1,185 @@
+import socket
+import sys
+from threading import Thread, Lock
+from time import sleep, time
+from .ipc import connect
+from .scheduler import Runner, cpu_count, thread_share
+from .utils import AttrDict
+from .task import Task, MainThreadExiting, run_task, task_placement
+from .placement import CpuAllocator, placement_supported
+from .encx264_impl import task_thread_budget
+
+__all__ = ["run_worker"]
+
+# how often to ask for work / renew leases, and how often progress is sent
+poll_interval = 2
+progress_interval = 1
+
+class CoordinatorClient:
+    """Shared connection to the coordinator, reconnected on demand."""
+    def __init__(self, address, token=None):
+        self.address = address
+        self.token = token
+        self.conn = None
+        self.lock = Lock()
+
+    def request(self, request):
+        """Returns the reply, or None if the coordinator can't be reached."""
+        if self.token:
+            request = dict(request, auth=self.token)
+
+        with self.lock:
+            try:
+                if not self.conn:
+                    self.conn = connect(self.address, timeout=10)
+
+                reply = self.conn.request(request)
+                if reply is None:
+                    raise OSError("connection closed")
+
+                return reply
+            except (OSError, ValueError):
+                if self.conn:
+                    self.conn.close()
+                    self.conn = None
+
+                return None
+
+def worker_task_thread(client, state, runner):
+    task = runner.task
+    last_report = [0]
+    def on_output():
+        if time() - last_report[0] < progress_interval:
+            return
+
+        last_report[0] = time()
+        reply = client.request({
+            "command": "progress",
+            "lease": task.id,
+            "lease_token": runner.lease_token,
+            "msg": runner.msg,
+            "title_msg": runner.title_msg,
+        })
+        if reply and "error" in reply:
+            state.lost.add(task.id)
+
+    ret, error = None, None
+    try:
+        ret, error = run_task(
+            runner,
+            lambda: state.exit_code is not None or task.id in state.lost,
+            on_output)
+    except KeyboardInterrupt:
+        print("Interrupted by user.")
+        state.exit_code = 1
+    except MainThreadExiting:
+        pass
+    except Exception as e:
+        ret, error = 0, str(e)
+
+    if task.id in state.lost:
+        print("Lease of task", runner.tag, "expired, result discarded")
+    else:
+        print("Task", runner.tag, "finished with", error or ret)
+        request = {
+            "command": "complete",
+            "lease": task.id,
+            "lease_token": runner.lease_token,
+            "ret": ret,
+            "error": error,
+            "msg": runner.msg,
+            "encode_result": runner.encode_result,
+            "metrics": runner.metrics,
+        }
+        # don't lose the result because of a network hiccup
+        while client.request(request) is None and state.exit_code is None:
+            sleep(poll_interval)
+
+    with state.lock:
+        state.free_slots += task.slot
+        del state.running[task.id]
+        if runner.cpus:
+            state.allocator.release(runner.cpus)
+
+def run_worker(address, max_slots=2, name=None, token=None):
+    name = name or socket.gethostname()
+    client = CoordinatorClient(address, token)
+    state = AttrDict()
+    state.lock = Lock()
+    state.free_slots = max_slots
+    state.running = {}
+    state.lost = set()
+    state.exit_code = None
+    state.allocator = placement_supported() and CpuAllocator() or None
+
+    print("Worker", name, "connecting to {0}:{1}".format(*address))
+    try:
+        while True:
+            if state.running:
+                with state.lock:
+                    leases = [[id, r.lease_token]
+                              for id, r in state.running.items()]
+
+                reply = client.request({"command": "renew",
+                                        "leases": leases})
+                if reply and "error" in reply:
+                    print("Coordinator:", reply["error"])
+                    state.exit_code = 1
+                    break
+
+                if reply:
+                    state.lost.update(reply["lost"])
+
+            reply = None
+            if state.free_slots > 0:
+                reply = client.request({
+                    "command": "lease",
+                    "worker": name,
+                    "slots": state.free_slots,
+                    "max_slots": max_slots,
+                })
+
+            if reply and "error" in reply:
+                print("Coordinator:", reply["error"])
+                state.exit_code = 1
+
+            if reply and reply.get("task"):
+                runner = Runner(Task(data=reply["task"]), reply["tag"])
+                runner.lease_token = reply["lease_token"]
+                if task_thread_budget:
+                    runner.threads = thread_share(
+                        cpu_count(), runner.task.slot, max_slots)
+                print("Running task", runner.tag)
+                with state.lock:
+                    state.free_slots -= runner.task.slot
+                    state.running[runner.task.id] = runner
+                    policy, nodes = task_placement(runner.task)
+                    if state.allocator and policy:
+                        count = runner.threads or thread_share(
+                            cpu_count(), runner.task.slot, max_slots)
+                        runner.cpus = state.allocator.allocate(
+                            count, policy, nodes)
+                        if not runner.cpus:
+                            runner.cpus = state.allocator.share(
+                                count, policy, nodes)
+                            if runner.cpus:
+                                print("Task", runner.tag, "shares cpus",
+                                      ",".join(map(str, runner.cpus)))
+
+                        if runner.cpus and runner.threads:
+                            runner.threads = len(runner.cpus)
+
+                Thread(target=worker_task_thread,
+                       args=(client, state, runner)).start()
+                continue
+
+            if state.exit_code is not None:
+                break
+
+            sleep(poll_interval)
+
+    except KeyboardInterrupt:
+        print("Interrupted by user.")
+        state.exit_code = 1
+
+    sys.exit(state.exit_code)
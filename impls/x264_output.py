@@ -0,0 +1,293 @@
+import json
+import locale
+import os
+import re
+from time import time
+
+__all__ = ["X264OutputParser", "X264Event", "parse_line", "event_types",
+           "read_output"]
+
+# how often progress updates are passed on, x264 writes them much more
+# often than anybody can read them
+progress_tick = 0.25
+read_size = 65536
+
+class event_types:
+    """Values of X264Event.type. Plain class attributes rather than an
+    AttrDict like task_states, subscribers look them up for every line."""
+    progress = "progress"
+    summary = "summary"
+    ssim = "ssim"
+    psnr = "psnr"
+    piper = "piper"
+    text = "text"
+
+# [12.3%] 123/1000 frames, 23.45 fps, 1234.56 kb/s, eta 0:01:02
+# [12.3%] 123/1000 frames, 23.45 fps, 1234.56 kb/s, 1.23 MB, eta 0:01:02, ...
+progress_pat = re.compile(
+    r"\[ *([\d.]+)%\] *(\d+)/(\d+) frames, *([\d.]+) fps(?:, *([\d.]+) kb/s)?")
+# 123 frames: 23.45 fps, 1234.56 kb/s  (input length unknown)
+progress_nototal_pat = re.compile(
+    r"(\d+) frames: *([\d.]+) fps, *([\d.]+) kb/s")
+eta_pat = re.compile(r"eta (\d+):(\d\d):(\d\d)")
+summary_pat = re.compile(
+    r" *encoded (\d+) frames(?:, *([\d.]+) fps)?(?:, *([\d.]+) kb/s)?")
+ssim_pat = re.compile(r"SSIM Mean Y:([\d.]+)(?: *\( *([\d.]+|inf)db\))?")
+# avs [info]: 1920x1080p 1:1 @ 24000/1001 fps (cfr)
+resolution_pat = re.compile(r"\w+ \[info\]: (\d+x\d+)[pi]? ")
+psnr_pat = re.compile(
+    r"PSNR Mean Y:([\d.]+) U:([\d.]+) V:([\d.]+) Avg:([\d.]+) "
+    r"Global:([\d.]+)")
+# the final summary of piper --stats, see piper.py
+piper_stats_prefix = "piper stats: "
+
+def field(index, convert):
+    def get(self):
+        m = self.match
+        if m is None:
+            m = self.match = self.pattern.match(self.line) or False
+
+        value = m and m.group(index)
+        if not value:
+            return None
+
+        return convert(value)
+
+    return property(get)
+
+def parse_eta(self):
+    m = self.frames is not None and \
+        eta_pat.search(self.line, self.match.end())
+    if not m:
+        return None
+
+    h, mi, s = m.groups()
+    return int(h) * 3600 + int(mi) * 60 + int(s)
+
+def parse_percent(self):
+    # the one value read for every line, skip the regex
+    try:
+        return float(self.line[1:self.line.index("%")])
+    except ValueError:
+        return None
+
+class X264Event:
+    """One line of x264 output. The values (percent, frames, fps...) are
+    converted from the match when they are read, and progress lines are
+    only matched when something other than the percentage is needed, most
+    of them are just displayed."""
+    __slots__ = ["line", "match"]
+    type = event_types.text
+    fields = []
+    pattern = None
+
+    def __init__(self, line, match=None):
+        self.line = line
+        self.match = match
+
+    def as_dict(self):
+        ret = {"type": self.type, "line": self.line}
+        for name in self.fields:
+            ret[name] = getattr(self, name)
+
+        return ret
+
+class ProgressEvent(X264Event):
+    __slots__ = []
+    type = event_types.progress
+    fields = ["percent", "frames", "total", "fps", "kbps", "eta"]
+    pattern = progress_pat
+    percent = property(parse_percent)
+    frames = field(2, int)
+    total = field(3, int)
+    fps = field(4, float)
+    kbps = field(5, float)
+    eta = property(parse_eta)
+
+class UnknownTotalProgressEvent(ProgressEvent):
+    __slots__ = []
+    percent = None
+    frames = field(1, int)
+    total = None
+    fps = field(2, float)
+    kbps = field(3, float)
+    eta = None
+
+class SummaryEvent(X264Event):
+    __slots__ = []
+    type = event_types.summary
+    fields = ["frames", "fps", "kbps"]
+    frames = field(1, int)
+    fps = field(2, float)
+    kbps = field(3, float)
+
+class SsimEvent(X264Event):
+    __slots__ = []
+    type = event_types.ssim
+    fields = ["ssim", "db"]
+    ssim = field(1, float)
+    db = field(2, float)
+
+class PsnrEvent(X264Event):
+    __slots__ = []
+    type = event_types.psnr
+    fields = ["y", "u", "v", "avg", "glob"]
+    y = field(1, float)
+    u = field(2, float)
+    v = field(3, float)
+    avg = field(4, float)
+    glob = field(5, float)
+
+def parse_stats(self):
+    try:
+        return json.loads(self.line[len(piper_stats_prefix):])
+    except ValueError:
+        return None
+
+class PiperEvent(X264Event):
+    __slots__ = []
+    type = event_types.piper
+    fields = ["stats"]
+    stats = property(parse_stats)
+
+def parse_line(line):
+    """Turns one line of x264 output into an X264Event, see event_types."""
+    s = line.strip()
+    c = s[:1]
+    if c == "[":
+        # only progress lines start with "[", matched on demand
+        return ProgressEvent(s)
+
+    elif c == "e":
+        m = summary_pat.match(s)
+        if m and m.group(2) and m.group(3):
+            return SummaryEvent(s, m)
+
+    elif c.isdigit():
+        m = progress_nototal_pat.match(s)
+        if m:
+            return UnknownTotalProgressEvent(s, m)
+
+    elif "Mean Y:" in s:
+        m = ssim_pat.search(s)
+        if m:
+            return SsimEvent(s, m)
+
+        m = psnr_pat.search(s)
+        if m:
+            return PsnrEvent(s, m)
+
+    elif c == "p" and s.startswith(piper_stats_prefix):
+        return PiperEvent(s)
+
+    return X264Event(s)
+
+class X264OutputParser:
+    """Parses x264 output line by line and passes every event to the
+    subscribers. Keeps the last event of every type but text, so consumers
+    don't have to track the progress or the final result themselves."""
+
+    def __init__(self, *subscribers):
+        self.subscribers = list(subscribers)
+        self.progress = None
+        self.summary = None
+        self.ssim = None
+        self.psnr = None
+        self.piper = None
+        # of the input, from the first info line that has it
+        self.resolution = None
+
+    def subscribe(self, func):
+        self.subscribers.append(func)
+
+    def feed(self, line):
+        s = line.strip()
+        if s[:1] == "[":
+            # nearly every line, skip parse_line and setattr
+            event = self.progress = ProgressEvent(s)
+            for func in self.subscribers:
+                func(event)
+
+            return event
+
+        event = parse_line(s)
+        if event.fields:
+            setattr(self, event.type, event)
+        elif self.resolution is None:
+            m = resolution_pat.match(event.line)
+            if m:
+                self.resolution = m.group(1)
+
+        for func in self.subscribers:
+            func(event)
+
+        return event
+
+    def result(self):
+        """{"fps", "bitrate", "frames"} of the final summary line, the format
+        parse_encode_result_line() returns, the "resolution", and the
+        "piper" stats if piper ran with --stats."""
+        if not self.summary:
+            return None
+
+        return {
+            "fps": self.summary.fps,
+            "bitrate": int(self.summary.kbps),
+            "frames": self.summary.frames,
+            "resolution": self.resolution,
+            "piper": self.piper and self.piper.stats,
+        }
+
+line_end_pat = re.compile(rb"\r\n|\r|\n")
+
+def read_output(stream, tick=progress_tick, encoding=None):
+    """Yields the lines x264 writes to stream, a binary pipe. Reads large
+    chunks instead of decoding line by line, and of the progress updates
+    (lines ending with \\r) only passes on the latest one per tick, or
+    before the next normal line."""
+    encoding = encoding or locale.getpreferredencoding(False)
+    fd = stream.fileno()
+    buf = b""
+    pending = None
+    last_progress = 0
+    while True:
+        chunk = os.read(fd, read_size)
+        if not chunk:
+            break
+
+        buf += chunk
+        pos = 0
+        for m in line_end_pat.finditer(buf):
+            if m.end() == len(buf) and m.group() == b"\r":
+                # may be the first half of \r\n
+                break
+
+            line = buf[pos:m.start()].decode(encoding, "replace")
+            pos = m.end()
+            if m.group() == b"\r":
+                pending = line
+                continue
+
+            if pending is not None:
+                yield pending
+                pending = None
+
+            yield line
+
+        buf = buf[pos:]
+        if pending is not None and time() - last_progress >= tick:
+            last_progress = time()
+            yield pending
+            pending = None
+
+    if buf.endswith(b"\r"):
+        pending = buf[:-1].decode(encoding, "replace")
+    elif buf:
+        if pending is not None:
+            yield pending
+            pending = None
+
+        yield buf.decode(encoding, "replace")
+
+    if pending is not None:
+        yield pending
@@ -1,5 +1,7 @@
 import re
 from subprocess import Popen, PIPE, STDOUT
+from .x264_output import X264OutputParser, parse_line, event_types, \
+                         read_output
 
 class X264Error(Exception):
     def __init__(self, return_code):
@@ -116,17 +118,13 @@ def split_params(param_str):
             re.finditer(r'\s*([^" ].*?|".*?")(\s|$)', param_str, re.I)]
 
 def try_parse_encode_result_line(line):
-    pat = r"\s*encoded \d+ frames,.*"
-    m = re.match(pat, line)
-    if not m:
+    event = parse_line(line)
+    if event.type != event_types.summary:
         return None
 
-    fps = re.search(r",\s*([\d\.]+)\s*fps", line).group(1)
-    bitrate = re.search(r",\s*([\d\.]+)\s*kb/s", line).group(1)
-
     return {
-        "fps": float(fps),
-        "bitrate": int(float(bitrate)),
+        "fps": event.fps,
+        "bitrate": int(event.kbps),
     }
 
 def print_output(msg, line_type, print=print):
@@ -148,28 +146,25 @@ def check_return_code(p):
 def run_x264(
     params, 
     print_output=print_output,
-    Popen=Popen):
+    Popen=Popen,
+    on_event=None):
     assert isinstance(params, X264Params)
 
-    result = None
+    parser = X264OutputParser(*(on_event and [on_event] or []))
 
     with Popen(params.build_command_line(),
         stdout=PIPE,
         stderr=STDOUT,
         cwd=params.working_dir,
-        creationflags=params.creation_flags,
-        universal_newlines=True) as p:
+        creationflags=params.creation_flags) as p:
 
         try:
-            for l in p.stdout:
-                l = l.rstrip()
-                if l.startswith("["):
-                    print_output(l.ljust(78), "progress")
+            for l in read_output(p.stdout):
+                event = parser.feed(l)
+                if event.type == event_types.progress:
+                    print_output(event.line.ljust(78), "progress")
                 else:
-                    if not result:
-                        result = try_parse_encode_result_line(l)
-
-                    print_output(l, "normal")
+                    print_output(l.rstrip(), "normal")
 
         except:
             try:
@@ -181,6 +176,7 @@ def run_x264(
 
         check_return_code(p)
 
+        result = parser.result()
         if not result:
             raise ValueError("Can't read encoding information from x264 output")
 
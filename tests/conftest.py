@@ -0,0 +1,28 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fake_x264 = os.path.join(root, "impls", "fake_x264.py")
+
+# encx264_impl imports the user's encx264_targets.py, give it the sample
+# targets running the fake x264, and keep the history and the task database
+# out of the real temp directory
+config_dir = tempfile.mkdtemp(prefix="encx264_tests.")
+atexit.register(shutil.rmtree, config_dir, True)
+with open(os.path.join(root, "encx264_targets.py.sample"), "r") as f:
+    sample = f.read()
+
+with open(os.path.join(config_dir, "encx264_targets.py"), "w") as f:
+    f.write(sample)
+    f.write("\nx264_path = {0!r}\n".format(fake_x264))
+    f.write("history_file = ''\n")
+    f.write("default_priority = 'normal'\n")
+
+sys.path.insert(0, config_dir)
+sys.path.insert(0, root)
+os.environ["ENCX264_TASK_FILE"] = os.path.join(config_dir, "tasks")
+os.environ["FAKE_X264_FRAMES"] = "50"
+os.environ["FAKE_X264_FPS"] = "0"
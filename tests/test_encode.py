@@ -0,0 +1,162 @@
+import os
+import sys
+
+import pytest
+
+from impls import encx264_impl
+
+def run_encode(tmp_path, *args):
+    lines = []
+    def record(*values, **kwargs):
+        if kwargs.get("file"):
+            print(*values, **kwargs)
+        else:
+            lines.append(" ".join([str(x) for x in values]))
+
+    code = encx264_impl.encode(["mkv_720p", "in.avs"] + list(args),
+                               record, working_dir=str(tmp_path))
+    return code, lines
+
+def read(name):
+    with open(str(name), "r") as f:
+        return f.read()
+
+@pytest.fixture
+def source(tmp_path):
+    (tmp_path / "in.avs").write_text(u'Import("filters.avsi")\n')
+    (tmp_path / "filters.avsi").write_text(u"# nothing yet\n")
+    return tmp_path
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setattr(encx264_impl, "pass1_cache_dir", cache_dir)
+    monkeypatch.setattr(encx264_impl, "pass1_cache_size_mb", 1)
+    return cache_dir
+
+def reused(lines):
+    return [x for x in lines if x.startswith("Reusing cached 1st pass")]
+
+def test_2pass_encode(source):
+    code, lines = run_encode(source, "out.264", "20")
+    assert not code
+    assert os.path.getsize(str(source / "out.264")) > 0
+    # the 2nd pass got what the crf pass hit, see fake_x264.py
+    assert read(source / "out.264.bitrate.txt") == "1904"
+    assert "--bitrate 1904" in read(source / "out.264.log")
+    assert not reused(lines)
+
+def test_2pass_encode_reuses_the_1st_pass(source, cache_dir):
+    code, lines = run_encode(source, "out.264", "20")
+    assert not code and not reused(lines)
+    assert len(os.listdir(cache_dir)) == 1
+
+    os.remove(str(source / "out.264.x264_stats"))
+    code, lines = run_encode(source, "out.264", "20")
+    assert not code
+    assert reused(lines) == ["Reusing cached 1st pass result: 1904 kb/s"]
+    assert os.path.isfile(str(source / "out.264.x264_stats"))
+    assert os.path.isfile(str(source / "out.264.x264_stats.mbtree"))
+
+def test_1st_pass_cache_misses(source, cache_dir):
+    run_encode(source, "out.264", "20")
+
+    # other settings, another output, a changed script
+    code, lines = run_encode(source, "out.264", "18")
+    assert not code and not reused(lines)
+    code, lines = run_encode(source, "other.264", "20")
+    assert not code and not reused(lines)
+    (source / "filters.avsi").write_text(u"# changed\n")
+    code, lines = run_encode(source, "out.264", "20")
+    assert not code and not reused(lines)
+    assert len(os.listdir(cache_dir)) == 4
+
+def test_1st_pass_cache_evicts(source, cache_dir, monkeypatch):
+    # room for a single entry
+    monkeypatch.setattr(encx264_impl, "pass1_cache_size_mb", 40.0 / 2 ** 20)
+    run_encode(source, "a.264", "20")
+    run_encode(source, "b.264", "20")
+    assert len(os.listdir(cache_dir)) == 1
+
+    code, lines = run_encode(source, "b.264", "20")
+    assert reused(lines)
+    code, lines = run_encode(source, "a.264", "20")
+    assert not reused(lines)
+
+def test_1st_pass_cache_skips_unhashable_scripts(source, cache_dir):
+    (source / "filters.avsi").write_text(u'x = GetEnv("SOURCE")\n')
+    code, lines = run_encode(source, "out.264", "20")
+    assert not code
+    assert "Warning: Not using the 1st pass cache, " \
+           "{0} reads the environment".format(source / "filters.avsi") \
+           in lines
+    assert not os.path.exists(cache_dir)
+
+def test_segments(source):
+    code, lines = run_encode(source, "seg.264", "20", "--segments", "3",
+                             "--total-frames", "50")
+    assert not code
+    assert "seg.seg000.264" in read(source / "seg.264.log")
+    # only the joined output and its own files are left
+    assert sorted(os.listdir(str(source))) == \
+           ["filters.avsi", "in.avs", "seg.264", "seg.264.bitrate.txt",
+            "seg.264.log"]
+
+frameserver = """
+import sys
+with open(sys.argv[1], "a") as f:
+    f.write("run\\n")
+sys.stdout.buffer.write(b"YUV4MPEG2 W64 H64 F24:1 C420\\n")
+for i in range(50):
+    sys.stdout.buffer.write(b"FRAME\\n" + bytes([i]) * 6144)
+"""
+
+@pytest.fixture
+def frame_cache(source, monkeypatch):
+    (source / "fs.py").write_text(frameserver)
+    runs = source / "fs.runs"
+    monkeypatch.setattr(encx264_impl, "frameserver_cmd",
+                        '"{0}" "{1}" "{2}" "{{inFile}}"'.format(
+                            sys.executable, source / "fs.py", runs))
+    monkeypatch.setattr(encx264_impl, "frame_cache_dir",
+                        str(source / "frames"))
+    return runs
+
+def test_frame_cache_replays_the_1st_pass(source, frame_cache):
+    code, lines = run_encode(source, "out.264", "20", "--frame-cache")
+    assert not code
+    # the filters ran once for both passes
+    assert read(frame_cache) == "run\n"
+    assert "Reading the frames cached by the 1st pass" in lines
+    second = [x for x in lines if x.startswith("Second pass command line")]
+    assert second[0].endswith("--demuxer y4m -")
+    # removed once the 2nd pass succeeded
+    assert not os.listdir(str(source / "frames"))
+
+def test_frame_cache_kept_for_a_later_2nd_pass(source, frame_cache):
+    code, lines = run_encode(source, "out.264", "20", "--frame-cache",
+                             "--1pass-only")
+    assert not code
+    names = sorted(os.listdir(str(source / "frames")))
+    assert len(names) == 2 and names[1] == names[0] + ".size"
+
+    code, lines = run_encode(source, "out.264", "20", "--frame-cache",
+                             "--pass", "2")
+    assert not code
+    assert read(frame_cache) == "run\n"
+    assert "Reading the frames cached by the 1st pass" in lines
+
+def test_truncated_frame_cache_is_not_replayed(source, frame_cache):
+    run_encode(source, "out.264", "20", "--frame-cache", "--1pass-only")
+    name = [x for x in os.listdir(str(source / "frames"))
+            if not x.endswith(".size")][0]
+    with open(str(source / "frames" / name), "r+b") as f:
+        f.truncate(1000)
+
+    code, lines = run_encode(source, "out.264", "20", "--frame-cache",
+                             "--pass", "2")
+    assert not code
+    assert "Warning: The frame cache is incomplete, the 2nd pass reads " \
+           "the input again" in lines
+    assert "Reading the frames cached by the 1st pass" not in lines
+    assert not os.listdir(str(source / "frames"))
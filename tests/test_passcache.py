@@ -0,0 +1,99 @@
+import os
+import time
+
+from conftest import fake_x264
+from impls.passcache import Pass1Cache
+from impls.utils import AttrDict
+
+def make_args(out_file="out.264"):
+    return AttrDict(outFile=out_file,
+                    statsFile=out_file + ".x264_stats",
+                    x264_exec='"{0}"'.format(fake_x264))
+
+def cmdline(script, options="--crf 20"):
+    return '"{0}" --pass 1 --threads 8 {1} --stats "out.264.x264_stats" ' \
+           '"{2}"'.format(fake_x264, options, script)
+
+def key(tmp_path, cmd, out_file="out.264"):
+    cache = Pass1Cache(str(tmp_path / "cache"))
+    return cache.key(make_args(out_file), cmd, str(tmp_path)), \
+           cache.unhashable
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+def test_key_follows_imported_scripts(tmp_path):
+    script = write(tmp_path / "in.avs", u'Import("lib.avsi")\n')
+    write(tmp_path / "lib.avsi", u'LWLibavVideoSource("video.mkv")\n')
+    write(tmp_path / "video.mkv", u"frames")
+    first, reason = key(tmp_path, cmdline(script))
+    assert first and reason is None
+    assert key(tmp_path, cmdline(script))[0] == first
+
+    write(tmp_path / "lib.avsi", u'LWLibavVideoSource("video.mkv")\n'
+                                 u'Spline36Resize(1280, 720)\n')
+    second = key(tmp_path, cmdline(script))[0]
+    assert second != first
+
+    # video files by size and mtime
+    stat = os.stat(str(tmp_path / "video.mkv"))
+    os.utime(str(tmp_path / "video.mkv"),
+             (stat.st_atime, stat.st_mtime + 10))
+    assert key(tmp_path, cmdline(script))[0] != second
+
+def test_key_depends_on_settings_and_output(tmp_path):
+    script = write(tmp_path / "in.avs", u"BlankClip()\n")
+    first = key(tmp_path, cmdline(script))[0]
+    assert key(tmp_path, cmdline(script, "--crf 18"))[0] != first
+    assert key(tmp_path, cmdline(script), "other.264")[0] != first
+    # the thread count doesn't change the result
+    assert key(tmp_path, cmdline(script).replace("--threads 8",
+                                                 "--threads 4"))[0] == first
+
+def test_scripts_reading_the_environment_are_unhashable(tmp_path):
+    script = write(tmp_path / "in.avs", u'Import("lib.avsi")\n')
+    lib = write(tmp_path / "lib.avsi", u'x = GetEnv("SOURCE")\n')
+    assert key(tmp_path, cmdline(script)) == \
+           (None, "{0} reads the environment".format(lib))
+
+def test_python_imports_are_unhashable(tmp_path):
+    script = write(tmp_path / "in.vpy",
+                   u"import vapoursynth as vs\nimport os\n"
+                   u"from havsfunc import QTGMC\n")
+    assert key(tmp_path, cmdline(script)) == \
+           (None, "{0} imports havsfunc".format(script))
+
+    write(tmp_path / "in.vpy", u"import vapoursynth as vs\n"
+                               u"from functools import partial\n")
+    assert key(tmp_path, cmdline(script))[1] is None
+
+def store(cache, key, tmp_path, bitrate):
+    stats = write(tmp_path / (key + ".stats"), u"#options: " + key)
+    cache.store(key, stats, bitrate)
+
+def test_fetch_and_store(tmp_path):
+    cache = Pass1Cache(str(tmp_path / "cache"))
+    assert cache.fetch("a", str(tmp_path / "stats")) is None
+    store(cache, "a", tmp_path, 1234)
+    assert cache.fetch("a", str(tmp_path / "stats")) == 1234
+    assert (tmp_path / "stats").read_text() == u"#options: a"
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    # each entry is 11 bytes of stats and the 4 digit bitrate
+    cache = Pass1Cache(str(tmp_path / "cache"), max_size=30)
+    store(cache, "a", tmp_path, 1000)
+    store(cache, "b", tmp_path, 2000)
+    old = time.time() - 100
+    os.utime(cache.entry("a"), (old, old))
+    os.utime(cache.entry("b"), (old + 1, old + 1))
+    # a hit makes a the most recently used
+    assert cache.fetch("a", str(tmp_path / "stats")) == 1000
+
+    store(cache, "c", tmp_path, 3000)
+    assert sorted(os.listdir(cache.cache_dir)) == ["a", "c"]
+
+def test_the_newest_entry_is_kept_however_large(tmp_path):
+    cache = Pass1Cache(str(tmp_path / "cache"), max_size=1)
+    store(cache, "a", tmp_path, 1000)
+    assert os.listdir(cache.cache_dir) == ["a"]
@@ -0,0 +1,132 @@
+import io
+import os
+import subprocess
+import sys
+import time
+
+from impls import piper
+from impls.group import GroupInput
+
+class Sink(io.BytesIO):
+    def __init__(self, fail_after=None):
+        io.BytesIO.__init__(self)
+        self.fail_after = fail_after
+        self.data = None
+
+    def write(self, chunk):
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise BrokenPipeError()
+
+        return io.BytesIO.write(self, chunk)
+
+    def close(self):
+        self.data = self.getvalue()
+        io.BytesIO.close(self)
+
+def test_tee_copies_everything_to_every_sink():
+    data = os.urandom(piper.chunk_size * 3 + 123)
+    sinks = [Sink(), Sink()]
+    assert piper.tee(io.BytesIO(data), sinks, piper.chunk_size) == []
+    assert [x.data for x in sinks] == [data, data]
+
+def test_tee_drops_failed_sinks():
+    data = os.urandom(piper.chunk_size * 4)
+    good = Sink()
+    bad = Sink(fail_after=piper.chunk_size)
+    assert piper.tee(io.BytesIO(data), [bad, good], piper.chunk_size) == \
+           [bad]
+    assert good.data == data
+    assert bad.data == data[:piper.chunk_size]
+
+def test_tee_stops_when_every_sink_failed():
+    class Source(io.BytesIO):
+        reads = 0
+
+        def read(self, size):
+            Source.reads += 1
+            return io.BytesIO.read(self, size)
+
+    source = Source(b"x" * piper.chunk_size * 64)
+    sinks = [Sink(fail_after=0), Sink(fail_after=0)]
+    assert len(piper.tee(source, sinks, piper.chunk_size)) == 2
+    assert Source.reads < 64
+
+def python_cmd(code):
+    return [sys.executable, "-c", code]
+
+def test_piper_feeds_every_consumer(tmp_path):
+    producer = python_cmd("import sys; sys.stdout.buffer.write(b'y' * "
+                          "3000000)")
+    count = "import sys; n = len(sys.stdin.buffer.read()); " \
+            "open(sys.argv[1], 'w').write(str(n))"
+    outputs = [str(tmp_path / "a"), str(tmp_path / "b")]
+    code = subprocess.call(
+        [sys.executable, piper.__file__] + producer +
+        ["----"] + python_cmd(count) + [outputs[0]] +
+        ["----"] + python_cmd(count) + [outputs[1]],
+        stdout=subprocess.DEVNULL)
+    assert code == 0
+    for name in outputs:
+        with open(name, "r") as f:
+            assert f.read() == "3000000"
+
+def test_piper_consumer_exiting_early(tmp_path):
+    producer = python_cmd("import sys; sys.stdout.buffer.write(b'y' * "
+                          "30000000)")
+    count = "import sys; n = len(sys.stdin.buffer.read()); " \
+            "open(sys.argv[1], 'w').write(str(n))"
+    code = subprocess.call(
+        [sys.executable, piper.__file__] + producer +
+        ["----"] + python_cmd("import sys; sys.exit(3)") +
+        ["----"] + python_cmd(count) + [str(tmp_path / "b")],
+        stdout=subprocess.DEVNULL)
+    assert code == 3
+    with open(str(tmp_path / "b"), "r") as f:
+        assert f.read() == "30000000"
+
+def group_input(members, timeout=None):
+    return GroupInput(" ".join(['"{0}"'.format(sys.executable), "-c",
+                                '"print(123)"']),
+                      members, subprocess.Popen, None, piper.chunk_size,
+                      timeout)
+
+def join(group):
+    r, w = os.pipe()
+    group.join(os.fdopen(w, "wb"))
+    return os.fdopen(r, "rb")
+
+def test_group_round_starts_once_everybody_joined():
+    group = group_input(2)
+    first = join(group)
+    assert not group.threads
+    second = join(group)
+    group.wait()
+    assert first.read() == second.read() == b"123\n"
+    assert not group.failures
+
+def test_group_round_starts_without_members_that_left():
+    group = group_input(2)
+    first = join(group)
+    group.leave()
+    group.wait()
+    assert first.read() == b"123\n"
+
+def test_group_round_times_out():
+    group = group_input(2, timeout=0.2)
+    start = time.time()
+    first = join(group)
+    assert first.read() == b"123\n"
+    assert time.time() - start >= 0.2
+    # the straggler gets a round of its own
+    late = join(group)
+    assert late.read() == b"123\n"
+    group.wait()
+    assert len(group.threads) == 2
+
+def test_cancelled_group_closes_the_inputs():
+    group = group_input(3)
+    first = join(group)
+    group.cancel()
+    late = join(group)
+    assert first.read() == late.read() == b""
+    assert not group.threads
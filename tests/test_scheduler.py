@@ -0,0 +1,176 @@
+from uuid import uuid4
+
+from impls.scheduler import Scheduler, task_states
+from impls.utils import AttrDict
+
+class FakeTask(AttrDict):
+    def __init__(self, slot=1, priority=0, depends=None, **kwargs):
+        AttrDict.__init__(self, id=str(uuid4()), slot=slot,
+                          priority=priority, depends=depends,
+                          state=task_states.waiting, state_message="",
+                          **kwargs)
+
+    def set_state(self, state, message=''):
+        self.state = state
+        self.state_message = message
+
+def make_scheduler(tasks, max_slots=2, **kwargs):
+    launched = []
+    scheduler = Scheduler(tasks, max_slots,
+                          lambda s, runner: launched.append(runner),
+                          **kwargs)
+    return scheduler, launched
+
+def test_pick_by_priority_then_position():
+    tasks = [FakeTask(), FakeTask(priority=1), FakeTask(priority=1)]
+    scheduler, _ = make_scheduler(tasks)
+    assert scheduler.pick() is tasks[1]
+    assert scheduler.pick() is tasks[2]
+    assert scheduler.pick() is tasks[0]
+    assert scheduler.pick() is None
+
+def test_pick_longest_first_with_estimate():
+    tasks = [FakeTask(secs=10), FakeTask(secs=30), FakeTask(secs=20)]
+    scheduler, _ = make_scheduler(tasks, estimate=lambda t: t.secs)
+    assert [scheduler.pick() for t in tasks] == [tasks[1], tasks[2],
+                                                 tasks[0]]
+
+def test_pick_skips_tasks_that_dont_fit_the_slots():
+    tasks = [FakeTask(slot=2), FakeTask(slot=1)]
+    scheduler, _ = make_scheduler(tasks, max_slots=2)
+    assert scheduler.pick(avail_slots=1, idle=False) is tasks[1]
+    assert scheduler.pick(avail_slots=1, idle=False) is None
+    # with nothing running the big one runs anyway
+    assert scheduler.pick(avail_slots=1, idle=True) is tasks[0]
+
+def test_start_ready_waits_for_dependencies():
+    parent = FakeTask()
+    child = FakeTask(depends=[parent.id])
+    scheduler, launched = make_scheduler([child, parent])
+    scheduler.start_ready()
+    assert [r.task for r in launched] == [parent]
+    assert child.state == task_states.waiting
+
+    scheduler.handle_exit(launched[0], 0)
+    assert parent.state == task_states.completed
+    scheduler.start_ready()
+    assert [r.task for r in launched] == [parent, child]
+
+def test_handle_exit_fails_dependents():
+    parent = FakeTask()
+    child = FakeTask(depends=[parent.id])
+    grandchild = FakeTask(depends=[child.id])
+    scheduler, launched = make_scheduler([parent, child, grandchild])
+    scheduler.start_ready()
+    launched[0].msg = "x264 failed"
+    scheduler.handle_exit(launched[0], 1)
+    assert parent.state == task_states.error
+    assert parent.state_message == "code 1, x264 failed"
+    assert child.state == task_states.error
+    assert grandchild.state == task_states.error
+    assert scheduler.slots == 2
+
+def test_handle_exit_keeps_interrupted_tasks():
+    t = FakeTask()
+    scheduler, launched = make_scheduler([t])
+    scheduler.start_ready()
+    scheduler.handle_exit(launched[0], None)
+    assert t.state == task_states.running
+    assert scheduler.slots == 2
+    assert not scheduler.runners
+
+def test_handle_exit_records_the_result():
+    t = FakeTask()
+    scheduler, launched = make_scheduler([t])
+    scheduler.start_ready()
+    launched[0].encode_result = {"fps": 1.5, "bitrate": 1000}
+    scheduler.handle_exit(launched[0], 0)
+    assert t.state == task_states.completed
+    assert t.state_message == "1.5 fps, 1000 kbps"
+
+def test_dependency_cycle_fails():
+    a = FakeTask()
+    b = FakeTask(depends=[a.id])
+    a.depends = [b.id]
+    c = FakeTask()
+    scheduler, _ = make_scheduler([a, b, c])
+    assert a.state == b.state == task_states.error
+    assert a.state_message == "dependency cycle"
+    assert scheduler.pick() is c
+
+def test_backfill_starts_a_smaller_task_that_fits():
+    tasks = [FakeTask(mem=8), FakeTask(mem=5), FakeTask(mem=2),
+             FakeTask(mem=1, priority=-1)]
+    scheduler, launched = make_scheduler(
+        tasks, max_slots=4, resources=lambda t: {"memory": t.mem},
+        capacity={"memory": 10})
+    scheduler.start_ready()
+    # 5 doesn't fit next to 8, the 2 of the same priority does, the lower
+    # priority task waits even though it fits too
+    assert [r.task for r in launched] == [tasks[0], tasks[2]]
+    assert scheduler.used["memory"] == 10
+
+    scheduler.handle_exit(launched[0], 0)
+    scheduler.start_ready()
+    assert [r.task for r in launched[2:]] == [tasks[1], tasks[3]]
+
+def test_task_larger_than_capacity_runs_alone():
+    tasks = [FakeTask(mem=20), FakeTask(mem=1)]
+    scheduler, launched = make_scheduler(
+        tasks, resources=lambda t: {"memory": t.mem},
+        capacity={"memory": 10})
+    scheduler.start_ready()
+    assert [r.task for r in launched] == [tasks[0]]
+
+def test_preempt_suspends_lower_priority_tasks():
+    low = [FakeTask(), FakeTask()]
+    suspended = []
+    resumed = []
+    scheduler, launched = make_scheduler(
+        low, max_slots=2, suspend=suspended.append, resume=resumed.append)
+    scheduler.start_ready()
+    assert len(launched) == 2
+
+    high = FakeTask(priority=1)
+    scheduler.tasks.append(high)
+    scheduler.add_task(high)
+    scheduler.start_ready()
+    # the most recently added low priority task makes room
+    assert [r.task for r in suspended] == [low[1]]
+    assert launched[-1].task is high
+    assert low[1].state_message == "suspended"
+
+    scheduler.handle_exit(launched[-1], 0)
+    scheduler.start_ready()
+    assert resumed == suspended
+    assert scheduler.runners[low[1].id].suspended_at is None
+    assert scheduler.slots == 0
+
+def test_preempt_leaves_equal_priority_alone():
+    tasks = [FakeTask(), FakeTask(), FakeTask()]
+    suspended = []
+    scheduler, launched = make_scheduler(
+        tasks, suspend=suspended.append, resume=lambda r: None)
+    scheduler.start_ready()
+    assert len(launched) == 2
+    assert not suspended
+
+def test_expired_lease_is_requeued():
+    t = FakeTask()
+    scheduler, _ = make_scheduler([t])
+    runner = scheduler.lease("worker1", 2, 2, 60)
+    assert runner.task is t
+    assert t.state == task_states.running
+    assert scheduler.renew(t.id, "wrong token") is None
+    assert scheduler.renew(t.id, runner.lease_token) is runner
+
+    runner.lease_expiry = 0
+    scheduler.expire_leases()
+    assert t.state == task_states.waiting
+    assert t.state_message == "requeued, lost worker1"
+    # the old lease can't report on it anymore
+    assert scheduler.renew(t.id, runner.lease_token) is None
+
+    again = scheduler.lease("worker2", 2, 2, 60)
+    assert again.task is t
+    assert again.lease_token != runner.lease_token
@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from impls import task
+from impls.taskdb import TaskStore
+
+def make_task(d):
+    return dict(d)
+
+def test_journal_replays_over_the_snapshot(tmp_path):
+    store = TaskStore(str(tmp_path / "tasks"))
+    store.compact([{"id": "a", "state": "waiting"},
+                   {"id": "b", "state": "waiting"}])
+    store.append([{"op": "set", "id": "a", "data": {"state": "completed"}},
+                  {"op": "add", "task": {"id": "c", "state": "waiting"}},
+                  {"op": "remove", "id": "b"}])
+
+    tasks = TaskStore(str(tmp_path / "tasks")).load(make_task)
+    assert tasks == [{"id": "a", "state": "completed"},
+                     {"id": "c", "state": "waiting"}]
+
+def test_torn_journal_tail_is_cut_off(tmp_path):
+    store = TaskStore(str(tmp_path / "tasks"))
+    store.append([{"op": "add", "task": {"id": "a", "state": "waiting"}}])
+    good_size = os.path.getsize(store.journal_file)
+    # the process died in the middle of the next write
+    with open(store.journal_file, "a") as f:
+        f.write('{"op": "set", "id": "a", "data": {"sta')
+
+    store = TaskStore(str(tmp_path / "tasks"))
+    assert store.load(make_task) == [{"id": "a", "state": "waiting"}]
+    assert store.journal_records == 1
+    assert os.path.getsize(store.journal_file) == good_size
+
+    store.append([{"op": "set", "id": "a", "data": {"state": "error"}}])
+    assert TaskStore(str(tmp_path / "tasks")).load(make_task) == \
+           [{"id": "a", "state": "error"}]
+
+def test_crash_before_the_journal_is_removed(tmp_path):
+    store = TaskStore(str(tmp_path / "tasks"))
+    store.append([{"op": "add", "task": {"id": "a", "n": 0}},
+                  {"op": "set", "id": "a", "data": {"n": 1}},
+                  {"op": "add", "task": {"id": "b", "n": 0}}])
+    tasks = store.load(make_task)
+    shutil.copyfile(store.journal_file, str(tmp_path / "journal"))
+    store.compact(tasks)
+    # the snapshot was written, the journal is still there
+    shutil.copyfile(str(tmp_path / "journal"), store.journal_file)
+
+    assert TaskStore(str(tmp_path / "tasks")).load(make_task) == tasks
+
+def test_compacts_after_1000_records(tmp_path):
+    store = TaskStore(str(tmp_path / "tasks"))
+    store.append([{"op": "add", "task": {"id": "a", "n": 0}}])
+    store.append([{"op": "set", "id": "a", "data": {"n": i}}
+                  for i in range(1, 999)])
+    assert not store.should_compact()
+
+    store.append([{"op": "set", "id": "a", "data": {"n": 999}}])
+    assert store.should_compact()
+
+    tasks = TaskStore(str(tmp_path / "tasks")).load(make_task)
+    assert tasks == [{"id": "a", "n": 999}]
+    store.compact(tasks)
+    assert not os.path.exists(store.journal_file)
+    with open(store.task_file, "r") as f:
+        assert json.load(f) == tasks
+
+    assert TaskStore(str(tmp_path / "tasks")).load(make_task) == tasks
+
+def test_task_save_journals_changes(tmp_path, monkeypatch):
+    task_file = str(tmp_path / "tasks")
+    task.task_load(task_file)
+    monkeypatch.chdir(tmp_path)
+    task.task_add_internal(["mkv_720p", "in.avs", "out.264", "20"])
+    task.task_save()
+    task.tasks[0].set_state("completed", "done")
+    task.task_save()
+
+    task.task_load(task_file)
+    assert len(task.tasks) == 1
+    assert task.tasks[0].state == "completed"
+    assert task.tasks[0].state_message == "done"
+    assert task.task_store.journal_records == 2
+
+def set_up_tasks(tmp_path, count):
+    task.task_load(str(tmp_path / "tasks"))
+    for i in range(count):
+        task.task_add_internal(["mkv_720p", "in{0}.avs".format(i)])
+
+def test_set_depends(tmp_path):
+    set_up_tasks(tmp_path, 3)
+    task.task_set_depends(["2", "0", "1"])
+    assert task.tasks[2].depends == [task.tasks[0].id, task.tasks[1].id]
+
+def test_set_depends_rejects_cycles(tmp_path):
+    set_up_tasks(tmp_path, 3)
+    task.task_set_depends(["1", "0"])
+    task.task_set_depends(["2", "1"])
+    with pytest.raises(ValueError) as e:
+        task.task_set_depends(["0", "2"])
+
+    message = str(e.value)
+    assert message.startswith("Dependency cycle: ")
+    assert sorted(message.split(": ")[1].split(" -> ")[:-1]) == \
+           ["0", "1", "2"]
+    assert not task.tasks[0].depends
+
+    with pytest.raises(ValueError):
+        task.task_set_depends(["0", "0"])
@@ -0,0 +1,104 @@
+import json
+import subprocess
+import sys
+
+from conftest import fake_x264
+from impls.x264_output import X264OutputParser, parse_line, event_types, \
+                              read_output
+from impls.encx264_impl import parse_encode_result_line
+from impls.bench import legacy_parse, event_parse, sample_output
+
+def fake_output(*args):
+    p = subprocess.Popen([sys.executable, fake_x264] + list(args),
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    lines = list(read_output(p.stdout))
+    p.wait()
+    return lines
+
+def test_progress_line():
+    event = parse_line("[12.3%] 123/1000 frames, 23.45 fps, 1234.56 kb/s, "
+                       "eta 0:01:02")
+    assert event.type == event_types.progress
+    assert event.percent == 12.3
+    assert event.frames == 123
+    assert event.total == 1000
+    assert event.fps == 23.45
+    assert event.kbps == 1234.56
+    assert event.eta == 62
+
+def test_progress_line_without_bitrate():
+    event = parse_line("[50.0%] 5/10 frames, 2.00 fps")
+    assert event.type == event_types.progress
+    assert event.kbps is None
+    assert event.eta is None
+
+def test_unknown_total_falls_back():
+    event = parse_line("123 frames: 23.45 fps, 1234.56 kb/s")
+    assert event.type == event_types.progress
+    assert event.frames == 123
+    assert event.total is None
+    assert event.percent is None
+    assert event.kbps == 1234.56
+
+def test_summary_line():
+    event = parse_line("encoded 100 frames, 23.45 fps, 4321.00 kb/s")
+    assert event.type == event_types.summary
+    assert (event.frames, event.fps, event.kbps) == (100, 23.45, 4321.0)
+    assert parse_encode_result_line(event.line) == \
+           {"fps": 23.45, "bitrate": 4321, "frames": 100}
+
+def test_other_lines_are_text():
+    for line in ["x264 [info]: profile High, level 4.1",
+                 "encoded nothing",
+                 "piper says hi",
+                 ""]:
+        assert parse_line(line).type == event_types.text
+
+    assert parse_encode_result_line("x264 [error]: could not open input") \
+           is None
+
+def test_piper_line():
+    stats = {"bottleneck": "producer", "bytes": 123}
+    line = "piper stats: " + json.dumps(stats)
+    parser = X264OutputParser()
+    parser.feed(line)
+    parser.feed("encoded 10 frames, 5.00 fps, 100.00 kb/s")
+    assert parse_line(line).type == event_types.piper
+    assert parser.result()["piper"] == stats
+
+    assert parse_line("piper stats: {broken").stats is None
+
+def test_parser_reads_fake_x264(monkeypatch):
+    monkeypatch.setenv("FAKE_X264_FRAMES", "200")
+    events = []
+    parser = X264OutputParser(events.append)
+    for line in fake_output("--pass", "2", "--bitrate", "1500"):
+        parser.feed(line)
+
+    progress = [e for e in events if e.type == event_types.progress]
+    assert progress and progress[-1].total == 200
+    assert parser.progress is progress[-1]
+    assert parser.ssim.ssim == 0.9812345
+
+    result = parser.result()
+    assert result["frames"] == 200
+    assert result["bitrate"] == 1500
+    assert result["resolution"] == "1920x1080"
+    assert result["piper"] is None
+
+def test_no_summary_no_result(monkeypatch):
+    monkeypatch.setenv("FAKE_X264_FAIL_AT", "10")
+    monkeypatch.setenv("FAKE_X264_EXIT", "1")
+    parser = X264OutputParser()
+    for line in fake_output("--crf", "20"):
+        parser.feed(line)
+
+    assert parser.result() is None
+
+def test_same_result_as_legacy_parse():
+    lines = sample_output(2000)
+    legacy = legacy_parse(lines)
+    events = event_parse(lines)
+    assert legacy["fps"] == events["fps"]
+    assert legacy["bitrate"] == events["bitrate"]
+    assert abs(legacy["percent_sum"] - events["percent_sum"]) < 0.01